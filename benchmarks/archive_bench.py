@@ -0,0 +1,102 @@
+"""
+ Records a crawl of the local stand-in sites into a page archive, then replays it with the sites shut down and
+ checks the replay wrote the same outputs.
+
+    python -m benchmarks.archive_bench --recipes 5000 --latency 0.05
+    python -m benchmarks.archive_bench --processes 1 2 4 8      # replay once per pool size
+
+ The recording runs every scraper in --scrapers (each after the ones it DEPENDS_ON) with ARCHIVE_MODE=record in one
+ working directory. Each replay runs them again with ARCHIVE_MODE=replay in a fresh working directory, so no cache
+ or frontier of the recording is reused and every page is read from the archive.
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+
+from typing import Dict, List
+
+from benchmarks import stand_in
+from benchmarks.scraper_bench import read_report, run_child, scraper_environment
+from utils.outputs import Outputs, read_records
+
+SCRAPERS = ("recipetineats", "bbcgoodfood_lists", "recipe_details")
+
+
+def run_all(scrapers: List[str], workdir: str, env: Dict[str, str], timeout: float) -> dict:
+    os.makedirs(workdir, exist_ok=True)
+    results = {}
+    for name in scrapers:
+        result = run_child(name, workdir, env, timeout)
+        report = read_report(workdir, name) or {'counters': []}
+        result['archive'] = {counter['labels']['outcome']: counter['value'] for counter in report['counters']
+                             if counter['name'] == "archive_pages_total"}
+        results[name] = result
+    results['wall_seconds'] = round(sum(result['wall_seconds'] for result in results.values()), 3)
+    return results
+
+
+def read_outputs(workdir: str, scrapers: List[str]) -> Dict[str, List[str]]:
+    """Every output file's records, sorted (crawl order differs between runs)"""
+    outputs = {}
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        for name in scrapers:
+            output = Outputs(name)
+            for filename in output.files():
+                records = read_records(os.path.join(output.output_dir, filename))
+                outputs[f"{name}/{filename}"] = sorted(json.dumps(record, sort_keys=True) for record in records)
+    finally:
+        os.chdir(cwd)
+    return outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    stand_in.add_arguments(parser)
+    parser.add_argument("--scrapers", nargs="+", choices=SCRAPERS, default=list(SCRAPERS))
+    parser.add_argument("--processes", nargs="+", type=int, default=[os.cpu_count() or 1],
+                        help="ARCHIVE_PROCESSES of each replay")
+    parser.add_argument("--timeout", type=float, default=900, help="Seconds a scraper may run")
+    parser.add_argument("--keep", action="store_true", help="Keep the working directories")
+    args = parser.parse_args()
+
+    servers = stand_in.start(stand_in.catalogue_from_args(args), args.latency, args.jitter, args.pages)
+    env = scraper_environment(servers)
+    root = tempfile.mkdtemp(prefix="archive_bench-")
+    env['ARCHIVE_PATH'] = os.path.join(root, "pages.warc.gz")
+    try:
+        recording = run_all(args.scrapers, os.path.join(root, "record"), dict(env, ARCHIVE_MODE="record"),
+                            args.timeout)
+    finally:
+        # Nothing can be fetched from here on, a replay that tries fails
+        for server in servers.values():
+            server.shutdown()
+    try:
+        expected = read_outputs(os.path.join(root, "record"), args.scrapers)
+        replays = {}
+        for processes in args.processes:
+            workdir = os.path.join(root, f"replay-{processes}")
+            replay = run_all(args.scrapers, workdir, dict(env, ARCHIVE_MODE="replay", ARCHIVE_PROCESSES=str(processes)),
+                             args.timeout)
+            replay['same_outputs'] = read_outputs(workdir, args.scrapers) == expected
+            replays[processes] = replay
+    finally:
+        if args.keep:
+            print(f"Working directories kept in {root}", file=sys.stderr)
+        archive_mb = round(os.path.getsize(env['ARCHIVE_PATH']) / 1024 / 1024, 2)
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print(json.dumps({'archive_mb': archive_mb, 'output_records': sum(len(records) for records in expected.values()),
+                      'record': recording, 'replay': replays}, indent=2))
+    failed = any(result['exit_code'] != 0 for run in [recording] + list(replays.values())
+                 for result in run.values() if isinstance(result, dict) and 'exit_code' in result)
+    return 1 if failed or not all(replay['same_outputs'] for replay in replays.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+"""
+ Cache microbenchmark, measures get/set throughput with a large key space and many threads.
+
+    python -m benchmarks.cache_bench --keys 100000 --threads 32 --seconds 5
+"""
+import os
+import time
+import json
+import random
+import argparse
+import tempfile
+import threading
+
+from utils.cache import Cache, MemoryBackend, SQLiteBackend
+
+
+def run(cache: Cache, keys: int, threads: int, seconds: float, write_ratio: float) -> dict:
+    counts = [0] * threads
+    stop = threading.Event()
+
+    def worker(index):
+        rng = random.Random(index)
+        done = 0
+        while not stop.is_set():
+            key = f"key{rng.randrange(keys)}"
+            if rng.random() < write_ratio:
+                cache.set(key, {'n': done}, ttl=rng.randint(1, 600))
+            else:
+                cache.get(key)
+            done += 1
+        counts[index] = done
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    time.sleep(seconds)
+    stop.set()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    return {'ops': sum(counts), 'seconds': round(elapsed, 3), 'ops_per_sec': round(sum(counts) / elapsed)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keys", type=int, default=100_000)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--write-ratio", type=float, default=0.1)
+    parser.add_argument("--backend", choices=("memory", "sqlite"), default="memory")
+    args = parser.parse_args()
+
+    if args.backend == "sqlite":
+        backend = SQLiteBackend(os.path.join(tempfile.mkdtemp(), "bench.sqlite"))
+    else:
+        backend = MemoryBackend()
+    cache = Cache(backend)
+    # Prefill through the backend so start-up doesn't dominate the run
+    expires = time.time() + 600
+    for i in range(args.keys):
+        backend.save(f"cache_bench-key{i}", json.dumps({'n': i}), expires)
+    result = run(cache, args.keys, args.threads, args.seconds, args.write_ratio)
+    print(json.dumps({'backend': args.backend, 'keys': args.keys, 'threads': args.threads, **result}))
+
+
+if __name__ == "__main__":
+    main()
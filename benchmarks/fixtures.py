@@ -0,0 +1,85 @@
+"""
+ Synthetic page fixtures shaped like the real sites, used by the benchmarks when no recorded pages are given.
+ Each page carries a realistic amount of boilerplate (navigation, scripts, sidebars) around the parts the scrapers
+ extract, since that boilerplate is what makes full-tree parsing expensive.
+"""
+import json
+import random
+
+_WORDS = ("garlic butter chicken easy quick creamy pasta crispy roast beef vegetable soup lemon honey "
+          "slow cooker curry salad spicy tomato baked salmon").split()
+
+
+def _title(rng: random.Random) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(4)).title()
+
+
+def _boilerplate(rng: random.Random, size: int) -> str:
+    nav = "".join(f'<li class="menu-item"><a href="/page-{i}/">{_title(rng)}</a></li>' for i in range(size))
+    script = "<script>window.__data = " + ",".join(str(rng.random()) for _ in range(size * 5)) + ";</script>"
+    sidebar = "".join(f'<div class="widget"><p>{_title(rng)} {_title(rng)}</p></div>' for _ in range(size))
+    return f'<header><nav><ul>{nav}</ul></nav></header>{script}<aside>{sidebar}</aside>'
+
+
+def recipetineats_home(base_url: str, categories: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    links = "".join(f'<a href="{base_url}category/cat-{i}/">{_title(rng)}</a>' for i in range(categories))
+    return f'<html><head><title>RecipeTin Eats</title></head><body>{_boilerplate(rng, 80)}' \
+           f'<div class="categories">{links}</div></body></html>'
+
+
+def recipetineats_listing(base_url: str, recipes, next_page: str = None, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    articles = "".join(
+        f'<article class="post entry"><header><h2 class="entry-title">'
+        f'<a class="entry-title-link" rel="bookmark" href="{base_url}{slug}/">{_title(rng)}</a></h2></header>'
+        f'<div class="entry-content"><img src="/img/{slug}.jpg" alt=""><p>{_title(rng)} {_title(rng)}</p></div>'
+        f'</article>' for slug in recipes)
+    pagination = f'<a class="next page-numbers" href="{next_page}">Next</a>' if next_page else ""
+    return f'<html><head><title>Category</title></head><body>{_boilerplate(rng, 80)}' \
+           f'<main class="content">{articles}</main><div class="pagination">{pagination}</div>' \
+           f'{_boilerplate(rng, 40)}</body></html>'
+
+
+def bbcgoodfood_list(recipes, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    items = "".join(
+        f'<div class="recipe-item"><h3 id="{100 + i}" class="heading"><a href="/recipes/{slug}">{_title(rng)}</a>'
+        f'</h3><p>{_title(rng)} {_title(rng)} {_title(rng)}</p></div>' for i, slug in enumerate(recipes))
+    return f'<html><head><title>List</title></head><body>{_boilerplate(rng, 120)}' \
+           f'<div class="post-content">{items}</div>{_boilerplate(rng, 60)}</body></html>'
+
+
+def recipe_page(url: str, ingredients, seed: int = 0, graph: bool = True) -> str:
+    """
+    A recipe page with its schema.org Recipe as JSON-LD, in a Yoast style @graph in the head (graph=True, as on
+    RecipeTin Eats) or as a standalone block in the body (as on BBC Good Food)
+    """
+    rng = random.Random(seed)
+    name = _title(rng)
+    recipe = {
+        '@type': "Recipe", 'name': name, 'description': f"{_title(rng)} &amp; {_title(rng)}",
+        'recipeIngredient': list(ingredients),
+        'recipeInstructions': [{'@type': "HowToSection", 'name': "Method", 'itemListElement': [
+            {'@type': "HowToStep", 'text': f"{_title(rng)} {_title(rng)}."} for _ in range(rng.randint(3, 8))]}],
+        'prepTime': f"PT{rng.randint(5, 30)}M", 'cookTime': f"PT{rng.randint(0, 2)}H{rng.randint(0, 59)}M",
+        'recipeYield': [str(rng.randint(2, 8)), f"{rng.randint(2, 8)} servings"],
+        'nutrition': {'@type': "NutritionInformation", 'calories': f"{rng.randint(150, 900)} kcal",
+                      'proteinContent': f"{rng.randint(2, 60)} g", 'fatContent': f"{rng.randint(1, 50)} g"},
+        'recipeCategory': ["Main"], 'recipeCuisine': ["Australian"],
+    }
+    if graph:
+        data = {'@context': "https://schema.org", '@graph': [
+            {'@type': "WebPage", '@id': url, 'name': name}, {'@type': "Organization", 'name': "Stand-in"},
+            dict(recipe, mainEntityOfPage=url)]}
+        head = f'<script type="application/ld+json" class="yoast-schema-graph">{json.dumps(data)}</script>'
+        body = ""
+    else:
+        head = ""
+        standalone = dict({'@context': "https://schema.org"}, **recipe)
+        body = f'<script type="application/ld+json">{json.dumps(standalone)}</script>'
+    steps = "".join(f"<li>{step['text']}</li>" for step in recipe['recipeInstructions'][0]['itemListElement'])
+    items = "".join(f"<li>{ingredient}</li>" for ingredient in ingredients)
+    return f'<html><head><title>{name}</title>{head}</head><body>{_boilerplate(rng, 120)}' \
+           f'<main><article><h1>{name}</h1><ul class="ingredients">{items}</ul><ol>{steps}</ol></article></main>' \
+           f'{body}{_boilerplate(rng, 60)}</body></html>'
@@ -0,0 +1,98 @@
+"""
+ Compares FoodIndex nearest-match lookups against scoring every food in the catalogue, on a synthetic catalogue of
+ multi-word food names queried with misspelled, pluralized and recased variants.
+
+    python -m benchmarks.food_index_bench --foods 50000 --queries 2000
+"""
+import json
+import time
+import random
+import argparse
+
+from utils.food_index import FoodIndex, FOOD_MATCH_THRESHOLD, normalize_food_name, trigrams, similarity
+
+_WORDS = ("chicken beef pork lamb salmon prawn tofu egg milk butter cream cheese yoghurt flour sugar rice pasta "
+          "noodle tomato onion garlic ginger chilli carrot potato pumpkin spinach kale lettuce cucumber capsicum "
+          "mushroom pea bean lentil chickpea corn lemon lime orange apple banana berry mango coconut almond cashew "
+          "walnut peanut sesame soy honey vinegar mustard basil coriander parsley mint thyme rosemary oregano cumin "
+          "paprika turmeric cinnamon nutmeg pepper salt stock wine oat quinoa couscous bread tortilla").split()
+_QUALIFIERS = ("red green white black brown smoked fresh dried ground frozen baby sweet sour hot plain wholemeal "
+               "raw roasted toasted light dark extra virgin organic free range").split()
+
+
+def catalogue(size: int, rng: random.Random) -> list:
+    names = set()
+    while len(names) < size:
+        words = rng.sample(_QUALIFIERS, rng.randint(0, 2)) + rng.sample(_WORDS, rng.randint(1, 2))
+        names.add(" ".join(words).title())
+    return sorted(names)
+
+
+def variant(name: str, rng: random.Random) -> str:
+    """A spelling of the name that should still match it"""
+    words = name.split()
+    i = rng.randrange(len(words))
+    word = words[i]
+    change = rng.choice(("plural", "typo", "case"))
+    if change == "plural":
+        words[i] = word + "s"
+    elif change == "typo" and len(word) > 4:
+        j = rng.randrange(1, len(word) - 1)
+        words[i] = word[:j] + word[j + 1:]
+    return " ".join(words).lower() if change == "case" else " ".join(words)
+
+
+def linear_nearest(names, grams, query: str, threshold: float):
+    query_grams = trigrams(normalize_food_name(query))
+    best = None
+    for name, food_grams in zip(names, grams):
+        score = similarity(query_grams, food_grams)
+        if score >= threshold and (best is None or score > best[1]):
+            best = (name, score)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--foods", type=int, default=50_000)
+    parser.add_argument("--queries", type=int, default=2_000)
+    parser.add_argument("--threshold", type=float, default=FOOD_MATCH_THRESHOLD)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    names = catalogue(args.foods, rng)
+    queries = [variant(rng.choice(names), rng) for _ in range(args.queries)]
+
+    start = time.perf_counter()
+    index = FoodIndex(names)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    indexed = [index.nearest(query, args.threshold) for query in queries]
+    indexed_seconds = time.perf_counter() - start
+
+    # The linear scan is far slower, a sample of the queries is enough
+    sample = queries[:max(1, args.queries // 20)]
+    grams = [trigrams(normalize_food_name(name)) for name in names]
+    start = time.perf_counter()
+    linear = [linear_nearest(names, grams, query, args.threshold) for query in sample]
+    linear_seconds = time.perf_counter() - start
+
+    # Ties may resolve to different names, the scores have to agree
+    agree = sum((a is None) == (b is None) and (a is None or abs(a[1] - b[1]) < 1e-9)
+                for a, b in zip(indexed, linear))
+    indexed_per_query = indexed_seconds / len(queries)
+    linear_per_query = linear_seconds / len(sample)
+    print(json.dumps({
+        'foods': len(index), 'build_seconds': round(build, 3),
+        'matched': sum(result is not None for result in indexed) / len(queries),
+        'indexed_us_per_query': round(indexed_per_query * 1e6, 1),
+        'linear_us_per_query': round(linear_per_query * 1e6, 1),
+        'speedup': round(linear_per_query / indexed_per_query, 1),
+        'agreement': agree / len(sample),
+    }))
+
+
+if __name__ == "__main__":
+    main()
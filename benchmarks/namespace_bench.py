@@ -0,0 +1,51 @@
+"""
+ Compares Cache get/set throughput when the namespace comes from inspect.stack() (the original lookup),
+ from the frame based fallback, and from a namespace handle.
+
+    python -m benchmarks.namespace_bench --ops 20000
+"""
+import os
+import json
+import time
+import inspect
+import argparse
+
+from unittest import mock
+
+from utils import cache as cache_module
+from utils.cache import Cache, MemoryBackend
+
+
+def inspect_stack_filename():
+    """The original get_calling_filename, for comparison"""
+    frame = inspect.stack()[2]
+    module = inspect.getmodule(frame[0])
+    return os.path.basename(module.__file__).split(".")[0]
+
+
+def measure(target, ops: int) -> float:
+    start = time.perf_counter()
+    for i in range(ops):
+        target.set(f"key{i % 1000}", i)
+        target.get(f"key{i % 1000}")
+    return round(2 * ops / (time.perf_counter() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ops", type=int, default=20_000)
+    args = parser.parse_args()
+
+    cache = Cache(MemoryBackend())
+    results = {}
+    with mock.patch.object(cache_module, "get_calling_filename", inspect_stack_filename):
+        # inspect.stack() is orders of magnitude slower, a smaller sample is enough
+        results['inspect_stack'] = measure(cache, max(args.ops // 20, 1))
+    results['frame_fallback'] = measure(cache, args.ops)
+    results['namespace_handle'] = measure(cache.namespace("namespace_bench"), args.ops)
+    results['speedup'] = round(results['namespace_handle'] / results['inspect_stack'], 1)
+    print(json.dumps({'ops_per_sec': results}))
+
+
+if __name__ == "__main__":
+    main()
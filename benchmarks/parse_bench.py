@@ -0,0 +1,83 @@
+"""
+ Parse-time benchmark comparing the HTML parser backends on the extraction specs the scrapers use.
+
+    python -m benchmarks.parse_bench                              # synthetic pages
+    python -m benchmarks.parse_bench --pages saved/ --spec recipetineats
+
+ The "bs4-full" row is the original approach, a full BeautifulSoup tree followed by find_all.
+"""
+import os
+import json
+import time
+import argparse
+
+import bs4
+
+from benchmarks import fixtures
+from utils.parsers import available_backends, get_backend
+from scrapers import bbcgoodfood_lists, recipetineats
+
+SPECS = {
+    'recipetineats': recipetineats.RECIPE_LINKS,
+    'categories': recipetineats.CATEGORY_LINKS,
+    'bbcgoodfood': bbcgoodfood_lists.RECIPE_LINKS,
+}
+
+
+def synthetic_pages(spec_name: str):
+    slugs = [f"recipe-{i}" for i in range(40)]
+    if spec_name == 'bbcgoodfood':
+        return [fixtures.bbcgoodfood_list(slugs, seed=i) for i in range(10)]
+    if spec_name == 'categories':
+        return [fixtures.recipetineats_home("https://www.recipetineats.com/", 60, seed=i) for i in range(10)]
+    return [fixtures.recipetineats_listing("https://www.recipetineats.com/", slugs, seed=i) for i in range(10)]
+
+
+def full_tree(html, spec):
+    soup = bs4.BeautifulSoup(html, 'html.parser')
+    values = []
+    for element in soup.find_all(spec.tag, attrs=spec.attrs):
+        target = element.select_one(spec.select) if spec.select else element
+        if target is not None and target.get(spec.attr) is not None:
+            values.append(target.get(spec.attr))
+    return values
+
+
+def measure(fn, pages, spec, repeat: int) -> dict:
+    found = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for html in pages:
+            found = len(fn(html, spec))
+    elapsed = time.perf_counter() - start
+    return {'ms_per_page': round(1000 * elapsed / (repeat * len(pages)), 3), 'found_last_page': found}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", help="Directory of saved .html pages")
+    parser.add_argument("--spec", choices=sorted(SPECS), default="recipetineats")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.pages:
+        pages = []
+        for name in sorted(os.listdir(args.pages)):
+            if name.endswith(".html"):
+                with open(os.path.join(args.pages, name), "r", encoding="utf-8", errors="replace") as f:
+                    pages.append(f.read())
+    else:
+        pages = synthetic_pages(args.spec)
+    spec = SPECS[args.spec]
+
+    results = {'bs4-full': measure(full_tree, pages, spec, args.repeat)}
+    for name in available_backends():
+        results[name] = measure(get_backend(name).extract, pages, spec, args.repeat)
+    baseline = results['bs4-full']['ms_per_page']
+    for result in results.values():
+        result['speedup'] = round(baseline / result['ms_per_page'], 1) if result['ms_per_page'] else None
+    print(json.dumps({'spec': args.spec, 'pages': len(pages), 'results': results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
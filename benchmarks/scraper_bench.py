@@ -0,0 +1,209 @@
+"""
+ End to end scraper benchmark against the local stand-in sites (benchmarks.stand_in), no network needed.
+
+    python -m benchmarks.scraper_bench
+    python -m benchmarks.scraper_bench --recipes 10000 --latency 0.05 --scrapers mealie_food_builder
+    python -m benchmarks.scraper_bench --save-baseline        # record the current numbers
+    python -m benchmarks.scraper_bench --check                # exit 1 if a scenario regressed
+
+ Every scraper runs unattended in its own process and working directory, so its caches and outputs start empty
+ (--warm runs it once first and measures the second, incremental run). Scrapers it DEPENDS_ON are run first in the
+ same directory, unmeasured, to produce its inputs. Requests and pages are read from the run's
+ metrics report, peak RSS from the process's resource usage. Baselines are kept per scenario (scraper, catalogue,
+ latency, cold or warm) in benchmarks/baseline.json, a scenario regresses when its wall time, peak RSS or request
+ count grows by more than --tolerance.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import urllib.parse as urlparse
+
+from typing import Dict, List, Optional
+
+from benchmarks import stand_in
+from utils.registry import discover_scrapers
+
+SCRAPERS = ("recipetineats", "bbcgoodfood_lists", "mealie_food_builder", "recipe_details")
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+# Lower is better for all of them
+CHECKED = ("wall_seconds", "peak_rss_mb", "requests")
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def scraper_environment(servers: Dict[str, stand_in.StandInServer]) -> Dict[str, str]:
+    """Environment pointing every scraper at the stand-in sites and answering all of their prompts"""
+    hosts = [urlparse.urlsplit(servers[site].base_url).netloc for site in ('recipetineats', 'bbcgoodfood')]
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': os.pathsep.join(filter(None, [REPOSITORY, os.getenv("PYTHONPATH")])),
+        'LOGGING_LEVEL': os.getenv("LOGGING_LEVEL", "WARNING"),
+        'TQDM_DISABLE': "1",
+        'METRICS_ENABLED': "1",
+        'METRICS_DIRECTORY': "./metrics",
+        'RECIPETINEATS_URL': servers['recipetineats'].base_url,
+        'RECIPETINEATS_DISCOVERY': "categories",
+        'BBCGOODFOOD_URL': servers['bbcgoodfood'].base_url + "recipes/collection/quick-lunch-ideas",
+        'BBCGOODFOOD_DISCOVERY': "list",
+        'MEALIE_URL': servers['mealie'].base_url,
+        'MEALIE_API_TOKEN': "stand-in",
+        'MEALIE_CHECK_FOODS': "n",
+        'MEALIE_CREATE_FOODS': "y",
+        # What's measured is the scrapers, not the politeness limits of the real sites
+        'MEALIE_WRITE_RATE': "0",
+        'HTTP_HOST_RATES': ",".join(f"{host}=0" for host in hosts),
+    })
+    return env
+
+
+def run_child(name: str, workdir: str, env: Dict[str, str], timeout: float) -> dict:
+    """Run one scraper in a fresh process, returning its exit code, wall time and peak RSS"""
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "benchmarks.scraper_bench", "--child", f"scrapers.{name}"],
+                               cwd=workdir, env=env, stdin=subprocess.DEVNULL)
+    while True:
+        # wait4 rather than Popen.wait, it is the only way to get the resource usage of this one child
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            break
+        if time.perf_counter() - started > timeout:
+            process.kill()
+            pid, status, usage = os.wait4(process.pid, 0)
+            break
+        time.sleep(0.05)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return {'exit_code': process.returncode, 'wall_seconds': round(time.perf_counter() - started, 3),
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_mb': round(usage.ru_maxrss / 1024, 1)}
+
+
+def read_report(workdir: str, name: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(workdir, "metrics", f"{name}.json"), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def summarize_report(report: Optional[dict], wall_seconds: float) -> dict:
+    if report is None:
+        return {}
+    requests = pages = 0
+    for counter in report['counters']:
+        if counter['name'] == "http_responses_total":
+            requests += counter['value']
+            if counter['labels'].get('status') in ("200", "304"):
+                pages += counter['value']
+        elif counter['name'] == "http_errors_total":
+            requests += counter['value']
+    received = sum(histogram['sum'] for histogram in report['histograms'] if histogram['name'] == "http_response_bytes")
+    return {'requests': requests, 'pages': pages,
+            'requests_per_sec': round(requests / wall_seconds, 1) if wall_seconds else None,
+            'pages_per_sec': round(pages / wall_seconds, 1) if wall_seconds else None,
+            'received_mb': round(received / 1024 / 1024, 2),
+            'http_cache': report['stats'].get('http_cache')}
+
+
+def scenario_key(name: str, args) -> str:
+    mode = "warm" if args.warm else "cold"
+    return f"{name}|recipes={args.recipes}|categories={args.categories}|list={args.list_size}|" \
+           f"latency={args.latency}|{mode}"
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """Regressions against the baseline, one line per metric that grew by more than tolerance"""
+    regressions = []
+    for key, result in results.items():
+        reference = baseline.get(key)
+        if reference is None:
+            continue
+        for metric in CHECKED:
+            if result.get(metric) is None or not reference.get(metric):
+                continue
+            change = result[metric] / reference[metric] - 1
+            result.setdefault('change', {})[metric] = round(change, 3)
+            if change > tolerance:
+                regressions.append(f"{key}: {metric} {reference[metric]} -> {result[metric]} (+{change:.0%})")
+    return regressions
+
+
+def load_baseline(path: str) -> Dict[str, dict]:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def child(module: str):
+    """Entry point of the scraper process, run from its working directory"""
+    import logging
+    from utils.runner import run_scraper
+
+    logging.basicConfig(level=os.getenv("LOGGING_LEVEL", "WARNING"),
+                        format=f"%(asctime)s - {module} - %(levelname)s - %(message)s")
+    run_scraper(module)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    stand_in.add_arguments(parser)
+    parser.add_argument("--scrapers", nargs="+", choices=SCRAPERS, default=list(SCRAPERS))
+    parser.add_argument("--warm", action="store_true", help="Measure a second run over the first run's caches")
+    parser.add_argument("--timeout", type=float, default=900, help="Seconds a scraper may run")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Baseline file")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the baseline")
+    parser.add_argument("--check", action="store_true", help="Exit 1 if a scenario regressed against the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed growth before it is a regression")
+    parser.add_argument("--keep", action="store_true", help="Keep the working directories")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child)
+        return 0
+
+    servers = stand_in.start(stand_in.catalogue_from_args(args), args.latency, args.jitter, args.pages)
+    env = scraper_environment(servers)
+    root = tempfile.mkdtemp(prefix="scraper_bench-")
+    results = {}
+    registry = discover_scrapers(os.path.join(REPOSITORY, "scrapers"))
+    try:
+        for name in args.scrapers:
+            workdir = os.path.join(root, name)
+            os.makedirs(workdir)
+            for dependency in registry[name].depends_on:
+                run_child(dependency, workdir, env, args.timeout)
+            if args.warm:
+                run_child(name, workdir, env, args.timeout)
+            result = run_child(name, workdir, env, args.timeout)
+            result.update(summarize_report(read_report(workdir, name), result['wall_seconds']))
+            results[scenario_key(name, args)] = dict(result, scraper=name)
+    finally:
+        for server in servers.values():
+            server.shutdown()
+        if args.keep:
+            print(f"Working directories kept in {root}", file=sys.stderr)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    baseline = load_baseline(args.baseline)
+    regressions = compare(results, baseline, args.tolerance)
+    failed = [key for key, result in results.items() if result['exit_code'] != 0]
+    print(json.dumps({'results': results, 'regressions': regressions, 'failed': failed}, indent=2))
+    if args.save_baseline:
+        baseline.update({key: {metric: result.get(metric) for metric in CHECKED + ('pages_per_sec',)}
+                         for key, result in results.items() if result['exit_code'] == 0})
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}", file=sys.stderr)
+    if failed or (args.check and regressions):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,356 @@
+"""
+ Local stand-in for every site the scrapers talk to, so whole scraper runs can be benchmarked offline.
+
+    python -m benchmarks.stand_in --recipes 10000 --latency 0.05
+
+ Each site gets its own port (and so its own host, connection pool and rate limiter, as in production):
+    - recipetineats: homepage with category links, paginated category listings that 404 past the last page, recipe
+      pages (JSON-LD in the head) at /<slug>/
+    - bbcgoodfood: recipe list pages under /recipes/collection/, recipe pages (JSON-LD in the body) at /recipes/<slug>
+    - mealie: /api/app/about, paginated /api/recipes and /api/foods, /api/recipes/<slug>, POST /api/foods and
+      /api/parser/ingredients
+ Pages come from the synthetic fixtures unless a directory of recorded pages is given, a recorded page is served for
+ any path it mirrors (<pages>/<site>/<path>/index.html or <pages>/<site>/<path>) with the real site's links
+ pointed at the stand-in. HTML pages carry an ETag and answer If-None-Match with a 304 so warm runs revalidate.
+"""
+import os
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import urllib.parse as urlparse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+from benchmarks import fixtures
+
+LISTING_PAGE_SIZE = 20
+INGREDIENTS_PER_RECIPE = 8
+REAL_SITES = {
+    'recipetineats': "https://www.recipetineats.com/",
+    'bbcgoodfood': "https://www.bbcgoodfood.com/",
+}
+_FOODS = ("chicken beef pork lamb salmon prawn tofu egg milk butter cream cheese yoghurt flour sugar rice pasta "
+          "noodle potato onion garlic ginger carrot celery tomato capsicum zucchini eggplant spinach kale lettuce "
+          "cucumber avocado lemon lime orange apple banana mushroom pea corn bean lentil chickpea coriander basil "
+          "parsley thyme rosemary oregano cumin paprika turmeric cinnamon chilli pepper salt oil vinegar honey "
+          "mustard stock wine soy miso coconut almond walnut peanut sesame").split()
+_UNITS = ("tsp", "tbsp", "cup", "g", "kg", "ml", "clove", "pinch", "can", "bunch")
+_PREPARATION = ("", "finely chopped", "diced", "sliced", "grated", "crushed", "to taste", "at room temperature")
+
+
+class Catalogue:
+    """Deterministic content of the stand-in sites, sized by the benchmark"""
+
+    def __init__(self, recipes: int = 1000, categories: int = 30, list_size: int = 60, foods: int = 0,
+                 seed: int = 0):
+        self.recipes = recipes
+        self.categories = categories
+        self.list_size = list_size
+        self.seed = seed
+        rng = random.Random(seed)
+        self.recipe_slugs = [f"recipe-{i}" for i in range(recipes)]
+        self.category_recipes: Dict[int, List[str]] = {i: [] for i in range(categories)}
+        for i, slug in enumerate(self.recipe_slugs):
+            self.category_recipes[i % categories].append(slug)
+            # About a third of the recipes are listed in a second category, as on the real site
+            if i % 3 == 0 and categories > 1:
+                self.category_recipes[(i * 7 + 1) % categories].append(slug)
+        self.ingredients = {slug: [self._note(rng) for _ in range(INGREDIENTS_PER_RECIPE)]
+                            for slug in self.recipe_slugs}
+        # Half the foods exist already unless told otherwise, the rest are created by the food builder
+        self.foods = _FOODS[:foods or len(_FOODS) // 2]
+        self.created: List[str] = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _note(rng: random.Random) -> str:
+        note = f"{rng.randint(1, 4)} {rng.choice(_UNITS)} {rng.choice(_FOODS)} {rng.choice(_PREPARATION)}"
+        return note.strip()
+
+    def listing_pages(self, category: int) -> int:
+        return max(1, -(-len(self.category_recipes.get(category, [])) // LISTING_PAGE_SIZE))
+
+    def listing(self, category: int, page: int) -> List[str]:
+        recipes = self.category_recipes.get(category, [])
+        return recipes[(page - 1) * LISTING_PAGE_SIZE:page * LISTING_PAGE_SIZE]
+
+    def recipe_seed(self, slug: str) -> int:
+        return self.seed * 1_000_003 + int(hashlib.md5(slug.encode()).hexdigest()[:8], 16)
+
+    def food_names(self) -> List[str]:
+        with self.lock:
+            return list(self.foods) + self.created
+
+    def create_food(self, name: str) -> bool:
+        with self.lock:
+            if name in self.foods or name in self.created:
+                return False
+            self.created.append(name)
+            return True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes, with Nagle on the body waits for the client's delayed ACK (~40ms)
+    disable_nagle_algorithm = True
+    site = None
+    server: "StandInServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _delay(self):
+        latency, jitter = self.server.latency, self.server.jitter
+        if latency or jitter:
+            time.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: Optional[Dict[str, str]] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+        self.server.count(status)
+
+    def send_html(self, html: Optional[str]):
+        if html is None:
+            return self._send(404, b"Not Found", "text/plain")
+        body = html.encode("utf-8")
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            self.server.count(304)
+            return
+        self._send(200, body, "text/html; charset=utf-8", {"ETag": etag})
+
+    def send_json(self, data, status: int = 200):
+        self._send(status, json.dumps(data).encode("utf-8"), "application/json")
+
+    def do_GET(self):
+        self._delay()
+        parts = urlparse.urlsplit(self.path)
+        if parts.path == "/_stats":
+            return self.send_json(self.server.stats())
+        recorded = self.server.recorded(parts.path)
+        if recorded is not None:
+            return self.send_html(recorded)
+        self.get(parts.path, dict(urlparse.parse_qsl(parts.query)))
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        self._delay()
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"null")
+        self.post(urlparse.urlsplit(self.path).path, body)
+
+    def get(self, path: str, query: Dict[str, str]):
+        self.send_html(None)
+
+    def post(self, path: str, body):
+        self.send_json({'detail': 'Not Found'}, 404)
+
+
+class _RecipeTinEatsHandler(_Handler):
+    site = 'recipetineats'
+
+    def get(self, path, query):
+        base = self.server.base_url
+        catalogue = self.server.catalogue
+        if path == "/":
+            return self.send_html(self.server.page(path, lambda: fixtures.recipetineats_home(
+                base, catalogue.categories, seed=catalogue.seed)))
+        parts = [part for part in path.split("/") if part]
+        if len(parts) == 1 and parts[0] in catalogue.ingredients:
+            return self.send_html(self.server.page(path, lambda: fixtures.recipe_page(
+                base + path.lstrip("/"), catalogue.ingredients[parts[0]], seed=catalogue.recipe_seed(parts[0]),
+                graph=True)))
+        if len(parts) < 2 or parts[0] != "category" or not parts[1].startswith("cat-"):
+            return self.send_html(None)
+        category = int(parts[1][4:])
+        page = int(parts[3]) if len(parts) == 4 and parts[2] == "page" and parts[3].isdigit() else 1
+        if category >= catalogue.categories or page > catalogue.listing_pages(category):
+            return self.send_html(None)
+        next_page = f"{base}category/cat-{category}/page/{page + 1}/" \
+            if page < catalogue.listing_pages(category) else None
+        self.send_html(self.server.page(path, lambda: fixtures.recipetineats_listing(
+            base, catalogue.listing(category, page), next_page, seed=category * 1000 + page)))
+
+
+class _BBCGoodFoodHandler(_Handler):
+    site = 'bbcgoodfood'
+
+    def get(self, path, query):
+        catalogue = self.server.catalogue
+        parts = [part for part in path.split("/") if part]
+        if len(parts) == 2 and parts[0] == "recipes" and parts[1] in catalogue.ingredients:
+            return self.send_html(self.server.page(path, lambda: fixtures.recipe_page(
+                self.server.base_url + path.lstrip("/"), catalogue.ingredients[parts[1]],
+                seed=catalogue.recipe_seed(parts[1]), graph=False)))
+        if not path.startswith("/recipes/collection/"):
+            return self.send_html(None)
+        name = path.rstrip("/").rsplit("/", 1)[-1]
+        seed = int(hashlib.md5(name.encode()).hexdigest()[:8], 16)
+        start = seed % max(1, catalogue.recipes)
+        slugs = [catalogue.recipe_slugs[(start + i) % catalogue.recipes]
+                 for i in range(min(catalogue.list_size, catalogue.recipes))]
+        self.send_html(self.server.page(path, lambda: fixtures.bbcgoodfood_list(slugs, seed=seed)))
+
+
+class _MealieHandler(_Handler):
+    site = 'mealie'
+
+    def _page(self, items: list, query: Dict[str, str]):
+        per_page = int(query.get("perPage", 50))
+        page = int(query.get("page", 1))
+        total_pages = max(1, -(-len(items) // per_page))
+        self.send_json({'items': items[(page - 1) * per_page:page * per_page], 'page': page, 'per_page': per_page,
+                        'total': len(items), 'total_pages': total_pages})
+
+    def get(self, path, query):
+        catalogue = self.server.catalogue
+        if path == "/api/app/about":
+            return self.send_json({'version': "stand-in"})
+        if path == "/api/recipes":
+            return self._page([{'slug': slug, 'name': slug, 'dateUpdated': "2024-01-01T00:00:00"}
+                               for slug in catalogue.recipe_slugs], query)
+        if path.startswith("/api/recipes/"):
+            slug = path.rsplit("/", 1)[-1]
+            if slug not in catalogue.ingredients:
+                return self.send_json({'detail': 'Not Found'}, 404)
+            return self.send_json({'slug': slug, 'recipeIngredient': [
+                {'food': None, 'note': note, 'quantity': 0, 'unit': None} for note in catalogue.ingredients[slug]]})
+        if path == "/api/foods":
+            return self._page([{'id': i, 'name': name} for i, name in enumerate(catalogue.food_names())], query)
+        self.send_json({'detail': 'Not Found'}, 404)
+
+    def post(self, path, body):
+        if path == "/api/parser/ingredients":
+            return self.send_json([self._parse(note) for note in body.get('ingredients', [])])
+        if path == "/api/foods":
+            if not self.server.catalogue.create_food(body.get('name', "")):
+                return self.send_json({'detail': 'Food already exists'}, 409)
+            return self.send_json(body, 201)
+        self.send_json({'detail': 'Not Found'}, 404)
+
+    @staticmethod
+    def _parse(note: str) -> dict:
+        words = note.split()
+        food = next((word for word in words if word in _FOODS), None)
+        # Deterministic confidence, about a fifth of the foods fall under the builder's threshold
+        confidence = 0.7 + (int(hashlib.md5(note.encode()).hexdigest()[:4], 16) % 30) / 100
+        return {'input': note, 'confidence': {'food': confidence},
+                'ingredient': {'note': note, 'food': {'name': food} if food else None}}
+
+
+class StandInServer(ThreadingHTTPServer):
+    """One stand-in site, serving from its own port"""
+
+    daemon_threads = True
+
+    def __init__(self, handler, catalogue: Catalogue, port: int = 0, latency: float = 0, jitter: float = 0,
+                 pages: Optional[str] = None):
+        super().__init__(("127.0.0.1", port), handler)
+        self.catalogue = catalogue
+        self.latency = latency
+        self.jitter = jitter
+        self.pages = pages
+        self.base_url = f"http://127.0.0.1:{self.server_address[1]}/"
+        self._pages: Dict[str, str] = {}
+        self._counts: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def count(self, status: int):
+        with self._lock:
+            self._counts[status] = self._counts.get(status, 0) + 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {str(status): count for status, count in sorted(self._counts.items())}
+
+    def page(self, path: str, render) -> str:
+        """Rendered pages are kept so the stand-in's own CPU time doesn't dominate the benchmark"""
+        html = self._pages.get(path)
+        if html is None:
+            html = self._pages[path] = render()
+        return html
+
+    def recorded(self, path: str) -> Optional[str]:
+        if not self.pages or self.RequestHandlerClass.site not in REAL_SITES:
+            return None
+        root = os.path.join(self.pages, self.RequestHandlerClass.site)
+        for candidate in (os.path.join(root, path.strip("/"), "index.html"), os.path.join(root, path.strip("/"))):
+            if os.path.isfile(candidate):
+                with open(candidate, "r", encoding="utf-8", errors="replace") as f:
+                    return f.read().replace(REAL_SITES[self.RequestHandlerClass.site], self.base_url)
+        return None
+
+
+HANDLERS = {
+    'recipetineats': _RecipeTinEatsHandler,
+    'bbcgoodfood': _BBCGoodFoodHandler,
+    'mealie': _MealieHandler,
+}
+
+
+def start(catalogue: Catalogue, latency: float = 0, jitter: float = 0, pages: Optional[str] = None,
+          ports: Optional[Dict[str, int]] = None) -> Dict[str, StandInServer]:
+    """
+    Start every stand-in site on a background thread
+    :param catalogue: Content of the sites
+    :param latency: Seconds added to every response
+    :param jitter: Random +/- seconds around the latency
+    :param pages: Directory of recorded pages, see the module docstring
+    :param ports: Port per site, free ports are picked by default
+    :return: Server per site, see base_url and stats(), shutdown() each when done
+    """
+    servers = {}
+    for site, handler in HANDLERS.items():
+        server = StandInServer(handler, catalogue, (ports or {}).get(site, 0), latency, jitter, pages)
+        threading.Thread(target=server.serve_forever, name=f"stand-in-{site}", daemon=True).start()
+        servers[site] = server
+    return servers
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--recipes", type=int, default=1000, help="Recipes on the stand-in sites")
+    parser.add_argument("--categories", type=int, default=30, help="RecipeTin Eats categories")
+    parser.add_argument("--list-size", type=int, default=60, help="Recipes per BBC Good Food list")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random +/- seconds around the latency")
+    parser.add_argument("--pages", help="Directory of recorded pages, one sub directory per site")
+
+
+def catalogue_from_args(args) -> Catalogue:
+    return Catalogue(recipes=args.recipes, categories=args.categories, list_size=args.list_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument("--port", type=int, default=8800, help="Port of the first site, the others follow it")
+    args = parser.parse_args()
+    ports = {site: args.port + i for i, site in enumerate(HANDLERS)}
+    servers = start(catalogue_from_args(args), args.latency, args.jitter, args.pages, ports)
+    for site, server in servers.items():
+        print(f"{site:<14} {server.base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for server in servers.values():
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
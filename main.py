@@ -2,13 +2,14 @@ from dotenv import load_dotenv
 
 load_dotenv()
 import os
+import sys
 import logging
+import argparse
 
 from utils.logs import CustomFormatter
-from utils.cache import Cache
-from os import listdir
-from os.path import isfile, join
-from importlib import import_module
+from utils.metrics import PROFILE, PROFILERS
+from utils.registry import discover_scrapers
+from utils.runner import RUNNER_MAX_PARALLEL, RUNNER_TIMEOUT, run_scraper, run_scrapers, summarize
 
 LOGGING_LEVEL = os.getenv("LOGGING_LEVEL", "DEBUG")
 
@@ -22,12 +23,7 @@ logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 
 def get_list_of_scrapers():
-    scrapers_dir = "scrapers"
-    scrapers = [f"{scrapers_dir}.{f[:-3]}" for f in listdir(scrapers_dir) if
-            isfile(join(scrapers_dir, f)) and f.endswith(".py")]
-    # Filter out __init__.py
-    scrapers = [scraper for scraper in scrapers if scraper != "scrapers.__init__"]
-    return scrapers
+    return [info.module for info in discover_scrapers().values()]
 
 
 def menu_to_select_scraper(scrapers) -> list:
@@ -49,20 +45,49 @@ def menu_to_select_scraper(scrapers) -> list:
         return menu_to_select_scraper(scrapers)
 
 
-def main():
-    # Init the cache
-    c = Cache()
+def interactive():
     logging.info("Starting Scraper")
     scrapers = get_list_of_scrapers()
     scrapers = menu_to_select_scraper(scrapers)
     for scraper in scrapers:
         logging.debug(f"Starting Scraper: {scraper}")
-        module = import_module(scraper)
-        module.main()
+        run_scraper(scraper)
         logging.debug(f"Finishing Scraper: {scraper}")
     logging.debug("Finishing Scraper")
-    c.write_cache()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run scrapers. Without any arguments a menu asks which to run.")
+    parser.add_argument("scrapers", nargs="*", help="Scrapers to run by name, or 'all'")
+    parser.add_argument("--list", action="store_true", help="List the available scrapers and exit")
+    parser.add_argument("--parallel", type=int, default=RUNNER_MAX_PARALLEL, help="Scrapers run at the same time")
+    parser.add_argument("--timeout", type=float, default=RUNNER_TIMEOUT, help="Seconds before a scraper is stopped")
+    parser.add_argument("--summary", help="Write the run summary as JSON to this file")
+    parser.add_argument("--profile", choices=PROFILERS, default=PROFILE or None,
+                        help="Profile each scraper, the profile is written next to its metrics")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    available = discover_scrapers()
+    if args.list:
+        for info in available.values():
+            depends = f" (after {', '.join(info.depends_on)})" if info.depends_on else ""
+            print(f"{info.name:<24} {info.description}{depends}")
+        return 0
+    if not args.scrapers:
+        interactive()
+        return 0
+    names = list(available) if args.scrapers == ["all"] else args.scrapers
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        logging.error(f"Unknown scrapers: {', '.join(unknown)}, available: {', '.join(available)}")
+        return 2
+    runs = run_scrapers([available[name] for name in names], max_parallel=args.parallel, timeout=args.timeout,
+                        profile=args.profile)
+    return 0 if summarize(runs, args.summary) else 1
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
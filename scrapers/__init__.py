@@ -1 +1,6 @@
-from scrapers.recipetineats import main as recipetineats_main
+def __getattr__(name):
+    # Importing a scraper is expensive, only do it when something actually asks for one
+    if name == "recipetineats_main":
+        from scrapers.recipetineats import main
+        return main
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
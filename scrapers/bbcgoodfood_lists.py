@@ -1,3 +1,4 @@
+"""Recipe URLs from BBC Good Food recipe lists (or its sitemaps)"""
 import logging
 import re
 import os
@@ -5,35 +6,80 @@ import urllib.parse as urlparse
 
 import pyinputplus as pyip
 
-from utils.webpages import get_webpage, get_url_path_parts
-from utils.outputs import write_output
+from utils.webpages import extract_webpage, get_url_path_parts
+from utils.parsers import ExtractSpec
+from utils.outputs import Outputs
+from utils.crawler import Crawler
+from utils.frontier import Frontier
+from utils.sitemaps import SitemapDiscovery
+from utils.cache import TTL
+from utils.misc import env_or_prompt
+from utils.ratelimit import HostScheduler
 
-URLs = {}
+OUTPUTS = Outputs("bbcgoodfood_lists")
+FRONTIER = Frontier("bbcgoodfood_lists")
+# Curated lists are rarely edited once published
+CACHE_MAX_AGE = TTL.DAYS
+RECIPE_LINKS = ExtractSpec("h3", attrs={"id": re.compile("[0-9]+")}, select="a", attr="href")
+BASE_URL = "https://www.bbcgoodfood.com/"
+# list reads the recipes of one list page (asked for on start), sitemap reads every recipe in the site's sitemaps
+DISCOVERY = os.getenv("BBCGOODFOOD_DISCOVERY", "list")
+SITEMAP_SOURCE = "sitemap"
+# Public site, at most this many requests per second however fast it answers (HTTP_HOST_RATES overrides it)
+HOST_RATE = 10
+HostScheduler().configure_host(urlparse.urlsplit(BASE_URL).netloc, HOST_RATE)
+
+
+def resolve_recipe_urls(url, hrefs):
+    recipes = []
+    for href in hrefs:
+        recipe_url = urlparse.urljoin(url, href)
+        logging.debug(f"Found Recipe: {recipe_url}")
+        recipes.append(recipe_url)
+    return recipes
 
 
 def get_recipe_urls(url, thread_id=1):
     logging.debug(f"Thread-{thread_id}: Fetching Recipes from {url}")
-    recipes = []
-    soup = get_webpage(url)
-    titles = soup.find_all("h3", id=re.compile("[0-9]+"))
-    for title in titles:
-        a = title.find('a')
-        if a is not None:
-            recipe_url = urlparse.urljoin(url, a['href'])
-            logging.debug(f"Thread-{thread_id}: Found Recipe: {recipe_url}")
-            recipes.append(recipe_url)
-            if recipe_url not in URLs[url]:
-                URLs[url].append(recipe_url)
+    recipes = resolve_recipe_urls(url, extract_webpage(url, RECIPE_LINKS, max_age=CACHE_MAX_AGE,
+                                                       scraper=OUTPUTS.name))
+    FRONTIER.add_many(recipes, source=url)
     logging.debug(f"Thread-{thread_id}: Found {len(recipes)} recipes")
     return recipes
 
 
+def is_recipe_url(url):
+    parts = get_url_path_parts(url)
+    # /recipes/collection/... are the curated lists themselves
+    return url.startswith(BASE_URL) and len(parts) == 2 and parts[0] == "recipes"
+
+
+def discover_from_sitemaps():
+    logging.info("Reading Sitemaps")
+    discovery = SitemapDiscovery(OUTPUTS.name, BASE_URL, include=is_recipe_url)
+    new = FRONTIER.add_many(discovery.urls(), source=SITEMAP_SOURCE)
+    logging.info(f"Found {len(new)} new recipes, {len(FRONTIER)} known in total")
+    with OUTPUTS.writer("sitemap.txt", append=True) as writer:
+        # Earlier runs' recipes are already in the file, unless it has gone missing
+        writer.write_many(new if writer.append else FRONTIER.urls_from(SITEMAP_SOURCE))
+    discovery.commit()
+    FRONTIER.save()
+
+
 def main():
-    url = pyip.inputURL("Enter a BBC Good Food URL: ", limit=3)
+    if DISCOVERY == "sitemap":
+        discover_from_sitemaps()
+        return
+    url = env_or_prompt("BBCGOODFOOD_URL", lambda: pyip.inputURL("Enter a BBC Good Food URL: ", limit=3))
     logging.info(f"Fetching Recipes from {url}")
-    URLs[url] = []
-    get_recipe_urls(url)
-    write_output(f"{get_url_path_parts(url)[-1]}.txt", "\n".join(URLs[url]))
+    for list_url, result in Crawler(max_age=CACHE_MAX_AGE, name=OUTPUTS.name).crawl([url], RECIPE_LINKS).items():
+        if not result.ok:
+            logging.error(f"Failed to fetch recipes from {list_url}: {result.error!r}")
+            continue
+        FRONTIER.add_many(resolve_recipe_urls(list_url, result.value), source=list_url)
+        with OUTPUTS.writer(f"{get_url_path_parts(list_url)[-1]}.txt") as writer:
+            writer.write_many(FRONTIER.urls_from(list_url))
+    FRONTIER.save()
 
 
 if __name__ == "__main__":
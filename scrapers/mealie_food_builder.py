@@ -3,38 +3,49 @@
     from built in Ingredients Parser.
 """
 import os
+import time
 import logging
+import threading
 import tqdm
 import urllib.parse as urlparse
 import pyinputplus as pyip
 
-from typing import List
+from typing import Dict, Iterator, List, Set, Tuple
 
+from utils.archive import ARCHIVE_REPLAY
 from utils.cache import Cache, TTL
-from utils.webpages import get_authenticated_api_data, post_authenticated_api_data
-from utils.outputs import load_settings, save_settings
+from utils.webpages import get_authenticated_api_data, post_authenticated_api_data, iter_paginated_api_data
+from utils.outputs import Outputs
+from utils.misc import percentiles, env_or_prompt, is_interactive
+from utils.memo import Memo
+from utils.journal import Journal, run_journaled, PENDING, DONE
+from utils.pipeline import Pipeline, Checkpoint
+from utils.food_index import FoodIndex, FOOD_AUTO_RESOLVE_THRESHOLD, normalize_food_name
 from concurrent.futures import ThreadPoolExecutor
 
-SETTINGS = load_settings()
+OUTPUTS = Outputs("mealie_food_builder")
+CACHE = Cache().namespace("mealie_food_builder")
+SETTINGS = OUTPUTS.load_settings()
 NEEDS_CHECKING = []
+MEALIE_MAX_WORKERS = int(os.getenv("MEALIE_MAX_WORKERS", 8))
+# Cached ingredients are validated against the recipe's update timestamp, the TTL only bounds disk usage
+INGREDIENTS_TTL = TTL.DAYS * 30
+PARSER_BATCH_SIZE = int(os.getenv("MEALIE_PARSER_BATCH_SIZE", 50))
+PARSER_MAX_IN_FLIGHT = int(os.getenv("MEALIE_PARSER_MAX_IN_FLIGHT", 4))
+FOOD_CONFIDENCE = 0.85
+PARSER_NAME = "nlp"
+FOOD_WRITE_RATE = float(os.getenv("MEALIE_WRITE_RATE", 10))
+INGREDIENTS = Checkpoint(CACHE, "ingredients", INGREDIENTS_TTL)
 
 
-def get_recipe_ids():
-    recipe_ids = []
-    fetch = True
-    page = 1
-    base_url = SETTINGS['MEALIE_URL']
-    token = SETTINGS['MEALIE_API_TOKEN']
-    while fetch:
-        url = urlparse.urljoin(base_url, f"/api/recipes?perPage=25&page={page}")
-        data = get_authenticated_api_data(url, token)
-        for recipe in data['items']:
-            recipe_ids.append(recipe['slug'])
-        if data['page'] >= data['total_pages']:
-            fetch = False
-        else:
-            page += 1
-    return recipe_ids
+def iter_recipes():
+    url = urlparse.urljoin(SETTINGS['MEALIE_URL'], "/api/recipes")
+    return iter_paginated_api_data(url, SETTINGS['MEALIE_API_TOKEN'])
+
+
+def get_recipe_version(recipe) -> str:
+    """Last update timestamp of a recipe, the field name differs between Mealie versions, empty if it has none"""
+    return recipe.get('updatedAt') or recipe.get('dateUpdated') or recipe.get('updateAt') or ""
 
 
 def get_recipe_ingredients(recipe_id):
@@ -43,49 +54,141 @@ def get_recipe_ingredients(recipe_id):
     return data['recipeIngredient']
 
 
-def get_food_list_from_ingredient_parser(ingredients, thread_id=1) -> List[str]:
-    logging.debug(f"Thread-{thread_id}: Fetching Foods from Ingredients")
-    ingredient_strings = []
-    foods = []
-    for ingredient in ingredients:
-        if ingredient['food'] is None:
-            ingredient_strings.append(ingredient['note'])
+def normalize_ingredient_text(text: str) -> str:
+    """Normalized form used to dedupe ingredient notes before they are sent to the parser"""
+    return " ".join(text.lower().split()).strip(" .,;")
+
+
+def unresolved_notes(ingredients: list) -> List[str]:
+    """Notes of the ingredients Mealie has no food for, the ones the parser is asked about"""
+    return [ingredient['note'] for ingredient in ingredients if ingredient['food'] is None and ingredient.get('note')]
+
+
+class ParserStats:
+    """Counters for a parser run"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.notes = 0
+        self.unique = 0
+        self.memo_hits = 0
+        self.batches = 0
+        self.latencies = []
+
+    def add(self, notes: int = 0, unique: int = 0, memo_hits: int = 0):
+        with self.lock:
+            self.notes += notes
+            self.unique += unique
+            self.memo_hits += memo_hits
+
+    def record_batch(self, seconds: float):
+        with self.lock:
+            self.batches += 1
+            self.latencies.append(seconds)
+
+    def report(self) -> dict:
+        with self.lock:
+            return {
+                'notes': self.notes,
+                'unique': self.unique,
+                'dedup_ratio': round(1 - self.unique / self.notes, 3) if self.notes else 0.0,
+                'memo_hits': self.memo_hits,
+                'batches': self.batches,
+                'latency': {k: round(v, 3) for k, v in percentiles(self.latencies).items()}
+            }
 
+
+def get_parser_memo() -> Memo:
+    """Memo of parser results, tied to the Mealie version so an upgraded parser starts from scratch"""
+    about = get_authenticated_api_data(urlparse.urljoin(SETTINGS['MEALIE_URL'], "/api/app/about"),
+                                       SETTINGS['MEALIE_API_TOKEN'])
+    return Memo(f"mealie-parser-{PARSER_NAME}", str(about.get('version', 'unknown')))
+
+
+def summarize_parsed_ingredient(food_resp) -> dict:
+    """The parts of a parser response that are kept in the memo"""
+    if food_resp['ingredient'] is None or food_resp['ingredient']['food'] is None:
+        return {'food': None, 'confidence': None}
+    return {'food': food_resp['ingredient']['food']['name'], 'confidence': food_resp['confidence']['food']}
+
+
+def parse_ingredient_batch(ingredient_strings: List[str], stats: ParserStats = None) -> list:
     data = {
-        "parser": "nlp",
+        "parser": PARSER_NAME,
         "ingredients": ingredient_strings
     }
     url = urlparse.urljoin(SETTINGS['MEALIE_URL'], "/api/parser/ingredients")
+    start = time.perf_counter()
     resp_data = post_authenticated_api_data(url, SETTINGS['MEALIE_API_TOKEN'], data)
-    for i, food_resp in enumerate(resp_data):
-        if food_resp['ingredient'] is None or food_resp['ingredient']['food'] is None:
-            continue
-        food = food_resp['ingredient']['food']['name']
-        food_conf = food_resp['confidence']['food']
-        if food_conf and food_conf > 0.85:
-            foods.append(food)
-        else:
-            NEEDS_CHECKING.append({'food': food, 'original_text': ingredient_strings[i]})
-    logging.debug(f"Thread-{thread_id}: Found {len(foods)} foods")
-    return foods
+    if stats is not None:
+        stats.record_batch(time.perf_counter() - start)
+    return resp_data
+
+
+def confident_food(result: dict, original_text: str):
+    """The food of a parser result if the parser is confident about it, otherwise it is added to NEEDS_CHECKING"""
+    if result['food'] is None:
+        return None
+    food_conf = result['confidence']
+    if food_conf and food_conf > FOOD_CONFIDENCE:
+        return result['food']
+    NEEDS_CHECKING.append({'food': result['food'], 'original_text': original_text})
+    return None
+
+
+def parse_note_batch(batch: List[Tuple[str, str]], memo: Memo, stats: ParserStats) -> List[Tuple[str, str, dict]]:
+    """
+    Parse a batch of (normalized key, note) pairs, notes already in the memo are not sent
+    :return: (key, note, parser result) for every pair
+    """
+    parsed = memo.get_many([key for key, _ in batch])
+    stats.add(memo_hits=len(parsed))
+    todo = [(key, note) for key, note in batch if key not in parsed]
+    if todo:
+        results = parse_ingredient_batch([note for _, note in todo], stats)
+        results = {key: summarize_parsed_ingredient(resp) for (key, _), resp in zip(todo, results)}
+        memo.set_many(results)
+        parsed.update(results)
+    return [(key, note, parsed[key]) for key, note in batch]
+
+
+def build_food_pipeline(memo: Memo, stats: ParserStats) -> Pipeline:
+    """
+    Stream recipes from the listing to the parser: ingredients are fetched as soon as the first page of recipes
+    arrives and notes are parsed as soon as the first ingredients do. Fetched ingredients are checkpointed per
+    recipe version and parser results are kept in the memo, so a failed run resumes where it stopped.
+    Yields (key, note, parser result) for every distinct unresolved note.
+    """
+    seen: Set[str] = set()
+
+    def list_recipes() -> Iterator[Tuple[str, str]]:
+        return ((recipe['slug'], get_recipe_version(recipe)) for recipe in iter_recipes())
+
+    def distinct_notes(ingredients: list) -> List[Tuple[str, str]]:
+        # Single worker, so seen needs no lock
+        notes = unresolved_notes(ingredients)
+        new = []
+        for note in notes:
+            key = normalize_ingredient_text(note)
+            if key not in seen:
+                seen.add(key)
+                new.append((key, note))
+        stats.add(notes=len(notes), unique=len(new))
+        return new
+
+    pipeline = Pipeline("mealie_food_builder")
+    pipeline.source("recipes", list_recipes)
+    pipeline.stage("ingredients", lambda recipe: get_recipe_ingredients(recipe[0]), workers=MEALIE_MAX_WORKERS,
+                   checkpoint=INGREDIENTS, key=lambda recipe: recipe)
+    pipeline.stage("notes", distinct_notes, flat=True)
+    pipeline.stage("parse", lambda batch: parse_note_batch(batch, memo, stats), workers=PARSER_MAX_IN_FLIGHT,
+                   batch_size=PARSER_BATCH_SIZE, flat=True)
+    return pipeline
 
 
 def get_current_food_names():
-    fetch = True
-    page = 1
-    foods = []
-    while fetch:
-        logging.debug(f"Fetching Foods from Page {page}")
-        data = get_authenticated_api_data(urlparse.urljoin(SETTINGS['MEALIE_URL'],
-                                                           f"/api/foods?perPage=25&page={page}"),
-                                          SETTINGS['MEALIE_API_TOKEN'])
-        for food in data['items']:
-            foods.append(food['name'])
-        if data['page'] >= data['total_pages']:
-            fetch = False
-        else:
-            page += 1
-    return foods
+    url = urlparse.urljoin(SETTINGS['MEALIE_URL'], "/api/foods")
+    return [food['name'] for food in iter_paginated_api_data(url, SETTINGS['MEALIE_API_TOKEN'])]
 
 
 def create_new_food(food_name):
@@ -97,85 +200,159 @@ def create_new_food(food_name):
     return resp
 
 
-def filter_checking_foods():
+def get_food_journal() -> Journal:
+    """Journal of food creations for the configured Mealie instance"""
+    return Journal(f"mealie_foods-{urlparse.urlsplit(SETTINGS['MEALIE_URL']).netloc}")
+
+
+def is_existing_food_error(error) -> bool:
+    """Mealie rejects duplicate food names, treat that as the food having been created"""
+    resp = error.response
+    if resp is None:
+        return False
+    return resp.status_code == 409 or (resp.status_code in (400, 422, 500) and "exist" in resp.text.lower())
+
+
+def create_new_foods(foods, journal: Journal):
+    """Create foods concurrently, recording progress in the journal so an interrupted run can resume"""
+    return run_journaled(journal, foods, create_new_food, max_workers=MEALIE_MAX_WORKERS, rate=FOOD_WRITE_RATE,
+                         is_conflict=is_existing_food_error, desc="Creating Foods")
+
+
+def resolve_new_foods(foods: Dict[str, str], index: FoodIndex, review: bool = True) -> List[str]:
+    """
+    Foods that aren't in the index yet, each added to it so later spellings of the same food resolve to it.
+    Only FOOD_AUTO_RESOLVE_THRESHOLD similar foods resolve to an indexed one, a food that is merely close to one
+    (e.g. "white wine vinegar" to "white wine") is added to NEEDS_CHECKING with that match instead.
+    :param foods: Original text per food name, e.g. the parser's confident foods and their notes
+    :param index: Existing foods, the ones created by this run are added
+    :param review: False for foods a person already checked, close matches are then created too
+    :return: The foods that need creating
+    """
+    new_foods = []
+    for food in sorted(foods):
+        nearest = index.nearest(food)
+        if nearest is not None and nearest[1] >= FOOD_AUTO_RESOLVE_THRESHOLD:
+            if nearest[0] != food:
+                logging.info(f"Resolved {food} to {nearest[0]} ({nearest[1]:.2f} similar)")
+            continue
+        if nearest is not None and review:
+            NEEDS_CHECKING.append({'food': food, 'original_text': foods[food], 'match': nearest[0]})
+            continue
+        index.add(food)
+        new_foods.append(food)
+    return new_foods
+
+
+def filter_checking_foods(index: FoodIndex = None):
+    """
+    Drop repeated foods from NEEDS_CHECKING, and with an index the foods that resolve to one of its foods. Foods
+    that are only close to one stay, with the close food as their proposed match.
+    :param index: Existing and accepted foods
+    """
     new_foods = []
-    seen_text = []
-    seen_foods = []
+    seen_text = set()
+    seen_foods = set()
+    resolved = 0
     for food in NEEDS_CHECKING:
         if food['original_text'] == "":
             continue
-        if food['original_text'] in seen_text:
+        text = normalize_food_name(food['original_text'])
+        name = normalize_food_name(food['food'])
+        if text in seen_text or name in seen_foods:
             continue
-        if food['food'] in seen_foods:
+        seen_text.add(text)
+        seen_foods.add(name)
+        nearest = index.nearest(food['food']) if index is not None else None
+        if nearest is not None and nearest[1] >= FOOD_AUTO_RESOLVE_THRESHOLD:
+            logging.info(f"Resolved {food['food']} ({food['original_text']}) to {nearest[0]}")
+            resolved += 1
             continue
+        if nearest is not None:
+            food['match'] = nearest[0]
         new_foods.append(food)
-        seen_text.append(food['original_text'])
+    if resolved:
+        logging.info(f"Resolved {resolved} foods needing checking to existing foods")
 
     NEEDS_CHECKING.clear()
     NEEDS_CHECKING.extend(new_foods)
 
 
 def main():
-    cache = Cache()
+    if ARCHIVE_REPLAY:
+        # The parser is called with POSTs, which aren't archived, and the foods are created in Mealie itself
+        raise RuntimeError("mealie_food_builder can't be replayed, it works against a live Mealie instance")
+    # Only prompted values are saved, values from the environment (the token especially) never reach the disk
+    saved = {name: value for name, value in SETTINGS.items() if os.getenv(name) != value}
     token = os.getenv("MEALIE_API_TOKEN", SETTINGS.get("MEALIE_API_TOKEN"))
     if token is None:
-        token = pyip.inputStr("Enter your Mealie API Token: ")
-        SETTINGS["MEALIE_API_TOKEN"] = token
+        token = env_or_prompt("MEALIE_API_TOKEN", lambda: pyip.inputStr("Enter your Mealie API Token: "))
+        saved["MEALIE_API_TOKEN"] = token
     url = os.getenv("MEALIE_URL", SETTINGS.get("MEALIE_URL"))
     if url is None:
-        url = pyip.inputURL("Enter your Mealie URL: ")
-        SETTINGS["MEALIE_URL"] = url
-    save_settings(SETTINGS)
-    if cache.exists("recipe_ids"):
-        recipe_ids = cache.get("recipe_ids")
-    else:
-        recipe_ids = get_recipe_ids()
-        cache.set("recipe_ids", recipe_ids, TTL.MINUTES * 5)
-        cache.write_cache()
-    logging.debug(f"Found {len(recipe_ids)} recipes")
-
-    if cache.exists("ingredients"):
-        ingredients = cache.get("ingredients")
-    else:
-        ingredients = []
-        for recipe_id in tqdm.tqdm(recipe_ids, desc="Fetching Ingredients"):
-            ingredients.append(get_recipe_ingredients(recipe_id))
-        cache.set("ingredients", ingredients, TTL.MINUTES * 5)
-        cache.write_cache()
-
-    foods = []
-    with ThreadPoolExecutor() as executor:
-        for i, ingredient in enumerate(ingredients):
-            foods.extend(executor.submit(get_food_list_from_ingredient_parser, ingredient, i).result())
-    foods = list(set(foods))
+        url = env_or_prompt("MEALIE_URL", lambda: pyip.inputURL("Enter your Mealie URL: "))
+        saved["MEALIE_URL"] = url
+    OUTPUTS.save_settings(saved)
+    # Every API helper reads these from SETTINGS, for this run only when they came from the environment
+    SETTINGS["MEALIE_API_TOKEN"] = token
+    SETTINGS["MEALIE_URL"] = url
+    journal = get_food_journal()
+    pending = journal.with_state(PENDING)
+    if pending:
+        logging.info(f"Resuming {len(pending)} food creations from an interrupted run")
+        create_new_foods(pending, journal)
+
+    memo = get_parser_memo()
+    stats = ParserStats()
+    try:
+        with ThreadPoolExecutor(1) as executor:
+            # Listing the existing foods doesn't depend on the recipes, it runs alongside the pipeline
+            current_foods = executor.submit(get_current_food_names)
+            foods = {}
+            for _, note, result in tqdm.tqdm(build_food_pipeline(memo, stats).run(), desc="Parsing Ingredients"):
+                food = confident_food(result, note)
+                if food is not None:
+                    foods.setdefault(food, note)
+            current_foods = current_foods.result()
+    finally:
+        # When a stage failed the run stops here, the checkpointed ingredients let the next one resume
+        CACHE.write_cache()
+    logging.info(f"Parser stats: {stats.report()}")
     logging.info(f"Found {len(foods)} foods")
-    filter_checking_foods()
+    index = FoodIndex(current_foods)
+    index.update(journal.with_state(DONE))
+    foods = resolve_new_foods(foods, index)
+    filter_checking_foods(index)
     logging.info(f"Needs Checking: {len(NEEDS_CHECKING)}")
-    check = pyip.inputYesNo("Would you like to check the foods that need checking (y/n)? ", default="n",
-                            yesVal='y', noVal='n')
-    if check == 'y':
+    # Unattended runs leave the foods that need checking out unless MEALIE_CHECK_FOODS=y
+    check = env_or_prompt("MEALIE_CHECK_FOODS", lambda: pyip.inputYesNo(
+        "Would you like to check the foods that need checking (y/n)? ", default="n", yesVal='y', noVal='n'),
+                          "n").lower()[:1]
+    if check == 'y' and not is_interactive():
+        logging.warning("MEALIE_CHECK_FOODS=y needs a terminal to review the foods on, skipping the check")
+    elif check == 'y':
+        reviewed = {}
         for food in NEEDS_CHECKING:
             print(f"Original Text: {food['original_text']}")
             print(f"Food: {food['food']}")
+            if food.get('match'):
+                print(f"Closest Existing Food: {food['match']}")
             print()
             accept = pyip.inputYesNo("Is this correct? (y/n) ", default="n",
                                      yesVal='y', noVal='n')
             if accept == 'y':
-                foods.append(food['food'])
+                reviewed.setdefault(food['food'], food['original_text'])
             else:
-                foods.append(pyip.inputStr("Enter the correct food: "))
-
-    current_foods = get_current_food_names()
-    foods = list(set(foods) - set(current_foods))
+                reviewed.setdefault(pyip.inputStr("Enter the correct food: "), food['original_text'])
+        foods.extend(resolve_new_foods(reviewed, index, review=False))
 
     logging.info(f"Creating {len(foods)} new foods")
-    check = pyip.inputYesNo("Would you like to create these foods (y/n)? ", default="n",
-                            yesVal='y', noVal='n')
-    if check == 'n':
+    check = env_or_prompt("MEALIE_CREATE_FOODS", lambda: pyip.inputYesNo(
+        "Would you like to create these foods (y/n)? ", default="n", yesVal='y', noVal='n'), "n").lower()[:1]
+    if check != 'y':
         logging.info("Exiting")
         return
-    for food in tqdm.tqdm(foods, desc="Creating Foods"):
-        create_new_food(food)
+    create_new_foods(foods, journal)
 
     logging.info("Finished")
 
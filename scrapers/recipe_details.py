@@ -0,0 +1,210 @@
+"""Recipe details (ingredients, times, yield, nutrition) from the schema.org data of every scraped recipe URL"""
+import os
+import re
+import html
+import json
+import hashlib
+import logging
+import urllib.parse as urlparse
+
+from collections import Counter
+from typing import Any, Iterable, Iterator, List, Optional
+
+from utils.outputs import Outputs, read_records
+from utils.crawler import Crawler, CrawlResult
+from utils.cache import Cache, TTL
+from utils.ratelimit import HostScheduler
+
+DEPENDS_ON = ["recipetineats", "bbcgoodfood_lists"]
+OUTPUTS = Outputs("recipe_details")
+CACHE = Cache().namespace("recipe_details")
+# Appended to on every run, a later record of a URL replaces its earlier ones
+RECORDS_FILE = "recipes.jsonl"
+# Recipe pages are rarely edited, a day old copy is used without asking the site
+CACHE_MAX_AGE = TTL.DAYS
+HASH_TTL = TTL.DAYS * 90
+# Public sites, at most this many requests per second per host (HTTP_HOST_RATES overrides it)
+HOST_RATE = 10
+# The JSON-LD blocks are cut out of the raw page, no DOM is built
+LD_JSON = re.compile(r"<script[^>]*\btype\s*=\s*[\"']application/ld\+json[\"'][^>]*>(.*?)</script>",
+                     re.IGNORECASE | re.DOTALL)
+DURATION = re.compile(r"^P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+(?:\.\d+)?)S)?)?$", re.IGNORECASE)
+NUMBER = re.compile(r"\d+")
+
+
+def iter_recipe_urls(scrapers: Iterable[str] = DEPENDS_ON) -> Iterator[str]:
+    """Recipe URLs from the text outputs listed in the scrapers' manifests, each URL once"""
+    seen = set()
+    hosts = set()
+    for scraper in scrapers:
+        outputs = Outputs(scraper)
+        files = outputs.files()
+        if not files:
+            logging.warning(f"No outputs found for {scraper}, run it first")
+        for filename, entry in files.items():
+            if entry.get('format') != 'text':
+                continue
+            for url in read_records(os.path.join(outputs.output_dir, filename)):
+                url = url.strip()
+                if not url or url in seen:
+                    continue
+                seen.add(url)
+                host = urlparse.urlsplit(url).netloc.lower()
+                if host not in hosts:
+                    hosts.add(host)
+                    HostScheduler().configure_host(host, HOST_RATE)
+                yield url
+
+
+def iter_json_ld(page: str) -> Iterator[Any]:
+    for match in LD_JSON.finditer(page):
+        try:
+            yield json.loads(match.group(1))
+        except ValueError:
+            continue
+
+
+def find_recipe(data: Any) -> Optional[dict]:
+    """The first schema.org Recipe in JSON-LD data, looking through lists and @graph"""
+    if isinstance(data, list):
+        for item in data:
+            recipe = find_recipe(item)
+            if recipe is not None:
+                return recipe
+        return None
+    if not isinstance(data, dict):
+        return None
+    types = data.get('@type')
+    if types == "Recipe" or (isinstance(types, list) and "Recipe" in types):
+        return data
+    return find_recipe(data.get('@graph'))
+
+
+def clean_text(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        value = value.get('text') or value.get('name')
+    text = " ".join(html.unescape(str(value)).split())
+    return text or None
+
+
+def text_list(value: Any) -> List[str]:
+    """A string, a list of strings or a list of objects with a text or name as a list of cleaned strings"""
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        value = [value]
+    return [text for text in (clean_text(item) for item in value) if text]
+
+
+def instruction_list(value: Any) -> List[str]:
+    """Steps of recipeInstructions, HowToSections flattened into their steps"""
+    if isinstance(value, str):
+        return [line for line in (clean_text(line) for line in value.splitlines()) if line]
+    steps = []
+    for item in value if isinstance(value, list) else [value] if value else []:
+        if isinstance(item, dict) and 'itemListElement' in item:
+            steps.extend(instruction_list(item['itemListElement']))
+        else:
+            text = clean_text(item)
+            if text:
+                steps.append(text)
+    return steps
+
+
+def minutes(duration: Any) -> Optional[int]:
+    """Minutes of an ISO 8601 duration such as PT1H30M"""
+    match = DURATION.match(str(duration or "").strip())
+    if match is None or not any(match.groups()):
+        return None
+    days, hours, mins, seconds = (float(group or 0) for group in match.groups())
+    return round(days * 1440 + hours * 60 + mins + seconds / 60)
+
+
+def recipe_yield(value: Any) -> Optional[str]:
+    if isinstance(value, list):
+        # Sites often give both "4" and "4 servings", the longer one says more
+        value = max((clean_text(item) or "" for item in value), key=len, default=None)
+    return clean_text(value)
+
+
+def servings(yield_text: Optional[str]) -> Optional[int]:
+    match = NUMBER.search(yield_text or "")
+    return int(match.group()) if match else None
+
+
+def nutrition(value: Any) -> dict:
+    if not isinstance(value, dict):
+        return {}
+    return {key: clean_text(item) for key, item in value.items() if not key.startswith("@") and item}
+
+
+def normalize_recipe(url: str, recipe: dict) -> dict:
+    """
+    Flatten a schema.org Recipe into the record written to the output
+    :param url: Page the recipe came from
+    :param recipe: Recipe object from the page's JSON-LD
+    :return: Record, content_hash identifies the recipe data it was built from
+    """
+    yield_text = recipe_yield(recipe.get('recipeYield'))
+    return {
+        'url': url,
+        'name': clean_text(recipe.get('name')),
+        'description': clean_text(recipe.get('description')),
+        'ingredients': text_list(recipe.get('recipeIngredient')),
+        'instructions': instruction_list(recipe.get('recipeInstructions')),
+        'prep_minutes': minutes(recipe.get('prepTime')),
+        'cook_minutes': minutes(recipe.get('cookTime')),
+        'total_minutes': minutes(recipe.get('totalTime')),
+        'yield': yield_text,
+        'servings': servings(yield_text),
+        'nutrition': nutrition(recipe.get('nutrition')),
+        'category': text_list(recipe.get('recipeCategory')),
+        'cuisine': text_list(recipe.get('recipeCuisine')),
+        'content_hash': hashlib.sha1(json.dumps(recipe, sort_keys=True).encode("utf-8")).hexdigest(),
+    }
+
+
+def extract_recipe(url: str, page: str) -> Optional[dict]:
+    """Crawler extractor, the normalized record of the page's recipe or None if it has none"""
+    recipe = find_recipe(list(iter_json_ld(page)))
+    if recipe is None:
+        return None
+    return normalize_recipe(url, recipe)
+
+
+def main():
+    stats = Counter()
+    hashes = {}
+    with OUTPUTS.writer(RECORDS_FILE, append=True) as writer:
+        # The existing file already holds the recipes that haven't changed, a new one needs every recipe
+        skip_unchanged = writer.append
+
+        def record(result: CrawlResult):
+            if not result.ok:
+                stats['failed'] += 1
+                return
+            if result.value is None:
+                logging.debug(f"No recipe found at {result.url}")
+                stats['no_recipe'] += 1
+                return
+            content_hash = result.value['content_hash']
+            if skip_unchanged and CACHE.get(f"hash:{result.url}") == content_hash:
+                stats['unchanged'] += 1
+                return
+            writer.write(result.value)
+            hashes[result.url] = content_hash
+            stats['written'] += 1
+
+        Crawler(max_age=CACHE_MAX_AGE, name=OUTPUTS.name).crawl_each(iter_recipe_urls(), extract_recipe, record)
+    # Only once the records are safely in the file, a failed run must write them again
+    for url, content_hash in hashes.items():
+        CACHE.set(f"hash:{url}", content_hash, HASH_TTL)
+    CACHE.write_cache()
+    logging.info(f"Recipe details: {dict(stats)}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    main()
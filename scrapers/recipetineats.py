@@ -1,54 +1,186 @@
-import logging
+"""Recipe URLs from every RecipeTin Eats category (or its sitemaps)"""
 import os
+import re
+import time
+import logging
+import urllib.parse as urlparse
+
+from typing import Callable, Dict, List, Optional
+
 import tqdm
 
-from utils.webpages import get_webpage, get_url_path_parts
-from utils.outputs import write_output
-from concurrent.futures import ThreadPoolExecutor
+from utils.webpages import extract_webpage, get_url_path_parts
+from utils.parsers import ExtractSpec
+from utils.outputs import Outputs, read_records
+from utils.crawler import Crawler, CrawlResult, is_not_found
+from utils.frontier import Frontier
+from utils.sitemaps import SitemapDiscovery
+from utils.cache import Cache, TTL
+from utils.ratelimit import HostScheduler
+
+# Overridable to crawl a mirror or the benchmarks' stand-in server
+BASE_URL = os.getenv("RECIPETINEATS_URL", "https://www.recipetineats.com/")
+# Listing pages change when recipes are published, a few times a day at most
+CACHE_MAX_AGE = TTL.HOURS * 6
+# Listings sit in <main>, streaming stops reading the page once it closes
+RECIPE_LINKS = ExtractSpec("article", select="a.entry-title-link", attr="href", stop_after="main")
+CATEGORY_LINKS = ExtractSpec("a", attrs={"href": True}, attr="href")
+OUTPUTS = Outputs("recipetineats")
+FRONTIER = Frontier("recipetineats")
+CACHE = Cache().namespace("recipetineats")
+# Per category crawl state only matters while the frontier remembers the recipes it found
+CATEGORY_STATE_TTL = TTL.DAYS * 90
+MAX_PAGES = int(os.getenv("RECIPETINEATS_MAX_PAGES", 200))
+PAGE_NUMBER = re.compile(r"/page/(\d+)/?$")
+# categories crawls every category listing, sitemap reads the site's sitemaps instead
+DISCOVERY = os.getenv("RECIPETINEATS_DISCOVERY", "categories")
+SITEMAP_SOURCE = "sitemap"
+# Yoast splits the sitemap by type, only the post sitemaps hold recipes
+TAXONOMY_SITEMAP = re.compile(r"/(category|post_tag|tag|author|page|attachment|web-story)-sitemap\d*\.xml")
+# Public site, at most this many requests per second however fast it answers (HTTP_HOST_RATES overrides it)
+HOST_RATE = 10
+HostScheduler().configure_host(urlparse.urlsplit(BASE_URL).netloc, HOST_RATE)
+
+
+def page_url(category, page):
+    return category if page == 1 else urlparse.urljoin(category, f"page/{page}/")
+
+
+def split_page_url(url):
+    """Split a listing URL into its category URL and page number"""
+    match = PAGE_NUMBER.search(url)
+    if match is None:
+        return url, 1
+    return url[:match.start()] + "/", int(match.group(1))
+
+
+def listing_follower(states: Dict[str, dict]) -> Callable[[str, List[str]], Optional[str]]:
+    """
+    Decide after each listing page whether to read the next one. A category is walked until a page comes back empty
+    or missing, or, once it has been walked to the end before, until a page only lists recipes earlier runs found.
+    :param states: Crawl state per category from the last run
+    :return: Follow callback for Crawler.crawl_chains
+    """
+    def follow(url, recipes):
+        category, page = split_page_url(url)
+        if len(recipes) == 0:
+            return None
+        if states.get(category, {}).get('complete') and all(FRONTIER.is_known(recipe) for recipe in recipes):
+            logging.debug(f"Caught up with {category} at page {page}")
+            return None
+        if page >= MAX_PAGES:
+            logging.warning(f"Stopping {category} at RECIPETINEATS_MAX_PAGES ({MAX_PAGES})")
+            return None
+        return page_url(category, page + 1)
+    return follow
+
+
+def record_category(category, chain: List[CrawlResult]) -> int:
+    """
+    Add the recipes of a crawled category to the frontier and store how far the crawl got
+    :return: Number of recipes no earlier run had found
+    """
+    new = 0
+    for result in chain:
+        if result.ok:
+            new += len(FRONTIER.add_many(result.value, source=category))
+    last = chain[-1]
+    if not last.ok and not is_not_found(last.error):
+        logging.error(f"Failed to fetch recipes from {last.url}: {last.error!r}")
+    elif chain[0].ok and len(chain[0].value) == 0:
+        logging.warning(f"No recipes found at {category}")
+    pages = sum(1 for result in chain if result.ok)
+    # A chain that ended early on an error has unread pages, it must be walked to the end again next run
+    complete = last.ok or is_not_found(last.error)
+    CACHE.set(f"category:{category}", {'pages': pages, 'complete': complete, 'new': new, 'crawled_at': time.time()},
+              CATEGORY_STATE_TTL)
+    logging.debug(f"Read {pages} pages of {category}, {new} new recipes")
+    return new
 
-BASE_URL = "https://www.recipetineats.com/"
-URLs = {}
+
+def category_filename(category) -> str:
+    return f"{get_url_path_parts(category)[-1]}.txt"
+
+
+def has_output(category, files) -> bool:
+    """True if the category's output file is listed in the manifest, whatever its compression"""
+    filename = category_filename(category)
+    return any(name == filename or name.startswith(filename + ".") for name in files)
+
+
+def write_category(category, recipes: List[str]) -> int:
+    """
+    Add a category's recipes to its output file. The file is appended to, never rebuilt from the frontier: a caught
+    up crawl only re-reads the first pages of a category and a Bloom filter frontier doesn't remember which
+    recipes earlier runs found in it.
+    :return: Number of recipes the file didn't hold yet
+    """
+    with OUTPUTS.writer(category_filename(category), append=True) as writer:
+        written = set(read_records(writer.path)) if writer.append else set()
+        return writer.write_many(recipe for recipe in recipes if recipe not in written)
 
 
 def get_recipe_urls(url, thread_id=1):
     logging.debug(f"Thread-{thread_id}: Fetching Recipes from {url}")
-    recipes = []
-    soup = get_webpage(url)
-    articles = soup.find_all('article')
-    for article in articles:
-        a = article.find('a', class_='entry-title-link')
-        if a is not None:
-            recipe_url = a['href']
-            recipes.append(recipe_url)
-            if recipe_url not in URLs[url]:
-                URLs[url].append(recipe_url)
-    if len(articles) == 0:
-        logging.warning(f"Thread-{thread_id}: No recipes found at {url}")
-        return []
+    recipes = extract_webpage(url, RECIPE_LINKS, max_age=CACHE_MAX_AGE, scraper=OUTPUTS.name)
+    FRONTIER.add_many(recipes, source=url)
     logging.debug(f"Thread-{thread_id}: Found {len(recipes)} recipes")
     return recipes
 
 
 def get_categories(url):
-    soup = get_webpage(url)
-    return [a['href'] for a in soup.select('a') if a.has_attr('href') and
-            a['href'].startswith('https://www.recipetineats.com/') and "category" in get_url_path_parts(a['href'])]
+    links = extract_webpage(url, CATEGORY_LINKS, max_age=CACHE_MAX_AGE, scraper=OUTPUTS.name)
+    # Listing pages are addressed as <category>/page/N/, so keep every category URL in its trailing slash form
+    return list(dict.fromkeys(href if href.endswith("/") else href + "/" for href in links if
+                              href.startswith(BASE_URL) and
+                              "category" in get_url_path_parts(href)))
 
 
-def main():
+def is_recipe_url(url):
+    # Recipes are posts, which live directly under the site root
+    return url.startswith(BASE_URL) and len(get_url_path_parts(url)) == 1
+
+
+def crawl_categories():
     logging.info("Fetching Categories")
-    for url in get_categories(BASE_URL):
-        URLs[url] = []
-    logging.info(f"Found {len(URLs)} categories")
+    categories = get_categories(BASE_URL)
+    logging.info(f"Found {len(categories)} categories")
     logging.info("Fetching Recipes")
-    with ThreadPoolExecutor(os.cpu_count()) as executor:
-        for i, url in enumerate(URLs):
-            executor.submit(get_recipe_urls, url, i)
+    # A category whose output has gone missing is walked to the end again, its earlier recipes are only in the file
+    files = OUTPUTS.files()
+    states = {category: (CACHE.get(f"category:{category}") or {}) if has_output(category, files) else {}
+              for category in categories}
+    chains = Crawler(max_age=CACHE_MAX_AGE, name=OUTPUTS.name).crawl_chains(categories, RECIPE_LINKS,
+                                                                             listing_follower(states))
+    for category, chain in chains.items():
+        record_category(category, chain)
+    CACHE.write_cache()
+    logging.info(f"Found {len(FRONTIER)} unique recipes, {FRONTIER.new_count} new since the last run")
+
+    for url in tqdm.tqdm(categories, desc="Writing Outputs"):
+        recipes = FRONTIER.urls_from(url)
+        if len(recipes) > 0:
+            write_category(url, recipes)
 
-    for url in tqdm.tqdm(URLs, desc="Writing Outputs"):
-        if len(URLs[url]) > 0:
-            write_output(f"{get_url_path_parts(url)[-1]}.txt", "\n".join(URLs[url]))
 
+def discover_from_sitemaps():
+    logging.info("Reading Sitemaps")
+    discovery = SitemapDiscovery(OUTPUTS.name, BASE_URL, include=is_recipe_url,
+                                 include_sitemap=lambda url: not TAXONOMY_SITEMAP.search(url))
+    new = FRONTIER.add_many(discovery.urls(), source=SITEMAP_SOURCE)
+    logging.info(f"Found {len(new)} new recipes, {len(FRONTIER)} known in total")
+    with OUTPUTS.writer("sitemap.txt", append=True) as writer:
+        # Earlier runs' recipes are already in the file, unless it has gone missing
+        writer.write_many(new if writer.append else FRONTIER.urls_from(SITEMAP_SOURCE))
+    discovery.commit()
+
+
+def main():
+    if DISCOVERY == "sitemap":
+        discover_from_sitemaps()
+    else:
+        crawl_categories()
+    FRONTIER.save()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,14 @@
+"""
+ The caches, journals, frontiers and outputs all live under the working directory, the tests run in a temporary one
+ so they never touch the state of real runs
+"""
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_WORKDIR = tempfile.mkdtemp(prefix="scraper-tests-")
+os.chdir(_WORKDIR)
+atexit.register(shutil.rmtree, _WORKDIR, ignore_errors=True)
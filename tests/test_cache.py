@@ -0,0 +1,169 @@
+"""The SQLite cache backend, the expiry index, and the Cache and namespace handles in front of them"""
+import os
+import time
+import uuid
+import threading
+
+from utils.cache import Cache, ExpiryIndex, MemoryBackend, SQLiteBackend
+
+
+def fresh_key() -> str:
+    return f"test-{uuid.uuid4().hex}"
+
+
+def test_sqlite_values_survive_a_new_connection(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    backend = SQLiteBackend(path)
+    backend.save("k", '{"a": 1}', time.time() + 60)
+    backend.flush()
+    assert SQLiteBackend(path).load("k")[0] == '{"a": 1}'
+
+
+def test_sqlite_expired_rows_are_not_loaded(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "cache.sqlite"))
+    now = time.time()
+    backend.save("old", "1", now - 1)
+    backend.save("new", "2", now + 60)
+    assert backend.load("old") is None
+    assert [key for key, _, _ in backend.items()] == ["new"]
+    assert backend.delete_expired(now) == 1
+
+
+def test_sqlite_eviction_drops_least_recently_used(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "cache.sqlite"), max_bytes=100)
+    expires = time.time() + 60
+    for n in range(10):
+        backend.save(f"k{n}", "x" * 20, expires)
+    backend.load("k0")
+    assert backend.evict() == 5
+    remaining = {key for key, _, _ in backend.items()}
+    assert "k0" in remaining and len(remaining) == 5
+
+
+def test_sqlite_prefixes(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "cache.sqlite"))
+    expires = time.time() + 60
+    for key in ("a-1", "a-2", "ab-1", "b_%-1"):
+        backend.save(key, "1", expires)
+    backend.delete_prefix("a-")
+    assert sorted(key for key, _, _ in backend.items()) == ["ab-1", "b_%-1"]
+    # LIKE wildcards in a prefix are matched literally
+    assert [key for key, _, _ in backend.items("b_%")] == ["b_%-1"]
+    assert list(backend.items("b__")) == []
+
+
+def test_sqlite_threads_share_the_file(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "cache.sqlite"))
+    expires = time.time() + 60
+
+    def fill(thread_id):
+        for n in range(200):
+            backend.save(f"{thread_id}-{n}", str(n), expires)
+
+    threads = [threading.Thread(target=fill, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(list(backend.items())) == 1600
+
+
+def test_cache_reads_values_back_from_the_backend():
+    cache = Cache()
+    key = fresh_key()
+    cache._set(key, {'recipes': ["/a", "/b"]}, 60)
+    # Dropped from memory, loaded again from SQLite
+    cache._stripe(key).forget(key)
+    assert cache._load(key)[0] == {'recipes': ["/a", "/b"]}
+    assert os.path.exists(cache.backend.path)
+    cache._remove(key)
+    assert cache._load(key) is None
+
+
+def test_expiry_index_pops_only_expired_keys_in_order():
+    index = ExpiryIndex()
+    for expires, key in [(30.0, "c"), (10.0, "a"), (50.0, "e"), (20.0, "b")]:
+        index.push(key, expires)
+    assert index.pop_expired(25.0) == [(10.0, "a"), (20.0, "b")]
+    assert index.pop_expired(25.0) == []
+    assert index.pop_expired(100.0) == [(30.0, "c"), (50.0, "e")]
+    assert index.pop_expired(100.0) == []
+
+
+def test_expiry_index_hands_out_one_compaction_at_a_time():
+    index = ExpiryIndex()
+    # Overwriting the same keys leaves stale entries behind
+    due = [index.push(f"k{n % 10}", float(n)) for n in range(2000)]
+    assert due.count(True) == 1
+    index.compact({f"k{n}": 1990.0 + n for n in range(10)})
+    assert len(index.heap) == 10
+    assert index.compact_at == 2 * 10 + 1024
+
+
+def test_stale_expiries_never_delete_a_live_value():
+    backend = MemoryBackend()
+    now = time.time()
+    backend.save("k", "old", now - 10)
+    backend.save("k", "new", now + 60)
+    assert backend.delete_expired(now) == 0
+    assert backend.load("k")[0] == "new"
+    backend.save("gone", "1", now - 1)
+    assert backend.delete_expired(now) == 1
+    assert backend.load("gone") is None
+
+
+def test_cache_expires_keys_from_memory():
+    cache = Cache()
+    expired, live = fresh_key(), fresh_key()
+    cache._set(expired, 1, -1)
+    cache._set(live, 2, 60)
+    assert cache._load(expired) is None
+    assert expired not in cache._stripe(expired).entries
+    assert cache._load(live)[0] == 2
+
+
+def test_cache_expiry_heap_stays_bounded_under_overwrites():
+    cache = Cache()
+    key = fresh_key()
+    for n in range(5000):
+        cache._set(key, n, 60)
+    live = sum(len(stripe.entries) for stripe in cache.stripes)
+    assert len(cache.expiry.heap) <= 2 * live + 1024 + 1
+    assert cache._load(key)[0] == 4999
+
+
+def test_namespace_round_trip():
+    namespace = Cache().namespace(fresh_key())
+    namespace.set("k", [1, 2], 60)
+    assert namespace.exists("k")
+    assert namespace.get("k") == [1, 2]
+    namespace.remove("k")
+    assert not namespace.exists("k")
+    assert namespace.get("k") is None
+
+
+def test_namespace_get_all_keeps_hyphenated_keys():
+    namespace = Cache().namespace(fresh_key())
+    keys = ["main-dishes", "category:https://www.recipetineats.com/category/one-pot-meals/", "-", "a--b"]
+    for n, key in enumerate(keys):
+        namespace.set(key, n, 60)
+    assert namespace.get_all() == {key: n for n, key in enumerate(keys)}
+
+
+def test_namespace_clear_leaves_other_namespaces():
+    name = uuid.uuid4().hex
+    first, second = Cache().namespace(name), Cache().namespace(name[::-1])
+    first.set("k", 1, 60)
+    second.set("k", 2, 60)
+    first.clear()
+    assert first.get("k") is None and first.get_all() == {}
+    assert second.get("k") == 2
+
+
+def test_module_level_calls_use_the_calling_module_as_namespace():
+    key = fresh_key()
+    Cache().set(key, "value", 60)
+    assert Cache().namespace("test_cache").get(key) == "value"
+    assert Cache().get(key) == "value"
+    Cache().remove(key)
+    assert not Cache().exists(key)
@@ -0,0 +1,80 @@
+"""Parsed foods only resolve to existing ones when they are the same food, close matches are left for checking"""
+import pytest
+
+from scrapers import mealie_food_builder
+from scrapers.mealie_food_builder import filter_checking_foods, resolve_new_foods
+from utils.food_index import FoodIndex, normalize_food_name
+
+FALSE_POSITIVES = [("white wine vinegar", "white wine"), ("olive", "olive oil")]
+
+
+@pytest.fixture(autouse=True)
+def needs_checking(monkeypatch):
+    checking = []
+    monkeypatch.setattr(mealie_food_builder, "NEEDS_CHECKING", checking)
+    return checking
+
+
+def test_normalize_food_name():
+    assert normalize_food_name("Tomatoes, chopped") == "tomato chopped"
+    assert normalize_food_name("  Cherry   TOMATOES ") == normalize_food_name("cherry tomato")
+    assert normalize_food_name("Swiss cheese") == "swiss cheese"
+
+
+@pytest.mark.parametrize("food, existing", FALSE_POSITIVES)
+def test_close_foods_are_proposed_not_matched(food, existing):
+    index = FoodIndex([existing])
+    assert index.nearest(food)[0] == existing
+    assert index.match(food) is None
+
+
+def test_spelling_variants_are_matched():
+    index = FoodIndex(["tomato", "Spring Onion"])
+    assert index.match("Tomatoes") == "tomato"
+    assert index.match("spring onions") == "Spring Onion"
+    assert "TOMATOES" in index
+
+
+@pytest.mark.parametrize("food, existing", FALSE_POSITIVES)
+def test_resolve_leaves_close_foods_for_checking(needs_checking, food, existing):
+    assert resolve_new_foods({food: f"1 cup {food}"}, FoodIndex([existing])) == []
+    assert needs_checking == [{'food': food, 'original_text': f"1 cup {food}", 'match': existing}]
+
+
+def test_resolve_skips_existing_foods(needs_checking):
+    index = FoodIndex(["tomato"])
+    assert resolve_new_foods({"tomatoes": "2 tomatoes", "basil": "basil leaves"}, index) == ["basil"]
+    assert "basil" in index
+    assert needs_checking == []
+
+
+def test_resolve_does_not_chain_new_foods(needs_checking):
+    # "white wine" is created first, it mustn't swallow "white wine vinegar" created by the same run
+    foods = {"white wine": "1/2 cup white wine", "white wine vinegar": "1 tbsp white wine vinegar"}
+    assert resolve_new_foods(foods, FoodIndex()) == ["white wine"]
+    assert [food['food'] for food in needs_checking] == ["white wine vinegar"]
+    assert needs_checking[0]['match'] == "white wine"
+
+
+def test_resolve_reviewed_foods_creates_close_foods(needs_checking):
+    index = FoodIndex(["white wine"])
+    assert resolve_new_foods({"white wine vinegar": "vinegar", "white wines": "wine"}, index,
+                             review=False) == ["white wine vinegar"]
+    assert needs_checking == []
+
+
+def test_filter_keeps_close_foods_for_checking(needs_checking):
+    needs_checking.extend([
+        {'food': "olive", 'original_text': "a few olives"},
+        {'food': "Tomatoes", 'original_text': "2 ripe tomatoes"},
+        {'food': "olive", 'original_text': "A few olives"},
+        {'food': "basil", 'original_text': ""},
+    ])
+    filter_checking_foods(FoodIndex(["olive oil", "tomato"]))
+    assert needs_checking == [{'food': "olive", 'original_text': "a few olives", 'match': "olive oil"}]
+
+
+def test_filter_without_index_only_dedupes(needs_checking):
+    needs_checking.extend([{'food': "olive", 'original_text': "olives"}, {'food': "olive", 'original_text': "olive"}])
+    filter_checking_foods()
+    assert needs_checking == [{'food': "olive", 'original_text': "olives"}]
@@ -0,0 +1,93 @@
+"""URL canonicalization, the Frontier remembering earlier runs, and its Bloom filter mode"""
+import threading
+
+import pytest
+
+from utils.frontier import BloomFilter, Frontier, canonical_url
+
+
+@pytest.mark.parametrize("url, canonical", [
+    ("HTTPS://WWW.RecipeTinEats.com:443/chicken-soup/#comments", "https://www.recipetineats.com/chicken-soup/"),
+    ("http://example.com", "http://example.com/"),
+    ("http://example.com:8080/a", "http://example.com:8080/a"),
+    ("https://example.com/a?b=2&a=1", "https://example.com/a?a=1&b=2"),
+    ("https://example.com/a?utm_source=x&page=2&fbclid=y&UTM_Medium=z", "https://example.com/a?page=2"),
+    ("https://example.com/a?utm_source=x", "https://example.com/a"),
+    ("  https://example.com/a?q=  ", "https://example.com/a?q="),
+])
+def test_canonical_url(url, canonical):
+    assert canonical_url(url) == canonical
+
+
+def test_spellings_of_a_url_are_added_once(tmp_path):
+    frontier = Frontier("test", directory=str(tmp_path))
+    assert frontier.add_many(["https://example.com/a", "https://EXAMPLE.com/a#x", "https://example.com/b"],
+                             source="page-1") == ["https://example.com/a", "https://example.com/b"]
+    assert frontier.add_many(["https://example.com/b?utm_source=feed", "https://example.com/c"],
+                             source="page-2") == ["https://example.com/c"]
+    assert len(frontier) == 3
+    assert frontier.urls_from("page-2") == ["https://example.com/b", "https://example.com/c"]
+    assert frontier.sources_of("https://example.com/b") == ["page-1", "page-2"]
+    assert frontier.urls_from("missing") == []
+    assert "https://example.com/c#top" in frontier
+
+
+def test_saved_urls_are_known_to_the_next_run(tmp_path):
+    frontier = Frontier("test", directory=str(tmp_path))
+    frontier.add_many(["https://example.com/a", "https://example.com/b"], source="page-1")
+    frontier.save()
+
+    resumed = Frontier("test", directory=str(tmp_path))
+    assert resumed.is_known("https://example.com/a")
+    assert resumed.urls_from("page-1") == ["https://example.com/a", "https://example.com/b"]
+    assert resumed.add_many(["https://example.com/b", "https://example.com/c"], source="page-2") == \
+        ["https://example.com/c"]
+    assert not resumed.is_known("https://example.com/c")
+    assert resumed.new_count == 1
+    assert resumed.sources_of("https://example.com/b") == ["page-1", "page-2"]
+
+
+def test_threads_adding_the_same_urls(tmp_path):
+    frontier = Frontier("test", directory=str(tmp_path))
+    new = []
+
+    def add(thread_id):
+        new.extend(frontier.add_many([f"https://example.com/{n}" for n in range(500)], source=f"t{thread_id}"))
+
+    threads = [threading.Thread(target=add, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(frontier) == 500
+    assert sorted(new) == sorted(f"https://example.com/{n}" for n in range(500))
+    assert all(len(frontier.urls_from(f"t{i}")) == 500 for i in range(8))
+
+
+def test_bloom_filter_has_no_false_negatives_and_few_false_positives(tmp_path):
+    bloom = BloomFilter(10000, 0.001)
+    for n in range(10000):
+        bloom.add(f"https://example.com/recipe-{n}")
+    path = str(tmp_path / "test.bloom")
+    bloom.save(path)
+    loaded = BloomFilter.load(path)
+    assert (loaded.size, loaded.hashes) == (bloom.size, bloom.hashes)
+    assert all(f"https://example.com/recipe-{n}" in loaded for n in range(10000))
+    false_positives = sum(f"https://example.com/other-{n}" in loaded for n in range(20000))
+    # 0.1% expected, 20 in 20000
+    assert false_positives < 60
+
+
+def test_bloom_frontier_remembers_earlier_runs(tmp_path):
+    frontier = Frontier("test", bloom_capacity=1000, directory=str(tmp_path))
+    frontier.add_many([f"https://example.com/{n}" for n in range(100)], source="page-1")
+    frontier.save()
+
+    resumed = Frontier("test", bloom_capacity=1000, directory=str(tmp_path))
+    # Earlier URLs aren't loaded back, only recognised
+    assert len(resumed) == 0
+    assert resumed.is_known("https://example.com/5#x")
+    assert "https://example.com/5" in resumed
+    resumed.add_many(["https://example.com/5", "https://example.com/new"], source="page-1")
+    assert resumed.new_count == 1
+    assert not resumed.is_known("https://example.com/new")
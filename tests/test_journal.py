@@ -0,0 +1,91 @@
+"""Journal resume after a crash, and how run_journaled retries or fails each write"""
+import uuid
+
+import pytest
+import requests
+
+from utils import journal as journal_module
+from utils.journal import DONE, FAILED, PENDING, Journal, run_journaled
+
+
+@pytest.fixture
+def journal():
+    journal = Journal(f"test-{uuid.uuid4().hex}")
+    yield journal
+    journal.close()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(journal_module, "jittered_backoff", lambda attempt, base: 0)
+
+
+def http_error(status: int, text: str = "") -> requests.HTTPError:
+    response = requests.Response()
+    response.status_code = status
+    response._content = text.encode()
+    return requests.HTTPError(f"{status} error", response=response)
+
+
+class FlakyWriter:
+    """Raises the errors queued for a key, one per call, then succeeds"""
+
+    def __init__(self, errors):
+        self.errors = {key: list(queued) for key, queued in errors.items()}
+        self.calls = {}
+
+    def __call__(self, key):
+        self.calls[key] = self.calls.get(key, 0) + 1
+        if self.errors.get(key):
+            raise self.errors[key].pop(0)
+
+
+def test_resume_after_a_crash(journal):
+    assert journal.begin(["a", "b", "c"]) == ["a", "b", "c"]
+    journal.mark("a", DONE)
+    # A crash while writing the next record leaves half a line behind
+    journal.file.write('{"key": "b", "sta')
+    journal.file.flush()
+
+    resumed = Journal(journal.name)
+    try:
+        assert resumed.with_state(DONE) == ["a"]
+        assert sorted(resumed.with_state(PENDING)) == ["b", "c"]
+        assert resumed.begin(["a", "b", "c", "d"]) == ["b", "c", "d"]
+    finally:
+        resumed.close()
+
+
+def test_run_journaled_resumes_pending_keys(journal):
+    journal.begin(["a", "b"])
+    journal.mark("a", DONE)
+    writer = FlakyWriter({})
+    assert run_journaled(journal, journal.with_state(PENDING) + ["c"], writer) == {"b": DONE, "c": DONE}
+    assert sorted(writer.calls) == ["b", "c"]
+    # Everything is done, the journal is compacted to one line per key
+    with open(journal.path) as f:
+        assert len(f.readlines()) == 3
+
+
+def test_connection_errors_are_retried(journal):
+    writer = FlakyWriter({"a": [requests.ConnectionError("reset"), requests.ReadTimeout("slow")],
+                          "b": [requests.ConnectionError("reset")] * 10})
+    results = run_journaled(journal, ["a", "b", "c"], writer, max_attempts=3)
+    assert results == {"a": DONE, "b": FAILED, "c": DONE}
+    assert writer.calls == {"a": 3, "b": 3, "c": 1}
+    assert journal.with_state(FAILED) == ["b"]
+
+
+def test_errors_the_client_already_retried_are_not_retried_again(journal):
+    writer = FlakyWriter({"throttled": [http_error(429)], "broken": [http_error(500)],
+                          "unreachable": [requests.ConnectTimeout("no route")]})
+    results = run_journaled(journal, ["throttled", "broken", "unreachable"], writer)
+    assert results == {"throttled": FAILED, "broken": FAILED, "unreachable": FAILED}
+    assert writer.calls == {"throttled": 1, "broken": 1, "unreachable": 1}
+
+
+def test_conflicts_count_as_done(journal):
+    writer = FlakyWriter({"a": [http_error(409)], "b": [http_error(400, "Food already exists")]})
+    results = run_journaled(journal, ["a", "b"], writer,
+                            is_conflict=lambda e: e.response.status_code == 409 or "exist" in e.response.text)
+    assert results == {"a": DONE, "b": DONE}
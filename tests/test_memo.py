@@ -0,0 +1,54 @@
+"""Memo versioning, eviction and export/import between installs"""
+import pytest
+
+from utils.memo import Memo, stored_version
+
+
+@pytest.fixture
+def path(tmp_path) -> str:
+    return str(tmp_path / "memo.sqlite")
+
+
+def test_entries_survive_reopening_at_the_same_version(path):
+    Memo("parser", "1.0", path).set_many({"2 eggs": {'food': "egg"}, "salt": {'food': "salt"}})
+    memo = Memo("parser", "1.0", path)
+    assert memo.get_many(["2 eggs", "salt", "pepper"]) == {"2 eggs": {'food': "egg"}, "salt": {'food': "salt"}}
+    assert stored_version("parser", path) == "1.0"
+
+
+def test_a_new_version_drops_the_old_entries(path):
+    Memo("parser", "1.0", path).set("2 eggs", {'food': "egg"})
+    Memo("other", "1.0", path).set("2 eggs", {'food': "eggs"})
+    memo = Memo("parser", "2.0", path)
+    assert len(memo) == 0
+    assert memo.get("2 eggs") is None
+    assert stored_version("parser", path) == "2.0"
+    # Only the memo whose version changed is dropped
+    assert Memo("other", "1.0", path).get("2 eggs") == {'food': "eggs"}
+
+
+def test_eviction_drops_least_recently_used(path):
+    memo = Memo("parser", "1.0", path, max_entries=3)
+    for n in range(5):
+        memo.set(f"note {n}", n)
+    memo.get("note 0")
+    assert memo.evict() == 2
+    assert sorted(memo.get_many(f"note {n}" for n in range(5))) == ["note 0", "note 3", "note 4"]
+
+
+def test_export_import_only_into_the_same_version(path, tmp_path):
+    exported = str(tmp_path / "memo.jsonl")
+    memo = Memo("parser", "1.0", path)
+    memo.set_many({f"note {n}": n for n in range(1500)})
+    assert memo.export(exported) == 1500
+
+    other_path = str(tmp_path / "other.sqlite")
+    assert Memo("parser", "1.0", other_path).import_file(exported) == 1500
+    assert Memo("parser", "1.0", other_path).get("note 1499") == 1499
+    assert Memo("parser", "2.0", str(tmp_path / "newer.sqlite")).import_file(exported) == 0
+
+
+def test_stored_version_of_a_missing_memo(path):
+    assert stored_version("parser", path) is None
+    Memo("other", "1.0", path)
+    assert stored_version("parser", path) is None
@@ -0,0 +1,99 @@
+"""OutputWriter's atomic and append modes, the manifest, and write_category appending without duplicates"""
+import os
+import uuid
+
+import pytest
+
+from scrapers import recipetineats
+from utils import outputs as outputs_module
+from utils.outputs import Outputs, read_records
+
+COMPRESSIONS = ['none', 'gzip'] + (['zstd'] if outputs_module.zstandard is not None else [])
+
+
+@pytest.fixture
+def outputs() -> Outputs:
+    return Outputs(f"test-{uuid.uuid4().hex}")
+
+
+def leftovers(outputs: Outputs):
+    return [name for name in os.listdir(outputs.output_dir) if name.endswith(".tmp")]
+
+
+@pytest.mark.parametrize("data", ["a\nb", "a\nb\n", "one line"])
+def test_write_output_writes_the_data_as_it_is(outputs, data):
+    outputs.write_output("list.txt", data)
+    with open(os.path.join(outputs.output_dir, "list.txt"), "rb") as f:
+        assert f.read() == data.encode()
+    assert outputs.files()["list.txt"]['records'] == len(data.splitlines())
+
+
+def test_failed_writer_leaves_the_old_file(outputs):
+    with outputs.writer("list.txt") as writer:
+        writer.write_many(["a", "b"])
+    with pytest.raises(RuntimeError):
+        with outputs.writer("list.txt") as writer:
+            writer.write("c")
+            raise RuntimeError("scraper crashed")
+    assert list(read_records(writer.path)) == ["a", "b"]
+    assert outputs.files()["list.txt"]['records'] == 2
+    assert leftovers(outputs) == []
+
+
+@pytest.mark.parametrize("compression", COMPRESSIONS)
+def test_append_adds_to_the_file_in_place(outputs, compression):
+    with outputs.writer("list.txt", compression=compression) as writer:
+        writer.write_many(["a", "b"])
+    inode = os.stat(writer.path).st_ino
+    with outputs.writer("list.txt", compression=compression, append=True) as writer:
+        assert writer.append
+        writer.write_many(["c"])
+    with outputs.writer("list.txt", compression=compression, append=True):
+        pass
+    assert list(read_records(writer.path)) == ["a", "b", "c"]
+    # Appending never copies the file
+    assert os.stat(writer.path).st_ino == inode
+    assert outputs.files()[writer.filename]['records'] == 3
+    assert leftovers(outputs) == []
+
+
+@pytest.mark.parametrize("compression", COMPRESSIONS)
+def test_failed_append_is_truncated_away(outputs, compression):
+    with outputs.writer("list.txt", compression=compression) as writer:
+        writer.write_many(["a", "b"])
+    size = os.path.getsize(writer.path)
+    with pytest.raises(RuntimeError):
+        with outputs.writer("list.txt", compression=compression, append=True) as writer:
+            writer.write_many(f"line {n}" for n in range(10000))
+            raise RuntimeError("scraper crashed")
+    assert os.path.getsize(writer.path) == size
+    assert list(read_records(writer.path)) == ["a", "b"]
+
+
+def test_append_to_a_missing_file_creates_it(outputs):
+    with outputs.writer("list.txt", append=True) as writer:
+        assert not writer.append
+        writer.write("a")
+    assert list(read_records(writer.path)) == ["a"]
+
+
+def test_csv_append_keeps_one_header(outputs):
+    with outputs.writer("recipes.csv") as writer:
+        writer.write({'name': "Soup", 'minutes': 20})
+    with outputs.writer("recipes.csv", append=True) as writer:
+        writer.write({'name': "Stew", 'minutes': 90})
+    assert list(read_records(writer.path)) == [{'name': "Soup", 'minutes': "20"}, {'name': "Stew", 'minutes': "90"}]
+
+
+@pytest.mark.parametrize("compression", COMPRESSIONS)
+def test_write_category_appends_new_recipes_only(monkeypatch, outputs, compression):
+    monkeypatch.setattr(recipetineats, "OUTPUTS", outputs)
+    monkeypatch.setattr(outputs_module, "OUTPUT_COMPRESSION", compression)
+    category = "https://www.recipetineats.com/category/main-dishes/"
+    assert recipetineats.write_category(category, ["/a", "/b"]) == 2
+    assert recipetineats.write_category(category, ["/b", "/c", "/a"]) == 1
+    assert recipetineats.write_category(category, ["/c"]) == 0
+    assert recipetineats.has_output(category, outputs.files())
+    filename = recipetineats.category_filename(category)
+    path = os.path.join(outputs.output_dir, filename + {'gzip': ".gz", 'zstd': ".zst"}.get(compression, ""))
+    assert list(read_records(path)) == ["/a", "/b", "/c"]
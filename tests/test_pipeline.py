@@ -0,0 +1,98 @@
+"""Pipeline runs, failed items failing the run and Checkpoint resuming an interrupted one"""
+import uuid
+
+import pytest
+
+from utils.cache import Cache
+from utils.pipeline import Checkpoint, Pipeline, PipelineError
+
+
+def fresh_checkpoint() -> Checkpoint:
+    return Checkpoint(Cache().namespace(f"test-{uuid.uuid4().hex}"), "items", 60)
+
+
+def test_items_flow_through_every_stage():
+    pipeline = Pipeline("test", queue_size=4)
+    pipeline.source("numbers", lambda: range(100))
+    pipeline.stage("double", lambda n: n * 2, workers=4)
+    pipeline.stage("batches", lambda batch: batch, batch_size=7, flat=True)
+    pipeline.stage("odd", lambda n: n if n % 4 else None)
+    assert sorted(pipeline.run()) == [n * 2 for n in range(100) if n % 2]
+    assert pipeline.stats()['double']['outputs'] == 100
+
+
+def test_failed_items_fail_the_run_after_the_rest():
+    def half(n):
+        if n in (3, 7):
+            raise ValueError(f"bad item {n}")
+        return n / 2
+
+    pipeline = Pipeline("test")
+    pipeline.source("numbers", lambda: range(10))
+    pipeline.stage("half", half, workers=2)
+    outputs = []
+    with pytest.raises(PipelineError, match="half: 2") as error:
+        for output in pipeline.run():
+            outputs.append(output)
+    assert sorted(outputs) == [n / 2 for n in range(10) if n not in (3, 7)]
+    assert isinstance(error.value.__cause__, ValueError)
+
+
+def test_source_error_is_raised_after_what_it_produced():
+    def numbers():
+        yield from range(5)
+        raise ConnectionError("listing failed")
+
+    pipeline = Pipeline("test")
+    pipeline.source("numbers", numbers)
+    pipeline.stage("same", lambda n: n)
+    outputs = []
+    with pytest.raises(ConnectionError):
+        for output in pipeline.run():
+            outputs.append(output)
+    assert sorted(outputs) == list(range(5))
+
+
+def test_stopping_early_cancels_the_run():
+    pipeline = Pipeline("test", queue_size=2)
+    pipeline.source("numbers", lambda: range(10 ** 6))
+    pipeline.stage("same", lambda n: n, workers=2)
+    for _ in pipeline.run():
+        break
+    assert pipeline.stats()['numbers']['outputs'] < 10 ** 6
+
+
+def test_checkpoint_resumes_after_a_crash():
+    checkpoint = fresh_checkpoint()
+    calls = []
+
+    def fetch(item, crash_on=None):
+        calls.append(item[0])
+        if item[0] == crash_on:
+            raise ConnectionError("connection reset")
+        return f"{item[0]}@{item[1]}"
+
+    def build(crash_on=None) -> Pipeline:
+        pipeline = Pipeline("test")
+        pipeline.source("items", lambda: [(str(n), "v1") for n in range(10)])
+        pipeline.stage("fetch", lambda item: fetch(item, crash_on), workers=3, checkpoint=checkpoint,
+                       key=lambda item: item)
+        return pipeline
+
+    with pytest.raises(PipelineError):
+        list(build(crash_on="5").run())
+    calls.clear()
+    pipeline = build()
+    assert sorted(pipeline.run()) == sorted(f"{n}@v1" for n in range(10))
+    # Only the item that failed is redone
+    assert calls == ["5"]
+    assert pipeline.stats()['fetch']['checkpointed'] == 9
+
+
+def test_checkpoint_redoes_changed_and_unversioned_items():
+    checkpoint = fresh_checkpoint()
+    checkpoint.put("a", "v1", ["a"])
+    checkpoint.put("b", "", ["b"])
+    assert checkpoint.get("a", "v1") == ["a"]
+    assert checkpoint.get("a", "v2") is None
+    assert checkpoint.get("b", "") is None
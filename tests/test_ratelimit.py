@@ -0,0 +1,95 @@
+"""Every way a request can end gives its host's AdaptiveLimiter slot back, and waiters are woken when it does"""
+import asyncio
+import uuid
+import threading
+
+import aiohttp
+import pytest
+import requests
+
+from utils.crawler import Crawler
+from utils.ratelimit import AdaptiveLimiter, HostScheduler, HTTP_HOST_INITIAL_CONCURRENCY
+from utils.webpages import HTTPClient
+
+
+def fresh_host() -> str:
+    return f"{uuid.uuid4().hex}.test"
+
+
+class RaisingSession:
+    """Stands in for a requests.Session or an aiohttp.ClientSession, every request raises the given exception"""
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+    def request(self, *args, **kwargs):
+        raise self.error
+
+    async def get(self, *args, **kwargs):
+        raise self.error
+
+
+@pytest.mark.parametrize("error", [requests.exceptions.ChunkedEncodingError("broken chunk"),
+                                   requests.exceptions.TooManyRedirects("loop"),
+                                   KeyboardInterrupt()])
+def test_threaded_request_releases_on_any_exception(monkeypatch, error):
+    host = fresh_host()
+    monkeypatch.setattr(HTTPClient, "session", property(lambda self: RaisingSession(error)))
+    limiter = HostScheduler().for_host(host)
+    for _ in range(HTTP_HOST_INITIAL_CONCURRENCY + 1):
+        with pytest.raises(type(error)):
+            HTTPClient().request("GET", f"http://{host}/")
+        assert limiter.in_flight == 0
+    # The host still takes requests
+    assert limiter.try_acquire() == 0.0
+
+
+@pytest.mark.parametrize("error", [aiohttp.InvalidURL("http://bad"), aiohttp.TooManyRedirects(None, ()),
+                                   asyncio.CancelledError()])
+def test_async_send_releases_on_any_exception(error):
+    host = fresh_host()
+    limiter = HostScheduler().for_host(host)
+
+    async def send():
+        await Crawler()._send(RaisingSession(error), f"http://{host}/", {})
+
+    for _ in range(HTTP_HOST_INITIAL_CONCURRENCY + 1):
+        with pytest.raises(type(error)):
+            asyncio.run(send())
+        assert limiter.in_flight == 0
+    assert limiter.try_acquire() == 0.0
+
+
+def test_waiting_thread_is_woken_by_a_release():
+    limiter = AdaptiveLimiter(fresh_host(), initial_concurrency=1)
+    limiter.acquire()
+    assert limiter.try_acquire() is None
+    acquired = threading.Event()
+    waiter = threading.Thread(target=lambda: (limiter.acquire(), acquired.set()))
+    waiter.start()
+    assert not acquired.wait(0.1)
+    limiter.release(0.01)
+    assert acquired.wait(1)
+    waiter.join()
+    assert limiter.in_flight == 1
+
+
+def test_waiting_coroutines_are_woken_by_releases_from_other_threads():
+    limiter = AdaptiveLimiter(fresh_host(), initial_concurrency=1)
+    limiter.acquire()
+
+    async def wait_for_slots():
+        cancelled = asyncio.ensure_future(limiter.acquire_async())
+        waiters = [asyncio.ensure_future(limiter.acquire_async()) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        assert not any(waiter.done() for waiter in waiters + [cancelled])
+        cancelled.cancel()
+        for _ in waiters:
+            # abandon() frees the slot without growing the window, one waiter gets it
+            threading.Thread(target=limiter.abandon).start()
+            done, _ = await asyncio.wait(waiters, timeout=1, return_when=asyncio.FIRST_COMPLETED)
+            assert len(done) == 1
+            waiters = [waiter for waiter in waiters if not waiter.done()]
+
+    asyncio.run(wait_for_slots())
+    assert limiter.in_flight == 1
@@ -0,0 +1,56 @@
+"""Sitemap index following, and SitemapDiscovery only remembering runs in which every sitemap was read"""
+import uuid
+
+import pytest
+import requests
+
+from utils import sitemaps as sitemaps_module
+from utils.sitemaps import SitemapDiscovery, iter_sitemap
+
+INDEX = "https://example.com/sitemap_index.xml"
+BODIES = {
+    INDEX: """<?xml version="1.0" encoding="UTF-8"?>
+<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+  <sitemap><loc>https://example.com/broken.xml</loc></sitemap>
+  <sitemap><loc>https://example.com/posts.xml</loc></sitemap>
+</sitemapindex>""",
+    "https://example.com/posts.xml": """<?xml version="1.0" encoding="UTF-8"?>
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+  <url><loc>https://example.com/soup/</loc><lastmod>2024-01-31</lastmod></url>
+  <url><loc>https://example.com/stew/</loc></url>
+</urlset>""",
+}
+
+
+def fake_body(url: str):
+    if url not in BODIES:
+        raise requests.HTTPError(f"404 Client Error: Not Found for url: {url}")
+    body = BODIES[url].encode()
+    # Split mid-element, the parser is fed chunk by chunk
+    yield body[:50]
+    yield body[50:]
+
+
+@pytest.fixture(autouse=True)
+def fake_site(monkeypatch):
+    monkeypatch.setattr(sitemaps_module, "_iter_body", fake_body)
+    monkeypatch.setattr(sitemaps_module, "sitemaps_from_robots", lambda base_url: [INDEX])
+
+
+def test_a_failing_child_sitemap_is_skipped():
+    failed = []
+    urls = [entry.url for entry in iter_sitemap(INDEX, failed=failed)]
+    assert urls == ["https://example.com/soup/", "https://example.com/stew/"]
+    assert failed == ["https://example.com/broken.xml"]
+
+
+def test_a_run_with_a_failed_sitemap_is_not_remembered(monkeypatch):
+    discovery = SitemapDiscovery(f"test-{uuid.uuid4().hex}", "https://example.com/")
+    assert len(list(discovery.urls())) == 2
+    discovery.commit()
+    assert discovery.last_run is None
+
+    monkeypatch.setitem(BODIES, "https://example.com/broken.xml", BODIES["https://example.com/posts.xml"])
+    assert len(list(discovery.urls())) == 4
+    discovery.commit()
+    assert discovery.last_run == discovery.started
@@ -0,0 +1,427 @@
+"""
+ Append-only archive of fetched pages, so a crawl can be extracted again (e.g. after fixing a selector) without
+ fetching a single page.
+
+ Pages are stored as WARC 1.0 response records (status line, headers and decoded body) appended to
+ ./.cache/archive/pages.warc.gz, each record compressed as a gzip member of its own, which keeps the file a standard
+ .warc.gz and lets any record be inflated on its own. An SQLite index next to it maps every URL to the offset and
+ length of its latest record, so a page is read with a single seek.
+
+ ARCHIVE_MODE=record archives every page the scrapers read, pages served from the HTTP cache included, and a page
+ that hasn't changed since it was last archived is not stored again. ARCHIVE_MODE=replay serves every GET from the
+ archive instead of the network (a page that isn't archived fails as a request would) and the crawler extracts the
+ replayed pages in a pool of ARCHIVE_PROCESSES processes, each reading its records straight from the file, so
+ re-extracting a crawl is bound by CPU rather than by the sites' rate limits.
+
+ Only GET responses are archived. Any other request fails with NotArchived during a replay, so scrapers that POST
+ (mealie_food_builder calls Mealie's parser and creates foods with POSTs) can't be replayed and refuse to start.
+
+    python -m utils.archive stats
+    python -m utils.archive get https://www.recipetineats.com/
+    python -m utils.archive reindex
+"""
+import os
+import sys
+import gzip
+import time
+import uuid
+import zlib
+import base64
+import pickle
+import sqlite3
+import hashlib
+import logging
+import threading
+import http.client
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, Mapping, Optional, Tuple
+
+from requests.structures import CaseInsensitiveDict
+
+from utils.http_cache import normalize_url
+from utils.parsers import ExtractSpec, extract
+from utils.metrics import Metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows, only one process may record at a time
+    fcntl = None
+
+# off, record (archive every page read) or replay (serve every page from the archive, no network)
+ARCHIVE_MODE = os.getenv("ARCHIVE_MODE", "off").lower()
+ARCHIVE_RECORD = ARCHIVE_MODE == "record"
+ARCHIVE_REPLAY = ARCHIVE_MODE == "replay"
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH", "./.cache/archive/pages.warc.gz")
+ARCHIVE_PROCESSES = int(os.getenv("ARCHIVE_PROCESSES", os.cpu_count() or 1))
+
+_READ_SIZE = 1024 * 1024
+# The archived body is the decoded one, headers describing the transfer no longer apply to it
+_TRANSFER_HEADERS = ('content-encoding', 'transfer-encoding', 'content-length')
+
+
+class NotArchived(LookupError):
+    """A replayed request for a page the archive doesn't hold"""
+
+
+class ArchivedPage:
+    """A page read back from the archive"""
+
+    def __init__(self, url: str, status: int, headers: Mapping[str, str], body: bytes, encoding: Optional[str],
+                 fetched_at: float):
+        self.url = url
+        self.status = status
+        self.headers = CaseInsensitiveDict(headers)
+        self.body = body
+        self.encoding = encoding
+        self.fetched_at = fetched_at
+
+    @property
+    def text(self) -> str:
+        return self.body.decode(self.encoding or 'utf-8', errors='replace')
+
+    def __repr__(self):
+        return f"ArchivedPage({self.url!r}, status={self.status}, bytes={len(self.body)})"
+
+
+class ArchiveEntry:
+    """Where the latest record of a URL is in the archive file"""
+
+    def __init__(self, url: str, offset: int, length: int, status: int, digest: str, fetched_at: float):
+        self.url = url
+        self.offset = offset
+        self.length = length
+        self.status = status
+        self.digest = digest
+        self.fetched_at = fetched_at
+
+
+def payload_digest(body: bytes) -> str:
+    return "sha1:" + base64.b32encode(hashlib.sha1(body).digest()).decode("ascii")
+
+
+def _header_block(first_line: str, headers: Mapping[str, str]) -> bytes:
+    lines = [first_line] + [f"{name}: {value}" for name, value in headers.items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("utf-8")
+
+
+def _parse_headers(lines) -> Dict[str, str]:
+    headers = {}
+    for line in lines:
+        name, _, value = line.decode("utf-8", errors='replace').partition(":")
+        name, value = name.strip(), value.strip()
+        headers[name] = f"{headers[name]}, {value}" if name in headers else value
+    return headers
+
+
+def build_record(url: str, status: int, headers: Mapping[str, str], body: bytes, encoding: Optional[str],
+                 fetched_at: float) -> Tuple[bytes, str]:
+    """
+    A gzipped WARC response record
+    :return: (record, payload digest)
+    """
+    kept = {name: value for name, value in headers.items() if name.lower() not in _TRANSFER_HEADERS}
+    kept['Content-Length'] = str(len(body))
+    try:
+        reason = http.client.responses[status]
+    except KeyError:
+        reason = ""
+    block = _header_block(f"HTTP/1.1 {status} {reason}".rstrip(), kept) + body
+    digest = payload_digest(body)
+    warc = {
+        'WARC-Type': "response",
+        'WARC-Record-ID': f"<urn:uuid:{uuid.uuid4()}>",
+        'WARC-Date': datetime.fromtimestamp(fetched_at, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        'WARC-Target-URI': url,
+        'WARC-Payload-Digest': digest,
+        'Content-Type': "application/http; msgtype=response",
+        'Content-Length': str(len(block)),
+    }
+    if encoding:
+        # Not part of the standard, the encoding requests guessed (or the cache stored) for a body without a charset
+        warc['X-Encoding'] = encoding
+    return gzip.compress(_header_block("WARC/1.0", warc) + block + b"\r\n\r\n", 6), digest
+
+
+def parse_record(data: bytes) -> Optional[ArchivedPage]:
+    """The page of an inflated WARC record, None for records other than responses"""
+    head, _, rest = data.partition(b"\r\n\r\n")
+    warc = CaseInsensitiveDict(_parse_headers(head.split(b"\r\n")[1:]))
+    if warc.get('WARC-Type') != "response":
+        return None
+    block = rest[:int(warc['Content-Length'])]
+    http_head, _, body = block.partition(b"\r\n\r\n")
+    lines = http_head.split(b"\r\n")
+    status = int(lines[0].split()[1])
+    fetched_at = datetime.strptime(warc['WARC-Date'], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc).timestamp()
+    return ArchivedPage(warc['WARC-Target-URI'], status, _parse_headers(lines[1:]), body, warc.get('X-Encoding'),
+                        fetched_at)
+
+
+def iter_members(f, start: int = 0) -> Iterator[Tuple[int, int, bytes]]:
+    """
+    Inflate the gzip members of a file one after the other
+    :param f: File opened for binary reading
+    :param start: Offset of the first member
+    :return: (offset, compressed length, inflated data) of each member, EOFError at a member cut short
+    """
+    f.seek(start)
+    offset = start
+    buffer = b""
+    while True:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        parts = []
+        consumed = 0
+        while not decompressor.eof:
+            if not buffer:
+                buffer = f.read(_READ_SIZE)
+                if not buffer:
+                    if consumed:
+                        raise EOFError(f"Incomplete record at offset {offset}")
+                    return
+            parts.append(decompressor.decompress(buffer))
+            consumed += len(buffer) - len(decompressor.unused_data)
+            buffer = decompressor.unused_data
+        yield offset, consumed, b"".join(parts)
+        offset += consumed
+
+
+# Descriptors of the archive files opened for reading, extraction workers keep theirs between tasks
+_readers: Dict[str, int] = {}
+_readers_lock = threading.Lock()
+
+
+def read_record(path: str, offset: int, length: int) -> ArchivedPage:
+    """Read one record straight from its offset, safe to call from several threads"""
+    with _readers_lock:
+        fd = _readers.get(path)
+        if fd is None:
+            fd = _readers[path] = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        # pread leaves the file position alone, which forked pool workers share with the process that opened it
+        if hasattr(os, 'pread'):
+            data = None
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            data = os.read(fd, length)
+    if data is None:
+        data = os.pread(fd, length, offset)
+    # Inflating and parsing is most of the work, it happens outside the lock
+    return parse_record(gzip.decompress(data))
+
+
+def apply_extractor(extractor: Any, url: str, text: str) -> Any:
+    """Run a crawler extractor, an ExtractSpec or a callback taking (url, html), on a page"""
+    if isinstance(extractor, ExtractSpec):
+        return extract(text, extractor)
+    return extractor(url, text)
+
+
+def extract_archived(path: str, offset: int, length: int, url: str, extractor: Any) -> Any:
+    """Read an archived page and extract from it, run by the replay process pool"""
+    return apply_extractor(extractor, url, read_record(path, offset, length).text)
+
+
+class PageArchive:
+    """Singleton archive of fetched pages, safe to record to from several threads and processes at once"""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = super(PageArchive, cls).__new__(cls)
+                cls._instance.path = ARCHIVE_PATH
+                cls._instance.index_path = ARCHIVE_PATH + ".idx"
+                cls._instance._local = threading.local()
+                cls._instance._write_lock = threading.Lock()
+                cls._instance._pool = None
+                cls._instance._picklable = {}
+                cls._instance._init()
+        return cls._instance
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        """SQLite connection to the index for the current thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _init(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                status INTEGER NOT NULL,
+                digest TEXT NOT NULL,
+                fetched_at REAL NOT NULL
+            )""")
+        open(self.path, "ab").close()
+        with self._locked() as f:
+            self._catch_up(f)
+
+    @contextmanager
+    def _locked(self) -> Iterator[Any]:
+        """The archive file opened for appending, locked against other processes"""
+        with open(self.path, "a+b") as f:
+            if fcntl is not None:
+                # Released when the file is closed
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            yield f
+
+    def _index(self, url: str, offset: int, length: int, status: int, digest: str, fetched_at: float):
+        # A record only replaces one written before it, whichever process indexes first
+        self.db.execute("""
+            INSERT INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET url = excluded.url, offset = excluded.offset, length = excluded.length,
+                status = excluded.status, digest = excluded.digest, fetched_at = excluded.fetched_at
+            WHERE excluded.offset > pages.offset""",
+                        (normalize_url(url), url, offset, length, status, digest, fetched_at))
+
+    def _catch_up(self, f, start: Optional[int] = None) -> int:
+        """
+        Index the records past the last indexed one (left by a run that stopped between writing a record and
+        indexing it), cutting off a record left half written. Called with the file locked.
+        :param f: Archive file
+        :param start: Offset to index from, after the last indexed record when omitted
+        :return: Records indexed
+        """
+        if start is None:
+            start = self.db.execute("SELECT COALESCE(MAX(offset + length), 0) FROM pages").fetchone()[0]
+        f.seek(0, os.SEEK_END)
+        if f.tell() <= start:
+            return 0
+        indexed = 0
+        end = start
+        try:
+            for offset, length, data in iter_members(f, start):
+                end = offset + length
+                page = parse_record(data)
+                if page is not None:
+                    self._index(page.url, offset, length, page.status, payload_digest(page.body), page.fetched_at)
+                    indexed += 1
+        except (EOFError, zlib.error, ValueError, KeyError) as e:
+            logging.warning(f"Truncating {self.path} at {end}: {e}")
+            f.truncate(end)
+        if indexed:
+            logging.info(f"Indexed {indexed} records of {self.path}")
+        return indexed
+
+    def reindex(self) -> int:
+        """Rebuild the index from the archive file"""
+        with self._locked() as f:
+            self.db.execute("DELETE FROM pages")
+            return self._catch_up(f, 0)
+
+    def locate(self, url: str) -> Optional[ArchiveEntry]:
+        """Where the latest record of a URL is, None if it was never archived"""
+        row = self.db.execute("SELECT url, offset, length, status, digest, fetched_at FROM pages WHERE key = ?",
+                              (normalize_url(url),)).fetchone()
+        return ArchiveEntry(*row) if row is not None else None
+
+    def __contains__(self, url: str) -> bool:
+        return self.locate(url) is not None
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+
+    def record(self, url: str, status: int, headers: Mapping[str, str], body: bytes,
+               encoding: Optional[str] = None) -> bool:
+        """
+        Archive a page, unless its latest record already holds the same response
+        :param url: URL the page was requested with
+        :param status: HTTP status
+        :param headers: Response headers
+        :param body: Decoded body
+        :param encoding: Text encoding of the body
+        :return: True if a record was appended
+        """
+        digest = payload_digest(body)
+        entry = self.locate(url)
+        if entry is not None and entry.digest == digest and entry.status == status:
+            Metrics().incr("archive_pages_total", outcome="unchanged")
+            return False
+        fetched_at = time.time()
+        data, digest = build_record(url, status, headers, body, encoding, fetched_at)
+        with self._write_lock, self._locked() as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(data)
+            f.flush()
+        self._index(url, offset, len(data), status, digest, fetched_at)
+        Metrics().incr("archive_pages_total", outcome="recorded")
+        Metrics().incr("archive_bytes_total", len(data))
+        return True
+
+    def get(self, url: str) -> ArchivedPage:
+        """
+        Read the latest archived copy of a page
+        :param url: URL
+        :return: ArchivedPage, whatever its status
+        """
+        entry = self.locate(url)
+        if entry is None:
+            Metrics().incr("archive_pages_total", outcome="missing")
+            raise NotArchived(f"{url} is not in {self.path}")
+        Metrics().incr("archive_pages_total", outcome="replayed")
+        page = read_record(self.path, entry.offset, entry.length)
+        page.url = url
+        return page
+
+    def executor(self, extractor: Any) -> Optional[ProcessPoolExecutor]:
+        """
+        Executor replayed pages are extracted in: the process pool, or None (the default thread pool) for
+        extractors that can't be sent to another process, such as closures
+        """
+        picklable = self._picklable.get(extractor)
+        if picklable is None:
+            try:
+                pickle.dumps(extractor)
+                picklable = True
+            except (pickle.PicklingError, AttributeError, TypeError):
+                logging.debug(f"{extractor!r} can't be pickled, extracting replayed pages in threads")
+                picklable = False
+            self._picklable[extractor] = picklable
+        if not picklable or ARCHIVE_PROCESSES <= 1:
+            return None
+        with self._instance_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(ARCHIVE_PROCESSES)
+        return self._pool
+
+    def stats(self) -> Dict[str, Any]:
+        row = self.db.execute("SELECT COUNT(*), COALESCE(SUM(length), 0), MIN(fetched_at), MAX(fetched_at), "
+                              "SUM(status >= 400) FROM pages").fetchone()
+        return {'pages': row[0], 'indexed_bytes': row[1], 'file_bytes': os.path.getsize(self.path),
+                'errors': row[4] or 0, 'oldest': row[2], 'newest': row[3]}
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        with _readers_lock:
+            fd = _readers.pop(self.path, None)
+        if fd is not None:
+            os.close(fd)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) == 2 and sys.argv[1] == "stats":
+        print(PageArchive().stats())
+    elif len(sys.argv) == 2 and sys.argv[1] == "reindex":
+        print(f"Indexed {PageArchive().reindex()} records")
+    elif len(sys.argv) == 3 and sys.argv[1] == "get":
+        page = PageArchive().get(sys.argv[2])
+        sys.stdout.write(page.text)
+    else:
+        print(__doc__)
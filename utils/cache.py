@@ -1,22 +1,41 @@
 """
- Simple modular Cache system, each module can store values in a Key->Value cache with a specified TTL,
- schedule runs every 5 seconds to check for expired keys and remove them.
+ Simple modular Cache system, each module can store values in a Key->Value cache with a specified TTL.
  Keys are stored such that module-key is the key in the cache, this allows for multiple modules to store
     keys with the same name without conflict.
+
+ Values live in a pluggable storage backend (SQLite by default) which only writes the keys that changed and is
+ read lazily on get, recently used values are kept decoded in a size-bounded in-memory LRU in front of it.
+ The LRU is split into lock stripes so concurrent readers of different keys don't serialize.
+
+ TTLs are checked on every access, so an expired key is never served. Expired keys are removed lazily from a
+ time-ordered index (a heap in memory, an indexed column on disk), so expiring costs O(expired) not O(all keys).
 """
+import heapq
 import logging
 import threading
+import sqlite3
 import time
 import os
 import json
 
-from typing import Any, Dict
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from utils.misc import get_calling_filename
+from utils.metrics import Metrics
 
 
 if not os.path.exists("./.cache"):
     os.makedirs("./.cache")
 
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "sqlite")
+CACHE_PATH = os.getenv("CACHE_PATH", "./.cache/cache.sqlite")
+CACHE_MEMORY_BYTES = int(os.getenv("CACHE_MEMORY_BYTES", 64 * 1024 * 1024))
+CACHE_DISK_BYTES = int(os.getenv("CACHE_DISK_BYTES", 1024 * 1024 * 1024))
+CACHE_LOCK_STRIPES = int(os.getenv("CACHE_LOCK_STRIPES", 16))
+# How often the backend is asked to drop expired keys, expired keys are never served in between
+CACHE_PURGE_INTERVAL = float(os.getenv("CACHE_PURGE_INTERVAL", 1))
+LEGACY_CACHE_PATH = "./.cache/cache.json"
+
 
 class TTL:
     """
@@ -28,45 +47,411 @@ class TTL:
     DAYS = 60 * 60 * 24
 
 
+class ExpiryIndex:
+    """
+    Min-heap of (expires, key). Overwritten keys leave stale entries behind, callers check the popped expiry
+    against the live value before deleting anything.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []
+        # Heap size at which stale entries may outnumber live ones, raised by every compaction
+        self.compact_at = 1024
+
+    def push(self, key: str, expires: float) -> bool:
+        """
+        Add a key's expiry
+        :return: True once the heap has grown enough that it is worth compacting
+        """
+        with self.lock:
+            heapq.heappush(self.heap, (expires, key))
+            if len(self.heap) <= self.compact_at:
+                return False
+            # Only this caller compacts, the others carry on until compact() sets the next threshold
+            self.compact_at = float("inf")
+            return True
+
+    def pop_expired(self, now: float) -> List[Tuple[float, str]]:
+        # Nearly every call finds nothing expired, looking at the head without the lock keeps readers from
+        # serializing on it. A stale look only delays an expiry to the next call.
+        heap = self.heap
+        try:
+            if heap[0][0] >= now:
+                return []
+        except IndexError:
+            return []
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] < now:
+                expired.append(heapq.heappop(self.heap))
+        return expired
+
+    def compact(self, live: Dict[str, float]):
+        """Rebuild the heap from the live expiries once stale entries pile up"""
+        with self.lock:
+            self.heap = [(expires, key) for key, expires in live.items()]
+            heapq.heapify(self.heap)
+            self.compact_at = 2 * len(self.heap) + 1024
+
+
+class CacheBackend:
+    """
+    Storage interface used by Cache. Values are passed as already serialized JSON strings.
+    """
+
+    def load(self, key: str) -> Optional[Tuple[str, float]]:
+        """Return (value, expires) for a key or None"""
+        raise NotImplementedError
+
+    def save(self, key: str, value: str, expires: float):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def delete_prefix(self, prefix: str):
+        raise NotImplementedError
+
+    def items(self, prefix: str = "") -> Iterator[Tuple[str, str, float]]:
+        """Iterate (key, value, expires) for all keys starting with prefix"""
+        raise NotImplementedError
+
+    def delete_expired(self, now: float) -> int:
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+
+class MemoryBackend(CacheBackend):
+    """Non persistent backend, useful for one-off runs and benchmarks"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+        self.expiry = ExpiryIndex()
+
+    def load(self, key):
+        with self.lock:
+            row = self.data.get(key)
+        if row is None or row[1] < time.time():
+            return None
+        return row
+
+    def save(self, key, value, expires):
+        with self.lock:
+            self.data[key] = (value, expires)
+        if self.expiry.push(key, expires):
+            with self.lock:
+                live = {key: row[1] for key, row in self.data.items()}
+            self.expiry.compact(live)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self.lock:
+            for key in [key for key in self.data if key.startswith(prefix)]:
+                del self.data[key]
+
+    def items(self, prefix=""):
+        now = time.time()
+        with self.lock:
+            items = [(key, value, expires) for key, (value, expires) in self.data.items()
+                     if key.startswith(prefix) and expires >= now]
+        return iter(items)
+
+    def delete_expired(self, now):
+        removed = 0
+        for expires, key in self.expiry.pop_expired(now):
+            with self.lock:
+                row = self.data.get(key)
+                if row is not None and row[1] == expires:
+                    del self.data[key]
+                    removed += 1
+        return removed
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    SQLite backend, every set is a single row upsert so a checkpoint never rewrites the whole cache.
+    WAL mode with a busy timeout lets several scraper processes share the same file.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, max_bytes: int = CACHE_DISK_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.evict_lock = threading.Lock()
+        self.writes = 0
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires REAL NOT NULL,
+                size INTEGER NOT NULL,
+                accessed REAL NOT NULL
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def load(self, key):
+        row = self.db.execute("SELECT value, expires FROM entries WHERE key = ? AND expires >= ?",
+                              (key, time.time())).fetchone()
+        if row is not None:
+            self.db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+        return row
+
+    def save(self, key, value, expires):
+        self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                        (key, value, expires, len(value), time.time()))
+        self.writes += 1
+        # Checking the total size is a full index scan, only do it every so often
+        if self.writes % 100 == 0:
+            self.evict()
+
+    def delete(self, key):
+        self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def delete_prefix(self, prefix):
+        self.db.execute("DELETE FROM entries WHERE substr(key, 1, ?) = ?", (len(prefix), prefix))
+
+    def items(self, prefix=""):
+        return iter(self.db.execute("SELECT key, value, expires FROM entries WHERE substr(key, 1, ?) = ? "
+                                    "AND expires >= ?", (len(prefix), prefix, time.time())).fetchall())
+
+    def delete_expired(self, now):
+        # Range scan on the expires index, only touches the rows that actually expired
+        return self.db.execute("DELETE FROM entries WHERE expires < ?", (now,)).rowcount
+
+    def evict(self) -> int:
+        """Remove least recently used entries until the file is under its disk budget"""
+        with self.evict_lock:
+            excess = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0] - self.max_bytes
+            evicted = 0
+            if excess <= 0:
+                return evicted
+            for key, size in self.db.execute("SELECT key, size FROM entries ORDER BY accessed").fetchall():
+                if excess <= 0:
+                    break
+                self.delete(key)
+                excess -= size
+                evicted += 1
+            logging.debug(f"Evicted {evicted} keys from the cache")
+            Metrics().incr("cache_evictions_total", evicted, tier="disk")
+            return evicted
+
+    def flush(self):
+        self.evict()
+        self.db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+
+BACKENDS = {
+    'sqlite': SQLiteBackend,
+    'memory': MemoryBackend,
+}
+
+
+class _Stripe:
+    """One lock-protected slice of the in-memory LRU"""
+
+    def __init__(self, budget: int):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.budget = budget
+        # Counted under the stripe lock, published by Cache._collect_stats
+        self.hits = 0
+        self.evicted = 0
+
+    def _acquire(self):
+        # Only waits are timed, an uncontended acquire stays a single call
+        if not self.lock.acquire(blocking=False):
+            started = time.perf_counter()
+            self.lock.acquire()
+            Metrics().observe("cache_lock_wait_seconds", time.perf_counter() - started)
+
+    def lookup(self, key: str, now: float) -> Optional[Tuple[Any, float]]:
+        self._acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < now:
+                self._forget(key)
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+        finally:
+            self.lock.release()
+
+    def remember(self, key: str, value: Any, expires: float, size: int):
+        self._acquire()
+        try:
+            self._forget(key)
+            if size > self.budget:
+                return
+            self.entries[key] = (value, expires, size)
+            self.bytes += size
+            while self.bytes > self.budget:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evicted += 1
+        finally:
+            self.lock.release()
+
+    def forget(self, key: str, expires: Optional[float] = None):
+        """Drop a key, if expires is given only when it still matches the live entry"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (expires is None or entry[1] == expires):
+                self._forget(key)
+
+    def forget_prefix(self, prefix: str):
+        with self.lock:
+            for key in [key for key in self.entries if key.startswith(prefix)]:
+                self._forget(key)
+
+    def _forget(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+
 class Cache:
     """Singleton Cache class"""
 
     _instance = None
 
-    def __new__(cls):
+    def __new__(cls, backend: Optional[CacheBackend] = None):
         if cls._instance is None:
             cls._instance = super(Cache, cls).__new__(cls)
-            cls._instance.cache = {}
-            cls._instance.cache_lock = threading.Lock()
-            cls._instance.cache_thread = threading.Thread(target=cls._instance._cache_thread)
-            cls._instance.cache_thread.daemon = True
-            cls._instance.cache_thread.start()
+            cls._instance.backend = backend or BACKENDS[CACHE_BACKEND]()
+            cls._instance.stripes = [_Stripe(CACHE_MEMORY_BYTES // CACHE_LOCK_STRIPES)
+                                     for _ in range(CACHE_LOCK_STRIPES)]
+            cls._instance.expiry = ExpiryIndex()
+            cls._instance.purge_lock = threading.Lock()
+            cls._instance.last_purge = 0.0
             cls._instance.read_cache()
+            Metrics().register_collector("cache", cls._instance._collect_stats)
         return cls._instance
 
+    def _collect_stats(self) -> Dict[str, int]:
+        hits = sum(stripe.hits for stripe in self.stripes)
+        evicted = sum(stripe.evicted for stripe in self.stripes)
+        Metrics().set_counter("cache_lookups_total", hits, result="memory")
+        Metrics().set_counter("cache_evictions_total", evicted, tier="memory")
+        return {'memory_hits': hits, 'memory_evictions': evicted,
+                'memory_keys': sum(len(stripe.entries) for stripe in self.stripes),
+                'memory_bytes': sum(stripe.bytes for stripe in self.stripes)}
+
     def write_cache(self):
-        with open("./.cache/cache.json", "w") as f:
-            json.dump(self.cache, f)
-        f.close()
+        """Checkpoint the backend, only keys changed since the last set are ever written"""
+        self.backend.flush()
         logging.debug("Cache written to disk")
 
     def read_cache(self):
+        """Import a legacy whole-file JSON cache into the backend, values are otherwise loaded lazily"""
         try:
-            with open("./.cache/cache.json", "r") as f:
-                self.cache = json.load(f)
+            with open(LEGACY_CACHE_PATH, "r") as f:
+                legacy = json.load(f)
             f.close()
-            logging.debug("Cache read from disk")
         except FileNotFoundError:
-            logging.debug("No cache file found")
+            logging.debug("No legacy cache file found")
+            return
+        for key, entry in legacy.items():
+            self.backend.save(key, json.dumps(entry['value']), entry['ttl'])
+        self.backend.flush()
+        os.rename(LEGACY_CACHE_PATH, LEGACY_CACHE_PATH + ".migrated")
+        logging.info(f"Migrated {len(legacy)} keys from {LEGACY_CACHE_PATH}")
+
+    def _stripe(self, key: str) -> _Stripe:
+        return self.stripes[hash(key) % len(self.stripes)]
 
-    def _cache_thread(self):
-        while True:
-            time.sleep(5)
-            with self.cache_lock:
-                for key in list(self.cache.keys()):
-                    if self.cache[key]['ttl'] < time.time():
-                        logging.debug(f"Removing expired key: {key}")
-                        del self.cache[key]
+    def _remember(self, key: str, value: Any, expires: float, size: int):
+        self._stripe(key).remember(key, value, expires, size)
+        if self.expiry.push(key, expires):
+            live = {}
+            for stripe in self.stripes:
+                with stripe.lock:
+                    live.update({key: entry[1] for key, entry in stripe.entries.items()})
+            self.expiry.compact(live)
+
+    def _expire(self, now: float):
+        """Drop keys whose TTL has passed, cost is proportional to the number of expired keys"""
+        for expires, key in self.expiry.pop_expired(now):
+            self._stripe(key).forget(key, expires)
+        if now - self.last_purge < CACHE_PURGE_INTERVAL or not self.purge_lock.acquire(blocking=False):
+            return
+        try:
+            self.last_purge = now
+            removed = self.backend.delete_expired(now)
+            if removed:
+                logging.debug(f"Removed {removed} expired keys")
+        finally:
+            self.purge_lock.release()
+
+    def _load(self, key: str) -> Optional[Tuple[Any, float]]:
+        now = time.time()
+        self._expire(now)
+        entry = self._stripe(key).lookup(key, now)
+        if entry is not None:
+            return entry
+        row = self.backend.load(key)
+        if row is None:
+            Metrics().incr("cache_lookups_total", result="miss")
+            return None
+        Metrics().incr("cache_lookups_total", result="backend")
+        raw, expires = row
+        value = json.loads(raw)
+        self._remember(key, value, expires, len(raw))
+        return value, expires
+
+    def namespace(self, name: str) -> 'CacheNamespace':
+        """Get a handle bound to a namespace, e.g. Cache().namespace("mealie_food_builder")
+
+        Args:
+            name (str): Namespace, normally the scraper module name
+
+        Returns:
+            CacheNamespace: Handle with the same set/get/exists/remove/clear/get_all API
+        """
+        return CacheNamespace(self, name)
+
+    def _set(self, key: str, value: Any, ttl: int):
+        raw = json.dumps(value)
+        now = time.time()
+        self._expire(now)
+        self.backend.save(key, raw, now + ttl)
+        self._remember(key, value, now + ttl, len(raw))
+
+    def _remove(self, key: str):
+        self._stripe(key).forget(key)
+        self.backend.delete(key)
+
+    def _clear(self, prefix: str):
+        for stripe in self.stripes:
+            stripe.forget_prefix(prefix)
+        self.backend.delete_prefix(prefix)
+
+    def _get_all(self, prefix: str) -> Dict[str, Any]:
+        return {key[len(prefix):]: json.loads(value) for key, value, _ in self.backend.items(prefix)}
+
+    # The methods below work out the namespace from the calling module, kept for backwards compatibility.
+    # Scrapers should hold a handle from Cache().namespace(name) instead.
 
     def set(self, key: str, value: Any, ttl: int = 60):
         """Set a value in the cache
@@ -77,9 +462,7 @@ class Cache:
             ttl (int, optional): Time in seconds before the key expires. Defaults to 60.
         """
         calling_filename = get_calling_filename()
-        key = f"{calling_filename}-{key}"
-        with self.cache_lock:
-            self.cache[key] = {'value': value, 'ttl': time.time() + ttl}
+        self._set(f"{calling_filename}-{key}", value, ttl)
 
     def get(self, key: str) -> Any:
         """Get a value from the cache
@@ -90,12 +473,10 @@ class Cache:
         Returns:
             Any: Value stored in the cache
         """
-        logging.debug(f"Getting key: {key}")
         calling_filename = get_calling_filename()
-        key = f"{calling_filename}-{key}"
-        with self.cache_lock:
-            if key in self.cache:
-                return self.cache[key]['value']
+        entry = self._load(f"{calling_filename}-{key}")
+        if entry is not None:
+            return entry[0]
         return None
 
     def remove(self, key: str):
@@ -104,21 +485,14 @@ class Cache:
         Args:
             key (str): Key to remove
         """
-        logging.debug(f"Removing key: {key}")
         calling_filename = get_calling_filename()
-        key = f"{calling_filename}-{key}"
-        with self.cache_lock:
-            if key in self.cache:
-                del self.cache[key]
+        self._remove(f"{calling_filename}-{key}")
 
     def clear(self):
         """Clear the cache for give module"""
         logging.debug("Clearing cache")
-        with self.cache_lock:
-            calling_filename = get_calling_filename()
-            keys = [key for key in self.cache.keys() if key.startswith(calling_filename)]
-            for key in keys:
-                del self.cache[key]
+        calling_filename = get_calling_filename()
+        self._clear(f"{calling_filename}-")
 
     def get_all(self) -> Dict[str, Any]:
         """Get all keys and values from the cache for module
@@ -126,11 +500,8 @@ class Cache:
         Returns:
             Dict[str, Any]: All keys and values in the cache
         """
-        logging.debug("Getting all keys")
-        with self.cache_lock:
-            calling_filename = get_calling_filename()
-            keys = {key: self.cache[key]['value'] for key in self.cache.keys() if key.startswith(calling_filename)}
-        return {key.split("-")[1]: value for key, value in keys.items()}
+        calling_filename = get_calling_filename()
+        return self._get_all(f"{calling_filename}-")
 
     def exists(self, key: str) -> bool:
         """Check if a key exists in the cache
@@ -142,6 +513,72 @@ class Cache:
             bool: True if key exists, False otherwise
         """
         calling_filename = get_calling_filename()
-        key = f"{calling_filename}-{key}"
-        with self.cache_lock:
-            return key in self.cache
+        return self._load(f"{calling_filename}-{key}") is not None
+
+
+class CacheNamespace:
+    """Cache handle bound to one namespace, avoids looking up the calling module on every call"""
+
+    def __init__(self, cache: Cache, name: str):
+        self.cache = cache
+        self.name = name
+        self.prefix = f"{name}-"
+
+    def set(self, key: str, value: Any, ttl: int = 60):
+        """Set a value in the cache
+
+        Args:
+            key (str): Key to store the value under
+            value (Any): Value to store
+            ttl (int, optional): Time in seconds before the key expires. Defaults to 60.
+        """
+        self.cache._set(self.prefix + key, value, ttl)
+
+    def get(self, key: str) -> Any:
+        """Get a value from the cache
+
+        Args:
+            key (str): Key to get the value for
+
+        Returns:
+            Any: Value stored in the cache
+        """
+        entry = self.cache._load(self.prefix + key)
+        if entry is not None:
+            return entry[0]
+        return None
+
+    def remove(self, key: str):
+        """Remove a key from the cache
+
+        Args:
+            key (str): Key to remove
+        """
+        self.cache._remove(self.prefix + key)
+
+    def clear(self):
+        """Clear every key in this namespace"""
+        logging.debug(f"Clearing cache for {self.name}")
+        self.cache._clear(self.prefix)
+
+    def get_all(self) -> Dict[str, Any]:
+        """Get all keys and values in this namespace
+
+        Returns:
+            Dict[str, Any]: All keys and values in the cache
+        """
+        return self.cache._get_all(self.prefix)
+
+    def exists(self, key: str) -> bool:
+        """Check if a key exists in the cache
+
+        Args:
+            key (str): Key to check
+
+        Returns:
+            bool: True if key exists, False otherwise
+        """
+        return self.cache._load(self.prefix + key) is not None
+
+    def write_cache(self):
+        self.cache.write_cache()
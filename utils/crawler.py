@@ -0,0 +1,376 @@
+"""
+ Asyncio crawl engine, keeps many page fetches in flight from a single thread.
+
+ Scrapers hand the engine a list of URLs and either an extraction callback taking (url, html) or an ExtractSpec.
+ Pages crawled with a spec are streamed into an incremental parser and the connection is dropped as soon as the
+ spec's region has been read. Every URL gets a CrawlResult holding either the value extracted or the exception that
+ was raised, nothing is silently dropped.
+
+ Paginated listings are crawled as chains: each chain is walked one page at a time, a follow callback deciding from
+ the page just read whether (and where) to continue, while many chains progress concurrently.
+
+ With ARCHIVE_MODE=record pages are read whole (no streaming) and archived. With ARCHIVE_MODE=replay nothing is
+ fetched: each page is read from the archive and extracted by the archive's process pool.
+"""
+import os
+import time
+import asyncio
+import logging
+
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
+import aiohttp
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+from utils.webpages import HTTP_MAX_RETRIES, HTTP_BACKOFF_FACTOR, HTTP_TIMEOUT, RETRY_STATUSES, \
+    THROTTLE_STATUSES, HTTP_STREAM_CHUNK_SIZE, HTTP_MAX_RESPONSE_BYTES, StreamedPage, stream_cache_vary, \
+    record_response, record_transfer, url_host
+from utils.http_cache import HTTP_CACHE_ENABLED, ResponseCache
+from utils.archive import ARCHIVE_RECORD, ARCHIVE_REPLAY, NotArchived, PageArchive, apply_extractor, \
+    extract_archived
+from utils.parsers import ExtractSpec, extract
+from utils.ratelimit import HostScheduler, jittered_backoff, retry_after
+from utils.metrics import Metrics
+
+CRAWL_MAX_IN_FLIGHT = int(os.getenv("CRAWL_MAX_IN_FLIGHT", 100))
+CRAWL_MAX_PER_HOST = int(os.getenv("CRAWL_MAX_PER_HOST", 8))
+
+Extractor = Union[Callable[[str, str], Any], ExtractSpec]
+# Takes (url, value) of the page just crawled, returns the next URL of the chain or None to stop
+Follow = Callable[[str, Any], Optional[str]]
+
+
+class CrawlResult:
+    """Outcome of crawling a single URL"""
+
+    def __init__(self, url: str, value: Any = None, error: Optional[BaseException] = None):
+        self.url = url
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self):
+        return f"CrawlResult({self.url!r}, ok={self.ok})"
+
+
+def is_not_found(error: Optional[BaseException]) -> bool:
+    """True for a 404, which ends a paginated chain rather than being a failure"""
+    return isinstance(error, aiohttp.ClientResponseError) and error.status == 404
+
+
+def _trace_config() -> aiohttp.TraceConfig:
+    """Times DNS lookups and connection setup (DNS included, as for the threaded client) per host"""
+    async def on_request_start(session, ctx, params):
+        ctx.host = url_host(str(params.url))
+
+    async def on_dns_start(session, ctx, params):
+        ctx.dns_started = time.perf_counter()
+
+    async def on_dns_end(session, ctx, params):
+        Metrics().observe("http_dns_seconds", time.perf_counter() - ctx.dns_started, host=ctx.host)
+
+    async def on_connect_start(session, ctx, params):
+        ctx.connect_started = time.perf_counter()
+
+    async def on_connect_end(session, ctx, params):
+        Metrics().observe("http_connect_seconds", time.perf_counter() - ctx.connect_started, host=ctx.host)
+
+    config = aiohttp.TraceConfig()
+    config.on_request_start.append(on_request_start)
+    config.on_dns_resolvehost_start.append(on_dns_start)
+    config.on_dns_resolvehost_end.append(on_dns_end)
+    config.on_connection_create_start.append(on_connect_start)
+    config.on_connection_create_end.append(on_connect_end)
+    return config
+
+
+class Crawler:
+    """
+    Fetches pages concurrently with a limit on requests in flight for the whole run and per host, within which each
+    host's AdaptiveLimiter decides how many are actually sent at once
+    """
+
+    def __init__(self, max_in_flight: int = CRAWL_MAX_IN_FLIGHT, max_per_host: int = CRAWL_MAX_PER_HOST,
+                 max_age: float = 0, name: str = "default", max_bytes: int = HTTP_MAX_RESPONSE_BYTES):
+        self.max_in_flight = max_in_flight
+        self.max_per_host = max_per_host
+        self.max_age = max_age
+        self.name = name
+        self.max_bytes = max_bytes
+
+    async def _send(self, session: aiohttp.ClientSession, url: str, headers: Dict[str, str]) -> aiohttp.ClientResponse:
+        """
+        Send a GET paced by the host's AdaptiveLimiter, retrying connection errors and 429/5xx responses with a
+        jittered backoff (429/503 hold the whole host for their Retry-After). The caller releases the response.
+        The host's limiter slot is given back once the headers arrive, the body is read outside the window.
+        """
+        limiter = HostScheduler().for_url(url)
+        attempt = 0
+        while True:
+            await limiter.acquire_async()
+            started = time.monotonic()
+            try:
+                resp = await session.get(url, headers=headers)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                limiter.release(None, ok=False)
+                Metrics().incr("http_errors_total", host=url_host(url), error=type(e).__name__)
+                if attempt >= HTTP_MAX_RETRIES:
+                    raise
+                delay = jittered_backoff(attempt, HTTP_BACKOFF_FACTOR)
+            except Exception:
+                # See HTTPClient.request, every failure gives the slot back
+                limiter.release(None, ok=False)
+                raise
+            except BaseException:
+                # Cancelled, e.g. by a timeout around the crawl, which says nothing about the host
+                limiter.abandon()
+                raise
+            else:
+                throttled = resp.status in THROTTLE_STATUSES
+                ttfb = time.monotonic() - started
+                limiter.release(ttfb, ok=resp.status < 500, throttled=throttled)
+                record_response(url, resp.status, ttfb)
+                if resp.status not in RETRY_STATUSES or attempt >= HTTP_MAX_RETRIES:
+                    return resp
+                delay = retry_after(resp.headers)
+                if delay is None:
+                    delay = jittered_backoff(attempt, HTTP_BACKOFF_FACTOR)
+                resp.release()
+                if throttled:
+                    limiter.backoff(delay)
+                    delay = 0
+            attempt += 1
+            logging.debug(f"Retrying {url} (attempt {attempt})")
+            await asyncio.sleep(delay)
+
+    async def fetch(self, session: aiohttp.ClientSession, url: str) -> str:
+        """
+        Fetch a page through the response cache, retrying connection errors and 429/5xx responses with backoff
+        :param session: Open aiohttp session
+        :param url: URL
+        :return: Decoded body
+        """
+        loop = asyncio.get_running_loop()
+        cache = ResponseCache() if HTTP_CACHE_ENABLED else None
+        entry = cache.lookup(url) if cache is not None else None
+        headers = {}
+        if entry is not None:
+            if entry.age() < self.max_age:
+                cache.stats.incr('hits')
+                await self._archive(url, 200, entry.headers, entry.body, entry.encoding)
+                return entry.text
+            headers = entry.conditional_headers()
+        async with await self._send(session, url, headers) as resp:
+            if resp.status == 304 and entry is not None:
+                cache.stats.incr('revalidated')
+                cache.refresh(url)
+                await self._archive(url, 200, entry.headers, entry.body, entry.encoding)
+                return entry.text
+            if resp.status >= 400:
+                await self._archive(url, resp.status, resp.headers, await resp.read(), None)
+            resp.raise_for_status()
+            started = time.perf_counter()
+            body = await resp.read()
+            record_transfer(url, time.perf_counter() - started, len(body))
+            encoding = resp.get_encoding()
+        await self._archive(url, 200, resp.headers, body, encoding)
+        if cache is None:
+            return body.decode(encoding, errors='replace')
+        cache.stats.incr('misses')
+        # Compressing and writing the body takes longer than receiving it, keep it off the event loop (zlib
+        # releases the GIL, so stores in the executor run in parallel)
+        stored = await loop.run_in_executor(None, cache.store, url, body, resp.headers, encoding)
+        return stored.text
+
+    @staticmethod
+    async def _archive(url: str, status: int, headers, body: bytes, encoding: Optional[str]):
+        if ARCHIVE_RECORD:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, PageArchive().record, url, status, dict(headers), body, encoding)
+
+    @staticmethod
+    async def replay(url: str, extractor: Extractor) -> Any:
+        """
+        Extract from the archived copy of a page, in the archive's process pool
+        :param url: URL
+        :param extractor: Callback taking (url, html), or an ExtractSpec
+        :return: Extracted value, the archived error of a page that failed when it was recorded is raised
+        """
+        archive = PageArchive()
+        entry = archive.locate(url)
+        if entry is None:
+            Metrics().incr("archive_pages_total", outcome="missing")
+            raise NotArchived(f"{url} is not in {archive.path}")
+        if entry.status >= 400:
+            request_info = aiohttp.RequestInfo(URL(url), "GET", CIMultiDictProxy(CIMultiDict()), URL(url))
+            raise aiohttp.ClientResponseError(request_info, (), status=entry.status, message="archived")
+        Metrics().incr("archive_pages_total", outcome="replayed")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(archive.executor(extractor), extract_archived, archive.path, entry.offset,
+                                          entry.length, url, extractor)
+
+    async def stream_extract(self, session: aiohttp.ClientSession, url: str, spec: ExtractSpec) -> List[str]:
+        """
+        Stream a page into an incremental parser, dropping the connection once the spec's region has been read or
+        max_bytes have arrived
+        :param session: Open aiohttp session
+        :param url: URL
+        :param spec: What to extract
+        :return: Extracted values
+        """
+        loop = asyncio.get_running_loop()
+        vary = stream_cache_vary(spec)
+        cache = ResponseCache() if HTTP_CACHE_ENABLED else None
+        entry = cache.lookup(url, vary) if cache is not None else None
+        headers = {}
+        if entry is not None:
+            if entry.age() < self.max_age:
+                cache.stats.incr('hits')
+                return await loop.run_in_executor(None, extract, entry.text, spec)
+            headers = entry.conditional_headers()
+        async with await self._send(session, url, headers) as resp:
+            if resp.status == 304 and entry is not None:
+                cache.stats.incr('revalidated')
+                cache.refresh(url, vary)
+                return await loop.run_in_executor(None, extract, entry.text, spec)
+            resp.raise_for_status()
+            encoding = resp.charset or 'utf-8'
+            page = StreamedPage(spec, encoding, self.max_bytes, keep_body=cache is not None)
+            page.complete = True
+            async for chunk in resp.content.iter_chunked(HTTP_STREAM_CHUNK_SIZE):
+                if not page.feed(chunk):
+                    page.complete = False
+                    # An unread body can't be reused, close the connection rather than drain it
+                    resp.close()
+                    break
+            values = page.finish(url, resp.headers, self.name)
+        if cache is not None:
+            cache.stats.incr('misses')
+            if page.cacheable(resp.headers, self.max_age):
+                await loop.run_in_executor(None, cache.store, url, bytes(page.body), resp.headers, encoding, vary)
+        return values
+
+    async def _crawl_one(self, session: aiohttp.ClientSession, url: str, extractor: Extractor) -> CrawlResult:
+        try:
+            if ARCHIVE_REPLAY:
+                return CrawlResult(url, value=await self.replay(url, extractor))
+            if isinstance(extractor, ExtractSpec) and not ARCHIVE_RECORD:
+                return CrawlResult(url, value=await self.stream_extract(session, url, extractor))
+            # Recording reads every page whole, the archive has no use for a page cut short
+            text = await self.fetch(session, url)
+            # Parsing is CPU bound, keep it off the event loop so other fetches keep progressing
+            loop = asyncio.get_running_loop()
+            value = await loop.run_in_executor(None, apply_extractor, extractor, url, text)
+            return CrawlResult(url, value=value)
+        except Exception as e:
+            if is_not_found(e):
+                logging.debug(f"{url} not found")
+            else:
+                logging.warning(f"Failed to crawl {url}: {e}")
+            return CrawlResult(url, error=e)
+
+    async def _crawl_chain(self, session: aiohttp.ClientSession, url: str, extractor: Extractor,
+                           follow: Follow) -> List[CrawlResult]:
+        results = []
+        while url is not None:
+            result = await self._crawl_one(session, url, extractor)
+            results.append(result)
+            url = follow(url, result.value) if result.ok else None
+        return results
+
+    def _session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight, limit_per_host=self.max_per_host)
+        return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+                                     trace_configs=[_trace_config()])
+
+    async def crawl_async(self, urls: Iterable[str], extractor: Extractor) -> Dict[str, CrawlResult]:
+        """
+        Crawl every URL and run the extractor on each page
+        :param urls: URLs to crawl, duplicates are only fetched once
+        :param extractor: Callback taking (url, html), or an ExtractSpec to stream each page and get its values
+        :return: CrawlResult per URL, in the order the URLs were given
+        """
+        urls = list(dict.fromkeys(urls))
+        async with self._session() as session:
+            results = await asyncio.gather(*(self._crawl_one(session, url, extractor) for url in urls))
+        return {result.url: result for result in results}
+
+    async def crawl_each_async(self, urls: Iterable[str], extractor: Extractor,
+                               callback: Callable[[CrawlResult], None]) -> int:
+        """
+        Crawl every URL, handing each CrawlResult to the callback as soon as it is ready instead of collecting them,
+        for crawls too large to hold every page's value at once. URLs are read lazily, at most twice max_in_flight
+        crawls are scheduled at a time.
+        :param urls: URLs to crawl, duplicates are only fetched once
+        :param extractor: Callback taking (url, html), or an ExtractSpec
+        :param callback: Called on the event loop with each CrawlResult, in completion order
+        :return: Number of URLs crawled
+        """
+        seen = set()
+        pending = set()
+        crawled = 0
+        async with self._session() as session:
+            for url in urls:
+                if url in seen:
+                    continue
+                seen.add(url)
+                pending.add(asyncio.ensure_future(self._crawl_one(session, url, extractor)))
+                if len(pending) < 2 * self.max_in_flight:
+                    continue
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    callback(task.result())
+                crawled += len(done)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    callback(task.result())
+                crawled += len(done)
+        return crawled
+
+    async def crawl_chains_async(self, urls: Iterable[str], extractor: Extractor,
+                                 follow: Follow) -> Dict[str, List[CrawlResult]]:
+        """
+        Crawl chains of pages, e.g. the pages of paginated listings. Pages within a chain are fetched one after the
+        other, chains are crawled concurrently. A chain ends when follow returns None or a page fails.
+        :param urls: First URL of each chain, duplicates are only crawled once
+        :param extractor: Callback taking (url, html), or an ExtractSpec
+        :param follow: Callback taking (url, value) of the page just crawled, returns the next URL or None
+        :return: CrawlResults of each chain in page order, keyed by the chain's first URL
+        """
+        urls = list(dict.fromkeys(urls))
+        async with self._session() as session:
+            chains = await asyncio.gather(*(self._crawl_chain(session, url, extractor, follow) for url in urls))
+        return dict(zip(urls, chains))
+
+    def crawl(self, urls: Iterable[str], extractor: Extractor) -> Dict[str, CrawlResult]:
+        """Blocking wrapper around crawl_async"""
+        results = asyncio.run(self.crawl_async(urls, extractor))
+        failed = [result for result in results.values() if not result.ok]
+        logging.info(f"Crawled {len(results)} pages, {len(failed)} failed")
+        return results
+
+    def crawl_each(self, urls: Iterable[str], extractor: Extractor, callback: Callable[[CrawlResult], None]) -> int:
+        """Blocking wrapper around crawl_each_async"""
+        failed = 0
+
+        def count(result: CrawlResult):
+            nonlocal failed
+            failed += not result.ok
+            callback(result)
+
+        crawled = asyncio.run(self.crawl_each_async(urls, extractor, count))
+        logging.info(f"Crawled {crawled} pages, {failed} failed")
+        return crawled
+
+    def crawl_chains(self, urls: Iterable[str], extractor: Extractor, follow: Follow) -> Dict[str, List[CrawlResult]]:
+        """Blocking wrapper around crawl_chains_async"""
+        chains = asyncio.run(self.crawl_chains_async(urls, extractor, follow))
+        pages = sum(len(chain) for chain in chains.values())
+        failed = sum(1 for chain in chains.values() for result in chain
+                     if not result.ok and not is_not_found(result.error))
+        logging.info(f"Crawled {pages} pages in {len(chains)} chains, {failed} failed")
+        return chains
@@ -0,0 +1,146 @@
+"""
+ In-memory index of food names for matching parser output against an existing food catalogue.
+
+ Names are normalized (case, punctuation, whitespace, plurals) so "Tomatoes" and "tomato" are the same food, and
+ names that still differ are compared by the Jaccard similarity of their character trigrams, which catches spelling
+ variants such as "chilli" and "chili" or "spring onion" and "spring onions, sliced".
+
+ Nearest-match lookups don't scan the catalogue: trigrams map to the foods containing them, and a food at least
+ `threshold` similar to the query must share one of the query's |q| - ceil(threshold * |q|) + 1 rarest trigrams
+ (prefix filtering), so only the foods in those few, short posting lists are scored.
+
+    index = FoodIndex(get_current_food_names())
+    index.match("Tomatoes")          # "tomato" if the catalogue has it
+    index.nearest("chilli flake")    # ("Chili Flakes", 0.8), a proposal for someone to check
+    index.match("chilli flake")      # None, only FOOD_AUTO_RESOLVE_THRESHOLD similar foods are matched
+"""
+import os
+import re
+import math
+
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# Lowest similarity at which an indexed food is proposed as a match, a person has to confirm it
+FOOD_MATCH_THRESHOLD = float(os.getenv("FOOD_MATCH_THRESHOLD", 0.6))
+# Similarity at which a food is taken to be the indexed one without asking, "white wine vinegar" is only 0.61
+# similar to "white wine" and "olive" 0.6 to "olive oil"
+FOOD_AUTO_RESOLVE_THRESHOLD = float(os.getenv("FOOD_AUTO_RESOLVE_THRESHOLD", 0.9))
+
+_WORD = re.compile(r"[^\W_]+")
+# Endings dropped by singular(), longest first, a plain "s" is handled after them
+_PLURAL_ENDINGS = (("ies", "y"), ("oes", "o"), ("ches", "ch"), ("shes", "sh"), ("xes", "x"), ("zes", "z"))
+_NOT_PLURAL = ("ss", "us", "is")
+
+
+def singular(word: str) -> str:
+    """Rough English singular, only has to turn both spellings of a food into the same string"""
+    if len(word) <= 3 or word.endswith(_NOT_PLURAL):
+        return word
+    for ending, replacement in _PLURAL_ENDINGS:
+        if word.endswith(ending):
+            return word[:-len(ending)] + replacement
+    return word[:-1] if word.endswith("s") else word
+
+
+def normalize_food_name(name: str) -> str:
+    """Lowercase singular words separated by single spaces, punctuation dropped"""
+    return " ".join(singular(word) for word in _WORD.findall(name.lower()))
+
+
+def trigrams(normalized: str) -> Set[str]:
+    """Character trigrams, padded so the start and end of the name weigh as much as its middle"""
+    padded = f"  {normalized} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def similarity(a: Set[str], b: Set[str]) -> float:
+    """Jaccard similarity of two trigram sets"""
+    if not a or not b:
+        return 0.0
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared)
+
+
+class FoodIndex:
+    """
+    Food names indexed for exact (normalized) and nearest trigram matches
+
+    Args:
+        names (Iterable[str], optional): Names to index, e.g. the foods already in Mealie
+    """
+
+    def __init__(self, names: Iterable[str] = ()):
+        self.names: List[str] = []
+        self.grams: List[Set[str]] = []
+        self.exact: Dict[str, int] = {}
+        self.postings: Dict[str, List[int]] = {}
+        self.update(names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, name: str) -> bool:
+        return normalize_food_name(name) in self.exact
+
+    def add(self, name: str) -> bool:
+        """
+        Index a name
+        :param name: Food name
+        :return: False if an equal name (once normalized) is already indexed
+        """
+        normalized = normalize_food_name(name)
+        if not normalized or normalized in self.exact:
+            return False
+        food_id = len(self.names)
+        self.names.append(name)
+        grams = trigrams(normalized)
+        self.grams.append(grams)
+        self.exact[normalized] = food_id
+        for gram in grams:
+            self.postings.setdefault(gram, []).append(food_id)
+        return True
+
+    def update(self, names: Iterable[str]):
+        for name in names:
+            self.add(name)
+
+    def nearest(self, name: str, threshold: float = FOOD_MATCH_THRESHOLD) -> Optional[Tuple[str, float]]:
+        """
+        Most similar indexed name
+        :param name: Food name to look up
+        :param threshold: Lowest similarity (0 to 1) worth returning, must be above 0
+        :return: (indexed name, similarity), None if nothing is at least threshold similar
+        """
+        normalized = normalize_food_name(name)
+        food_id = self.exact.get(normalized)
+        if food_id is not None:
+            return self.names[food_id], 1.0
+        query = trigrams(normalized) if normalized else set()
+        if not query:
+            return None
+        # Any match shares at least ceil(threshold * |q|) trigrams with the query, so at least one of any
+        # |q| - that + 1 of them, probing the rarest keeps the candidates few
+        probes = len(query) - math.ceil(threshold * len(query)) + 1
+        rarest = sorted(query, key=lambda gram: len(self.postings.get(gram, ())))[:probes]
+        smallest, largest = threshold * len(query), len(query) / threshold
+        best = None
+        seen = set()
+        for gram in rarest:
+            for food_id in self.postings.get(gram, ()):
+                if food_id in seen:
+                    continue
+                seen.add(food_id)
+                grams = self.grams[food_id]
+                if not smallest <= len(grams) <= largest:
+                    continue
+                score = similarity(query, grams)
+                if score >= threshold and (best is None or score > best[1]):
+                    best = (food_id, score)
+        if best is None:
+            return None
+        return self.names[best[0]], best[1]
+
+    def match(self, name: str, threshold: float = FOOD_AUTO_RESOLVE_THRESHOLD) -> Optional[str]:
+        """The indexed name a food resolves to without a person checking it, None if there is none"""
+        nearest = self.nearest(name, threshold)
+        return nearest[0] if nearest is not None else None
@@ -0,0 +1,245 @@
+"""
+ URL frontier shared by the crawling scrapers: a thread safe, insertion ordered set of discovered URLs.
+
+ URLs are canonicalized (see canonical_url) and deduplicated with a hash lookup, so adding is O(1) however many
+ categories link to the same recipe. Each URL is stored once and the sources linking to it are kept as interned
+ integer ids, so a recipe listed in ten categories costs ten small ints rather than ten copies of its URL.
+
+ The frontier is saved under ./.cache/frontiers between runs, URLs found by earlier runs are recognised as known
+ straight away. For very large crawls a Bloom filter can stand in for the saved URLs: earlier runs are then only
+ remembered approximately (a small false positive rate) and their URLs aren't loaded back into memory.
+"""
+import os
+import json
+import math
+import hashlib
+import logging
+import threading
+import urllib.parse as urlparse
+
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from utils.http_cache import normalize_url
+
+FRONTIER_DIRECTORY = os.getenv("FRONTIER_DIRECTORY", "./.cache/frontiers")
+# 0 keeps earlier runs' URLs exactly, anything else is the capacity of the Bloom filter used instead
+FRONTIER_BLOOM_CAPACITY = int(os.getenv("FRONTIER_BLOOM_CAPACITY", 0))
+FRONTIER_BLOOM_ERROR_RATE = float(os.getenv("FRONTIER_BLOOM_ERROR_RATE", 0.001))
+
+# Query parameters that only track where a click came from
+_TRACKING_PARAMS = ('utm_', 'fbclid', 'gclid', 'mc_cid', 'mc_eid')
+
+
+def canonical_url(url: str) -> str:
+    """
+    Canonical form of a URL used for deduplication
+    :param url: URL
+    :return: normalize_url() form without tracking parameters
+    """
+    parts = urlparse.urlsplit(normalize_url(url))
+    if not parts.query:
+        return urlparse.urlunsplit(parts)
+    query = [(k, v) for k, v in urlparse.parse_qsl(parts.query, keep_blank_values=True)
+             if not k.lower().startswith(_TRACKING_PARAMS)]
+    return urlparse.urlunsplit(parts._replace(query=urlparse.urlencode(query)))
+
+
+class BloomFilter:
+    """
+    Fixed size Bloom filter over strings, sized for a capacity and false positive rate
+    """
+
+    def __init__(self, capacity: int, error_rate: float = FRONTIER_BLOOM_ERROR_RATE, bits: bytearray = None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bits if bits is not None else bytearray((self.size + 7) // 8)
+
+    def _positions(self, value: str) -> Iterator[int]:
+        # Double hashing, two 64 bit halves of one digest give every position
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, value: str):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+    def save(self, path: str):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(json.dumps({'capacity': self.capacity, 'error_rate': self.error_rate}).encode() + b"\n")
+            f.write(self.bits)
+        f.close()
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BloomFilter":
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            bits = bytearray(f.read())
+        f.close()
+        return cls(header['capacity'], header['error_rate'], bits)
+
+
+class Frontier:
+    """
+    Thread safe insertion ordered set of canonical URLs, with the sources that link to each one
+
+    Args:
+        name (str): Name the frontier is saved under, e.g. "recipetineats"
+        bloom_capacity (int, optional): Remember earlier runs in a Bloom filter sized for this many URLs instead of
+            loading their URLs back, for crawls too large to keep every URL in memory
+        directory (str, optional): Where frontiers are saved
+    """
+
+    def __init__(self, name: str, bloom_capacity: int = FRONTIER_BLOOM_CAPACITY, directory: str = FRONTIER_DIRECTORY):
+        self.name = name
+        self.lock = threading.Lock()
+        self.path = os.path.join(directory, f"{name}.jsonl")
+        self.bloom_path = os.path.join(directory, f"{name}.bloom")
+        self._urls: List[str] = []
+        self._ids: Dict[str, int] = {}
+        self._sources: List[str] = []
+        self._source_ids: Dict[str, int] = {}
+        self._sources_of: List[List[int]] = []
+        self._by_source: List[List[int]] = []
+        # URL ids below this were loaded from earlier runs
+        self._known = 0
+        self.bloom = None
+        os.makedirs(directory, exist_ok=True)
+        if bloom_capacity:
+            self.bloom = BloomFilter.load(self.bloom_path) if os.path.exists(self.bloom_path) \
+                else BloomFilter(bloom_capacity)
+        else:
+            self._load()
+
+    def _source_id(self, source: str) -> int:
+        source_id = self._source_ids.get(source)
+        if source_id is None:
+            source_id = self._source_ids[source] = len(self._sources)
+            self._sources.append(source)
+            self._by_source.append([])
+        return source_id
+
+    def _add(self, url: str, source_id: Optional[int]) -> bool:
+        url_id = self._ids.get(url)
+        is_new = url_id is None
+        if is_new:
+            url_id = self._ids[url] = len(self._urls)
+            self._urls.append(url)
+            self._sources_of.append([])
+        if source_id is not None and source_id not in self._sources_of[url_id]:
+            self._sources_of[url_id].append(source_id)
+            self._by_source[source_id].append(url_id)
+        return is_new
+
+    def add(self, url: str, source: Optional[str] = None) -> bool:
+        """
+        Add a URL
+        :param url: URL, canonicalized before it is stored
+        :param source: Page (or any label) the URL was found on
+        :return: True if the URL wasn't in the frontier yet
+        """
+        return bool(self.add_many([url], source))
+
+    def add_many(self, urls: Iterable[str], source: Optional[str] = None) -> List[str]:
+        """
+        Add several URLs found on the same source
+        :param urls: URLs
+        :param source: Page (or any label) the URLs were found on
+        :return: Canonical URLs that weren't in the frontier yet, in the order given
+        """
+        canonical = [canonical_url(url) for url in urls]
+        with self.lock:
+            source_id = self._source_id(source) if source is not None else None
+            return [url for url in canonical if self._add(url, source_id)]
+
+    def is_known(self, url: str) -> bool:
+        """True if an earlier run already found the URL"""
+        url = canonical_url(url)
+        with self.lock:
+            if self.bloom is not None:
+                return url in self.bloom
+            url_id = self._ids.get(url)
+            return url_id is not None and url_id < self._known
+
+    def __contains__(self, url: str) -> bool:
+        url = canonical_url(url)
+        with self.lock:
+            return url in self._ids or (self.bloom is not None and url in self.bloom)
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self._urls)
+
+    def __iter__(self) -> Iterator[str]:
+        with self.lock:
+            return iter(list(self._urls))
+
+    def urls_from(self, source: str) -> List[str]:
+        """URLs found on a source, in the order they were first found there"""
+        with self.lock:
+            source_id = self._source_ids.get(source)
+            if source_id is None:
+                return []
+            return [self._urls[url_id] for url_id in self._by_source[source_id]]
+
+    def sources_of(self, url: str) -> List[str]:
+        """Sources a URL was found on"""
+        with self.lock:
+            url_id = self._ids.get(canonical_url(url))
+            if url_id is None:
+                return []
+            return [self._sources[source_id] for source_id in self._sources_of[url_id]]
+
+    def sources(self) -> List[str]:
+        with self.lock:
+            return list(self._sources)
+
+    @property
+    def new_count(self) -> int:
+        """URLs first found by this run"""
+        with self.lock:
+            if self.bloom is not None:
+                return sum(1 for url in self._urls if url not in self.bloom)
+            return len(self._urls) - self._known
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as f:
+            self._sources = json.loads(f.readline())['sources']
+            self._source_ids = {source: i for i, source in enumerate(self._sources)}
+            self._by_source = [[] for _ in self._sources]
+            for line in f:
+                url, source_ids = json.loads(line)
+                self._add(url, None)
+                for source_id in source_ids:
+                    self._add(url, source_id)
+        f.close()
+        self._known = len(self._urls)
+        logging.debug(f"Loaded frontier {self.name}: {self._known} URLs from {len(self._sources)} sources")
+
+    def save(self):
+        """Save the frontier so the next run recognises these URLs"""
+        with self.lock:
+            if self.bloom is not None:
+                for url in self._urls:
+                    self.bloom.add(url)
+                self.bloom.save(self.bloom_path)
+                return
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(json.dumps({'sources': self._sources}) + "\n")
+                for url, source_ids in zip(self._urls, self._sources_of):
+                    f.write(json.dumps([url, source_ids]) + "\n")
+            f.close()
+            os.replace(tmp_path, self.path)
+        logging.debug(f"Saved frontier {self.name}: {len(self._urls)} URLs")
@@ -0,0 +1,217 @@
+"""
+ Persistent HTTP response cache stored under ./.cache, shared by get_webpage, the Mealie GET helpers and the crawler.
+
+ Bodies are stored zlib compressed in SQLite, keyed by the normalized URL. Entries younger than the caller's max_age
+ are served without touching the network, older entries are revalidated with If-None-Match/If-Modified-Since so an
+ unchanged page only costs a 304. The total stored size is capped and the least recently used entries are evicted.
+"""
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import logging
+import threading
+import urllib.parse as urlparse
+
+from typing import Dict, Mapping, Optional
+
+HTTP_CACHE_ENABLED = os.getenv("HTTP_CACHE_ENABLED", "1") not in ("0", "false", "False")
+HTTP_CACHE_PATH = os.getenv("HTTP_CACHE_PATH", "./.cache/http.sqlite")
+HTTP_CACHE_MAX_BYTES = int(os.getenv("HTTP_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url: str) -> str:
+    """
+    Normalize a URL so equivalent spellings share a cache entry
+    :param url: URL
+    :return: URL with a lower case scheme/host, no default port, no fragment and sorted query parameters
+    """
+    parts = urlparse.urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != _DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    path = parts.path or "/"
+    query = urlparse.urlencode(sorted(urlparse.parse_qsl(parts.query, keep_blank_values=True)))
+    return urlparse.urlunsplit((scheme, host, path, query, ""))
+
+
+class CachedResponse:
+    """A response body and the validators needed to revalidate it"""
+
+    def __init__(self, url: str, body: bytes, headers: Mapping[str, str], encoding: Optional[str],
+                 stored_at: float):
+        self.url = url
+        self.body = body
+        self.headers = dict(headers)
+        self.encoding = encoding
+        self.stored_at = stored_at
+
+    @property
+    def text(self) -> str:
+        return self.body.decode(self.encoding or 'utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.body)
+
+    def age(self) -> float:
+        return time.time() - self.stored_at
+
+    def conditional_headers(self) -> Dict[str, str]:
+        headers = {}
+        if self.headers.get('etag'):
+            headers['If-None-Match'] = self.headers['etag']
+        if self.headers.get('last-modified'):
+            headers['If-Modified-Since'] = self.headers['last-modified']
+        return headers
+
+
+class CacheStats:
+    """Counters for how requests were served"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'misses': 0, 'revalidated': 0, 'stored': 0, 'evicted': 0}
+
+    def incr(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def as_dict(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.counts)
+
+
+class ResponseCache:
+    """Singleton on-disk response cache"""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = super(ResponseCache, cls).__new__(cls)
+                cls._instance.path = HTTP_CACHE_PATH
+                cls._instance.max_bytes = HTTP_CACHE_MAX_BYTES
+                cls._instance.stats = CacheStats()
+                cls._instance._local = threading.local()
+                cls._instance._evict_lock = threading.Lock()
+                cls._instance._size_estimate = None
+                cls._instance._init_db()
+        return cls._instance
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        """SQLite connection for the current thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                headers TEXT NOT NULL,
+                encoding TEXT,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+
+    @staticmethod
+    def key(url: str, vary: str = "") -> str:
+        """
+        Cache key for a URL
+        :param url: URL
+        :param vary: Extra value the response depends on, e.g. the bearer token of an API call
+        :return: Key
+        """
+        key = normalize_url(url)
+        if vary:
+            key += "#" + hashlib.sha256(vary.encode()).hexdigest()[:16]
+        return key
+
+    def lookup(self, url: str, vary: str = "") -> Optional[CachedResponse]:
+        """
+        Get the stored response for a URL, if any
+        :param url: URL
+        :param vary: See key()
+        :return: CachedResponse or None
+        """
+        key = self.key(url, vary)
+        row = self.db.execute("SELECT url, headers, encoding, body, stored_at FROM responses WHERE key = ?",
+                              (key,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        return CachedResponse(row[0], zlib.decompress(row[3]), json.loads(row[1]), row[2], row[4])
+
+    def store(self, url: str, body: bytes, headers: Mapping[str, str], encoding: Optional[str],
+              vary: str = "") -> CachedResponse:
+        """
+        Store a response body
+        :param url: URL
+        :param body: Raw body
+        :param headers: Response headers, only the validators are kept
+        :param encoding: Text encoding of the body
+        :param vary: See key()
+        :return: CachedResponse for the stored body
+        """
+        lowered = {k.lower(): v for k, v in headers.items()}
+        kept = {name: lowered[name] for name in ('etag', 'last-modified', 'content-type') if name in lowered}
+        compressed = zlib.compress(body, 6)
+        now = time.time()
+        self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (self.key(url, vary), url, json.dumps(kept), encoding, compressed, len(compressed), now, now))
+        self.stats.incr('stored')
+        self._evict(len(compressed))
+        return CachedResponse(url, body, kept, encoding, now)
+
+    def refresh(self, url: str, vary: str = ""):
+        """Mark a stored response as fresh again after a 304"""
+        now = time.time()
+        self.db.execute("UPDATE responses SET stored_at = ?, accessed_at = ? WHERE key = ?",
+                        (now, now, self.key(url, vary)))
+
+    def total_size(self) -> int:
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def _evict(self, added: int):
+        with self._evict_lock:
+            # Summing the sizes scans the whole table, only do it once the running estimate (which ignores replaced
+            # entries and other processes' writes) says the cap may have been passed
+            if self._size_estimate is not None:
+                self._size_estimate += added
+                if self._size_estimate <= self.max_bytes:
+                    return
+            self._size_estimate = self.total_size()
+            excess = self._size_estimate - self.max_bytes
+            if excess <= 0:
+                return
+            evicted = 0
+            for key, size in self.db.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall():
+                if excess <= 0:
+                    break
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                excess -= size
+                self._size_estimate -= size
+                evicted += 1
+            self.stats.incr('evicted', evicted)
+            logging.debug(f"Evicted {evicted} responses from the HTTP cache")
+
+    def clear(self):
+        self.db.execute("DELETE FROM responses")
+        self._size_estimate = None
@@ -0,0 +1,153 @@
+"""
+ Write-ahead journal for bulk writes, so an interrupted run can resume exactly where it stopped.
+
+ Every item is recorded as pending before any request for it is sent and as done once the server accepted it (or
+ reported that it already exists). The journal is an append-only JSONL file under ./.cache/journals, replaying it
+ gives the latest state of every item.
+"""
+import os
+import json
+import time
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterable, List, Optional
+
+import requests
+import tqdm
+
+from utils.ratelimit import TokenBucket, jittered_backoff
+
+JOURNAL_DIRECTORY = "./.cache/journals"
+JOURNAL_BACKOFF_FACTOR = 1.0
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+
+class Journal:
+    """Append-only record of the state of each item in a bulk write"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.path = os.path.join(JOURNAL_DIRECTORY, f"{name}.jsonl")
+        self.lock = threading.Lock()
+        self.states = {}
+        os.makedirs(JOURNAL_DIRECTORY, exist_ok=True)
+        self._replay()
+        self.file = open(self.path, "a")
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash mid-write can leave a partial last line
+                    continue
+                self.states[record['key']] = record['state']
+        f.close()
+        logging.debug(f"Replayed journal {self.name}: {len(self.states)} items")
+
+    def mark(self, key: str, state: str):
+        with self.lock:
+            self.states[key] = state
+            self.file.write(json.dumps({'key': key, 'state': state, 'at': time.time()}) + "\n")
+            self.file.flush()
+
+    def begin(self, keys: Iterable[str]) -> List[str]:
+        """Record new keys as pending, keys that are already done are skipped. Returns the keys still to write."""
+        todo = []
+        with self.lock:
+            for key in keys:
+                if self.states.get(key) == DONE:
+                    continue
+                if self.states.get(key) != PENDING:
+                    self.states[key] = PENDING
+                    self.file.write(json.dumps({'key': key, 'state': PENDING, 'at': time.time()}) + "\n")
+                todo.append(key)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        return todo
+
+    def with_state(self, state: str) -> List[str]:
+        with self.lock:
+            return [key for key, value in self.states.items() if value == state]
+
+    def compact(self):
+        """Rewrite the journal with only the latest state of each item"""
+        with self.lock:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                for key, state in self.states.items():
+                    f.write(json.dumps({'key': key, 'state': state}) + "\n")
+            f.close()
+            self.file.close()
+            os.replace(tmp_path, self.path)
+            self.file = open(self.path, "a")
+
+    def close(self):
+        self.file.close()
+
+
+def run_journaled(journal: Journal, keys: Iterable[str], write: Callable[[str], object], max_workers: int = 4,
+                  rate: Optional[float] = None, is_conflict: Callable[[requests.HTTPError], bool] = None,
+                  max_attempts: int = 5, desc: str = "Writing") -> Dict[str, str]:
+    """
+    Write every key that isn't already done, with bounded concurrency and an optional rate limit.
+    Throttling (429/503 with Retry-After) is handled by HTTPClient, which holds every request to the host. Connection
+    errors and read timeouts, which it doesn't retry for POSTs, are retried here with backoff: is_conflict makes
+    resending a write that did reach the server safe. Responses matched by is_conflict count as done, any other
+    error response fails the key.
+    :param journal: Journal to record progress in
+    :param keys: Keys to write, pending keys from an earlier run should be included to resume them
+    :param write: Function performing the write for one key
+    :param max_workers: Writes in flight
+    :param rate: Maximum writes per second
+    :param is_conflict: Returns True when an error means the item already exists
+    :param max_attempts: Attempts per key before it is marked failed
+    :param desc: Progress bar description
+    :return: Final state per key
+    """
+    todo = journal.begin(keys)
+    bucket = TokenBucket(rate, burst=max_workers) if rate else None
+
+    def write_one(key):
+        for attempt in range(max_attempts):
+            if bucket is not None:
+                bucket.acquire()
+            try:
+                write(key)
+                return DONE
+            except requests.HTTPError as e:
+                if is_conflict is not None and is_conflict(e):
+                    logging.debug(f"{key} already exists")
+                    return DONE
+                # HTTPClient already retried throttled responses
+                logging.error(f"Failed to write {key}: {e}")
+                return FAILED
+            except requests.RequestException as e:
+                # HTTPClient retries connect timeouts itself, retrying them here would multiply its attempts
+                if isinstance(e, requests.ConnectTimeout) or attempt + 1 >= max_attempts:
+                    logging.error(f"Failed to write {key}: {e}")
+                    return FAILED
+                logging.warning(f"Retrying {key} after {type(e).__name__}: {e}")
+                time.sleep(jittered_backoff(attempt, JOURNAL_BACKOFF_FACTOR))
+        return FAILED
+
+    results = {}
+    with ThreadPoolExecutor(max_workers) as executor:
+        futures = {executor.submit(write_one, key): key for key in todo}
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures), desc=desc):
+            key = futures[future]
+            results[key] = future.result()
+            journal.mark(key, results[key])
+    failed = [key for key, state in results.items() if state == FAILED]
+    logging.info(f"Wrote {len(results) - len(failed)} items, {len(failed)} failed")
+    if not journal.with_state(PENDING):
+        journal.compact()
+    return results
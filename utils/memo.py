@@ -0,0 +1,193 @@
+"""
+ Persistent memo tables for expensive, deterministic lookups (e.g. NLP ingredient parsing).
+
+ Every memo has a name and a version. Opening a memo with a different version than the one stored drops the old
+ entries, so upgrading the thing being memoized invalidates it. Entries are evicted least recently used first once
+ a memo holds more than max_entries. Memos can be exported to and imported from JSONL to share a warm memo
+ between installs:
+
+    python -m utils.memo export mealie-parser-nlp memo.jsonl
+    python -m utils.memo import memo.jsonl
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+from typing import Any, Dict, Iterable, Optional
+
+MEMO_PATH = os.getenv("MEMO_PATH", "./.cache/memo.sqlite")
+MEMO_MAX_ENTRIES = int(os.getenv("MEMO_MAX_ENTRIES", 500_000))
+
+
+class Memo:
+    """A named, versioned key->value memo stored in SQLite"""
+
+    def __init__(self, name: str, version: str, path: str = MEMO_PATH, max_entries: int = MEMO_MAX_ENTRIES):
+        self.name = name
+        self.version = version
+        self.path = path
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.writes = 0
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.db.execute("CREATE TABLE IF NOT EXISTS memo_versions (name TEXT PRIMARY KEY, version TEXT NOT NULL)")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS memo (
+                name TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                accessed REAL NOT NULL,
+                PRIMARY KEY (name, key)
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS memo_accessed ON memo (name, accessed)")
+        self._check_version()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def _check_version(self):
+        row = self.db.execute("SELECT version FROM memo_versions WHERE name = ?", (self.name,)).fetchone()
+        if row is not None and row[0] == self.version:
+            return
+        if row is not None:
+            removed = self.db.execute("DELETE FROM memo WHERE name = ?", (self.name,)).rowcount
+            logging.info(f"Memo {self.name} version changed {row[0]} -> {self.version}, dropped {removed} entries")
+        self.db.execute("INSERT OR REPLACE INTO memo_versions VALUES (?, ?)", (self.name, self.version))
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """
+        Look up several keys at once
+        :param keys: Keys
+        :return: Dict of the keys that were found
+        """
+        keys = list(keys)
+        found = {}
+        # Stay well under SQLite's bound parameter limit
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.db.execute(f"SELECT key, value FROM memo WHERE name = ? AND key IN ({placeholders})",
+                                   (self.name, *chunk)).fetchall()
+            found.update({key: json.loads(value) for key, value in rows})
+        if found:
+            now = time.time()
+            self.db.execute("BEGIN")
+            self.db.executemany("UPDATE memo SET accessed = ? WHERE name = ? AND key = ?",
+                                [(now, self.name, key) for key in found])
+            self.db.execute("COMMIT")
+        return found
+
+    def get(self, key: str) -> Any:
+        return self.get_many([key]).get(key)
+
+    def set_many(self, values: Dict[str, Any]):
+        if not values:
+            return
+        now = time.time()
+        self.db.execute("BEGIN")
+        self.db.executemany("INSERT OR REPLACE INTO memo VALUES (?, ?, ?, ?)",
+                            [(self.name, key, json.dumps(value), now) for key, value in values.items()])
+        self.db.execute("COMMIT")
+        self.writes += len(values)
+        if self.writes >= 1000:
+            self.writes = 0
+            self.evict()
+
+    def set(self, key: str, value: Any):
+        self.set_many({key: value})
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM memo WHERE name = ?", (self.name,)).fetchone()[0]
+
+    def evict(self) -> int:
+        """Drop the least recently used entries beyond max_entries"""
+        excess = len(self) - self.max_entries
+        if excess <= 0:
+            return 0
+        self.db.execute("DELETE FROM memo WHERE rowid IN (SELECT rowid FROM memo WHERE name = ? "
+                        "ORDER BY accessed LIMIT ?)", (self.name, excess))
+        logging.debug(f"Evicted {excess} entries from memo {self.name}")
+        return excess
+
+    def export(self, path: str) -> int:
+        """
+        Write the memo to a JSONL file, the first line holds the name and version
+        :param path: File to write
+        :return: Number of entries written
+        """
+        count = 0
+        with open(path, "w") as f:
+            f.write(json.dumps({'name': self.name, 'version': self.version}) + "\n")
+            for key, value in self.db.execute("SELECT key, value FROM memo WHERE name = ?", (self.name,)):
+                f.write(json.dumps({'key': key, 'value': json.loads(value)}) + "\n")
+                count += 1
+        f.close()
+        logging.info(f"Exported {count} entries from memo {self.name} to {path}")
+        return count
+
+    def import_file(self, path: str) -> int:
+        """
+        Load entries exported by another install, files for a different version are ignored
+        :param path: File written by export()
+        :return: Number of entries imported
+        """
+        with open(path, "r") as f:
+            header = json.loads(f.readline())
+            if header.get('name') != self.name or header.get('version') != self.version:
+                logging.warning(f"Skipping {path}: it holds {header.get('name')} version {header.get('version')}, "
+                                f"expected {self.name} version {self.version}")
+                return 0
+            count = 0
+            batch = {}
+            for line in f:
+                entry = json.loads(line)
+                batch[entry['key']] = entry['value']
+                if len(batch) >= 1000:
+                    self.set_many(batch)
+                    count += len(batch)
+                    batch = {}
+            self.set_many(batch)
+            count += len(batch)
+        f.close()
+        logging.info(f"Imported {count} entries into memo {self.name} from {path}")
+        return count
+
+
+def stored_version(name: str, path: str = MEMO_PATH) -> Optional[str]:
+    """Version of a memo as stored on disk, None if it doesn't exist yet"""
+    if not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(path)
+    try:
+        row = conn.execute("SELECT version FROM memo_versions WHERE name = ?", (name,)).fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    conn.close()
+    return row[0] if row is not None else None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) == 4 and sys.argv[1] == "export":
+        version = stored_version(sys.argv[2])
+        if version is None:
+            raise SystemExit(f"No memo named {sys.argv[2]} in {MEMO_PATH}")
+        Memo(sys.argv[2], version).export(sys.argv[3])
+    elif len(sys.argv) == 3 and sys.argv[1] == "import":
+        with open(sys.argv[2], "r") as header_file:
+            header = json.loads(header_file.readline())
+        # Never let an import change the version of an existing memo, mismatched files are skipped instead
+        Memo(header['name'], stored_version(header['name']) or header['version']).import_file(sys.argv[2])
+    else:
+        print(__doc__)
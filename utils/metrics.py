@@ -0,0 +1,320 @@
+"""
+ Run metrics: counters and histograms fed by hooks in the HTTP layer, the cache, the parsers and the output writers.
+
+ Every series is labelled with the scraper being run (set by the runner) and, for HTTP, the host. At the end of a
+ run the report is written to METRICS_DIRECTORY as <scraper>.json and as <scraper>.prom in the Prometheus text
+ format, ready for node_exporter's textfile collector.
+
+ profiled() wraps a scraper's main() in cProfile or in a sampling profiler that only needs the standard library:
+ a thread snapshots every thread's stack each PROFILE_INTERVAL seconds and writes them in the folded format read
+ by flamegraph.pl and speedscope.
+"""
+import os
+import io
+import sys
+import json
+import time
+import bisect
+import pstats
+import logging
+import cProfile
+import threading
+
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") not in ("0", "false", "False")
+METRICS_DIRECTORY = os.getenv("METRICS_DIRECTORY", "./metrics")
+# cprofile or sampling, empty to run without a profiler
+PROFILE = os.getenv("PROFILE", "")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.005))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+PROFILERS = ('cprofile', 'sampling')
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Fixed bucket histogram, cheap enough to observe every request"""
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q quantile, the maximum for the overflow bucket"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self) -> Dict[str, Any]:
+        cumulative, seen = {}, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            cumulative[str(bound)] = seen
+        cumulative['+Inf'] = self.count
+        return {'count': self.count, 'sum': round(self.sum, 6), 'min': self.min, 'max': self.max,
+                'mean': self.sum / self.count if self.count else None,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99),
+                'buckets': cumulative}
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Labels, le: Optional[str] = None) -> str:
+    if le is not None:
+        labels = labels + (('le', le),)
+    parts = [f'{name}="{_escape(value)}"' for name, value in labels]
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metrics:
+    """Singleton registry of every counter and histogram of the run"""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = super(Metrics, cls).__new__(cls)
+                cls._instance.lock = threading.Lock()
+                cls._instance.scraper = "default"
+                cls._instance.started = time.time()
+                cls._instance.counters: Dict[Tuple[str, Labels], float] = {}
+                cls._instance.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+                cls._instance.collectors: Dict[str, Callable[[], Dict[str, Any]]] = {}
+        return cls._instance
+
+    def begin(self, scraper: str):
+        """Start the metrics of a scraper's run, series recorded so far are dropped"""
+        with self.lock:
+            self.scraper = scraper
+            self.started = time.time()
+            self.counters.clear()
+            self.histograms.clear()
+
+    def _labels(self, labels: Dict[str, Any]) -> Labels:
+        return (('scraper', self.scraper),) + tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    def incr(self, name: str, amount: float = 1, **labels):
+        """
+        Add to a counter
+        :param name: Metric name, e.g. http_responses_total
+        :param amount: Amount added
+        :param labels: Labels besides the scraper, e.g. host="www.recipetineats.com"
+        """
+        if not METRICS_ENABLED:
+            return
+        key = (name, self._labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, buckets: Sequence[float] = LATENCY_BUCKETS, **labels):
+        """
+        Record a value in a histogram
+        :param name: Metric name, e.g. http_ttfb_seconds
+        :param value: Observed value
+        :param buckets: Bucket upper bounds, only used when the histogram is created
+        :param labels: Labels besides the scraper
+        """
+        if not METRICS_ENABLED:
+            return
+        key = (name, self._labels(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def set_counter(self, name: str, value: float, **labels):
+        """Set a counter that is kept elsewhere (see register_collector) to its current total"""
+        if not METRICS_ENABLED:
+            return
+        key = (name, self._labels(labels))
+        with self.lock:
+            self.counters[key] = value
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        """Observe the seconds spent in a with block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def register_collector(self, name: str, collect: Callable[[], Dict[str, Any]]):
+        """
+        Add a snapshot taken when the report is written, for stats that count themselves on hot paths where even
+        incr() would cost too much. The collector may also publish them with set_counter().
+        :param name: Section name in the JSON report
+        :param collect: Returns a JSON serializable dict
+        """
+        with self.lock:
+            self.collectors[name] = collect
+
+    def collect(self) -> Dict[str, Any]:
+        """Run every collector"""
+        with self.lock:
+            collectors = dict(self.collectors)
+        stats = {}
+        for name, collect in collectors.items():
+            try:
+                stats[name] = collect()
+            except Exception as e:
+                logging.warning(f"Failed to collect {name} stats: {e}")
+        return stats
+
+    def report(self) -> Dict[str, Any]:
+        stats = self.collect()
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = [dict(histogram.as_dict(), name=name, labels=dict(labels))
+                          for (name, labels), histogram in sorted(self.histograms.items())]
+        finished = time.time()
+        return {'scraper': self.scraper, 'started': self.started, 'finished': finished,
+                'duration': finished - self.started, 'counters': counters, 'histograms': histograms, 'stats': stats}
+
+    def prometheus_text(self) -> str:
+        self.collect()
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} counter")
+                    typed.add(name)
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                seen = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    seen += count
+                    lines.append(f"{name}_bucket{_format_labels(labels, str(bound))} {seen}")
+                lines.append(f"{name}_bucket{_format_labels(labels, '+Inf')} {histogram.count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, directory: str = METRICS_DIRECTORY) -> List[str]:
+        """
+        Write the run report as JSON and as Prometheus text
+        :param directory: Directory the files are written to
+        :return: Paths written
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for extension, content in (("json", json.dumps(self.report(), indent=2, default=str)),
+                                   ("prom", self.prometheus_text())):
+            path = os.path.join(directory, f"{self.scraper}.{extension}")
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+            paths.append(path)
+        logging.info(f"Metrics written to {', '.join(paths)}")
+        return paths
+
+
+class SamplingProfiler:
+    """Snapshots the stack of every thread at a fixed interval, counting identical stacks"""
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write_folded(self, path: str):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def top(self, limit: int = 15) -> List[Tuple[str, int]]:
+        """Functions most often on top of a stack (self time)"""
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return leaves.most_common(limit)
+
+
+def profiled(function: Callable[[], Any], mode: str, name: str, directory: str = METRICS_DIRECTORY) -> Any:
+    """
+    Run a function under a profiler and write its profile next to the metrics
+    :param function: Function to run, e.g. a scraper's main
+    :param mode: cprofile (writes <name>.pstats) or sampling (writes <name>.folded)
+    :param name: File name the profile is written under
+    :param directory: Directory the profile is written to
+    :return: Whatever the function returned
+    """
+    if mode not in PROFILERS:
+        raise ValueError(f"Unknown profiler {mode}, expected one of {PROFILERS}")
+    os.makedirs(directory, exist_ok=True)
+    if mode == 'cprofile':
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function)
+        finally:
+            path = os.path.join(directory, f"{name}.pstats")
+            profile.dump_stats(path)
+            summary = io.StringIO()
+            pstats.Stats(profile, stream=summary).sort_stats("cumulative").print_stats(15)
+            logging.info(f"Profile written to {path}, open it with python -m pstats\n{summary.getvalue()}")
+    profiler = SamplingProfiler()
+    profiler.start()
+    try:
+        return function()
+    finally:
+        profiler.stop()
+        path = os.path.join(directory, f"{name}.folded")
+        profiler.write_folded(path)
+        top = "\n".join(f"\t{count:>6} {function}" for function, count in profiler.top())
+        logging.info(f"{profiler.samples} samples written to {path}, most seen on top of the stack:\n{top}")
@@ -1,7 +1,52 @@
 import os
-import inspect
+import sys
+import logging
+
 
 def get_calling_filename():
-    frame = inspect.stack()[2]
-    module = inspect.getmodule(frame[0])
-    return os.path.basename(module.__file__).split(".")[0]
\ No newline at end of file
+    """
+    Name of the module that called the function calling this one, used as a namespace by Cache and outputs.
+    Kept as a fallback for callers that don't hold a namespace handle, prefer Cache().namespace(name) and
+    Outputs(name) which skip the frame lookup entirely.
+    """
+    frame = sys._getframe(2)
+    filename = frame.f_globals.get('__file__') or frame.f_code.co_filename
+    return os.path.basename(filename).split(".")[0]
+
+
+def percentiles(values, points=(50, 90, 99)) -> dict:
+    """
+    Nearest-rank percentiles of a list of numbers
+    :param values: Numbers
+    :param points: Percentiles to compute
+    :return: Dict of p<point> -> value, empty if there are no values
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return {}
+    return {f"p{point}": ordered[min(len(ordered) - 1, max(0, round(point / 100 * len(ordered)) - 1))]
+            for point in points}
+
+
+def is_interactive() -> bool:
+    """True when there is a terminal to ask questions on"""
+    return sys.stdin is not None and sys.stdin.isatty()
+
+
+def env_or_prompt(name: str, prompt, default=None) -> str:
+    """
+    Value of an environment variable, asking for it when it isn't set and a terminal is attached
+    :param name: Environment variable
+    :param prompt: Callable asking the user, e.g. lambda: pyip.inputURL("URL: ")
+    :param default: Used when running unattended, None makes the variable required
+    :return: Value
+    """
+    value = os.getenv(name)
+    if value:
+        return value
+    if is_interactive():
+        return prompt()
+    if default is None:
+        raise RuntimeError(f"{name} is not set and there is no terminal to ask for it")
+    logging.info(f"{name} is not set, using {default!r}")
+    return default
@@ -1,51 +1,318 @@
+"""
+ Output files of each scraper, under ./outputs/<scraper>.
+
+ Scrapers stream records into an OutputWriter one at a time (text lines, JSONL or CSV, optionally gzip or zstd
+ compressed). Writers fill a temp file that only replaces the real file once it is complete, so a crash never
+ leaves a truncated output behind. Append mode adds to an existing file in place (a new gzip member / zstd frame
+ when compressed) for incremental runs, so an append costs what it writes rather than the size of the file. Every file written is recorded in the scraper's manifest.json with its format
+ and record count, so consumers read one index instead of walking the directory.
+"""
 import os
-import logging
+import io
+import csv
+import gzip
 import json
+import time
+import logging
+import threading
+
+from typing import Any, Dict, Iterable, List, Optional
 
 from utils.misc import get_calling_filename
+from utils.metrics import Metrics, SIZE_BUCKETS
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 OUTPUT_DIRECTORY = "./outputs"
+# Compression used when a writer doesn't ask for one: none, gzip or zstd
+OUTPUT_COMPRESSION = os.getenv("OUTPUT_COMPRESSION", "none")
 # Check if the output directory exists, if not create it
 if not os.path.exists(OUTPUT_DIRECTORY):
     os.makedirs(OUTPUT_DIRECTORY)
 
+FORMATS = ('text', 'jsonl', 'csv')
+_EXTENSIONS = {'gzip': ".gz", 'zstd': ".zst"}
+_FORMAT_EXTENSIONS = {'.txt': 'text', '.jsonl': 'jsonl', '.csv': 'csv'}
+_MANIFEST_LOCK = threading.Lock()
+
+
+def _replace(tmp_path: str, path: str):
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class OutputWriter:
+    """
+    Streams records to an output file, use as a context manager. The file only appears (or changes) once the writer
+    is closed without an error, an exception discards everything written. Appends go straight to the existing file
+    and are discarded by truncating it back to its old size.
+
+    Args:
+        outputs (Outputs): Scraper outputs the file belongs to
+        filename (str): File name, the compression extension is added to it
+        format (str, optional): text, jsonl or csv, inferred from the file extension when omitted
+        compression (str, optional): none, gzip or zstd, defaults to OUTPUT_COMPRESSION
+        append (bool, optional): Add to the existing file instead of replacing it
+        fields (list, optional): CSV columns, taken from the first record when it is a dict
+    """
+
+    def __init__(self, outputs: "Outputs", filename: str, format: Optional[str] = None,
+                 compression: Optional[str] = None, append: bool = False, fields: Optional[List[str]] = None):
+        format = format or _FORMAT_EXTENSIONS.get(os.path.splitext(filename)[1], 'text')
+        if format not in FORMATS:
+            raise ValueError(f"Unknown output format {format}, expected one of {FORMATS}")
+        compression = compression or OUTPUT_COMPRESSION
+        if compression == 'zstd' and zstandard is None:
+            logging.warning("zstandard is not installed, falling back to gzip")
+            compression = 'gzip'
+        self.outputs = outputs
+        self.format = format
+        self.compression = compression if compression in _EXTENSIONS else 'none'
+        self.filename = filename + _EXTENSIONS.get(self.compression, "")
+        self.path = os.path.join(outputs.output_dir, self.filename)
+        self.append = append and os.path.exists(self.path)
+        self.tmp_path = self.path if self.append else f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self.appended_to = os.path.getsize(self.path) if self.append else None
+        self.fields = fields
+        self.records = outputs.manifest().get('files', {}).get(self.filename, {}).get('records', 0) \
+            if self.append else 0
+        self._csv = None
+        self.written = 0
+        self.write_seconds = 0.0
+        self._raw = None
+        self._text = None
+        os.makedirs(outputs.output_dir, exist_ok=True)
+
+    def _open(self):
+        """Open the file on the first write, until then an appending writer leaves the existing file as it is"""
+        if self._text is not None:
+            return
+        # Compressed streams can be concatenated, so appending is adding a new stream to the end of the file
+        self._raw = open(self.tmp_path, "ab")
+        if self.compression == 'gzip':
+            stream = gzip.GzipFile(fileobj=self._raw, mode="ab")
+        elif self.compression == 'zstd':
+            stream = zstandard.ZstdCompressor().stream_writer(self._raw, closefd=False)
+        else:
+            stream = self._raw
+        self._text = io.TextIOWrapper(stream, encoding="utf-8", newline="" if self.format == 'csv' else None)
+
+    def write(self, record: Any):
+        """
+        Write one record
+        :param record: A line (text), any JSON serializable value (jsonl), a dict or sequence (csv)
+        """
+        started = time.perf_counter()
+        self._open()
+        if self.format == 'text':
+            self._text.write(f"{record}\n")
+        elif self.format == 'jsonl':
+            self._text.write(json.dumps(record) + "\n")
+        else:
+            self._write_csv(record)
+        self.write_seconds += time.perf_counter() - started
+        self.records += 1
+        self.written += 1
+
+    def _write_csv(self, record):
+        if self._csv is None:
+            if self.fields is None and isinstance(record, dict):
+                self.fields = list(record)
+            if self.fields is not None:
+                self._csv = csv.DictWriter(self._text, fieldnames=self.fields, extrasaction='ignore')
+                if not self.append:
+                    self._csv.writeheader()
+            else:
+                self._csv = csv.writer(self._text)
+        if isinstance(self._csv, csv.DictWriter) and not isinstance(record, dict):
+            record = dict(zip(self.fields, record))
+        self._csv.writerow(record)
+
+    def write_text(self, text: str):
+        """
+        Write text as it is, e.g. a whole file put together by the caller, its lines count as the records
+        :param text: Text, a missing trailing newline is not added
+        """
+        started = time.perf_counter()
+        self._open()
+        self._text.write(text)
+        self.write_seconds += time.perf_counter() - started
+        lines = len(text.splitlines())
+        self.records += lines
+        self.written += lines
+
+    def write_many(self, records: Iterable[Any]) -> int:
+        count = 0
+        for record in records:
+            self.write(record)
+            count += 1
+        return count
+
+    def _close_streams(self):
+        if self._text is None:
+            if self.append:
+                return
+            # An empty output is still written
+            self._open()
+        # Closing the text wrapper closes the compressor (writing its trailer), the file itself is closed last
+        self._text.close()
+        if not self._raw.closed:
+            self._raw.close()
+
+    def close(self):
+        """Finish the file and move it into place"""
+        started = time.perf_counter()
+        self._close_streams()
+        if self.append:
+            with open(self.path, "rb") as f:
+                os.fsync(f.fileno())
+        else:
+            _replace(self.tmp_path, self.path)
+        # Serializing and compressing the records, then flushing and syncing the file
+        Metrics().observe("output_write_seconds", self.write_seconds + time.perf_counter() - started,
+                          file=self.filename)
+        Metrics().observe("output_bytes", os.path.getsize(self.path), buckets=SIZE_BUCKETS, file=self.filename)
+        Metrics().incr("output_records_total", self.written, file=self.filename)
+        self.outputs.record_file(self.filename, {
+            'format': self.format,
+            'compression': self.compression,
+            'records': self.records,
+            'bytes': os.path.getsize(self.path),
+            'updated_at': time.time()
+        })
+        logging.info(f"Output written to {self.path} ({self.records} records)")
+
+    def discard(self):
+        """Throw away everything written, the existing file is left as it was"""
+        self._close_streams()
+        if self.append:
+            os.truncate(self.path, self.appended_to)
+        else:
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            logging.error(f"Discarding {self.path}: {exc_value!r}")
+            self.discard()
+
+
+class Outputs:
+    """Output writer bound to one namespace, e.g. Outputs("recipetineats")"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.output_dir = os.path.join(OUTPUT_DIRECTORY, name)
+        self.settings_path = f"{OUTPUT_DIRECTORY}/{name}_settings.json"
+        self.manifest_path = os.path.join(self.output_dir, "manifest.json")
+
+    def writer(self, filename: str, format: Optional[str] = None, compression: Optional[str] = None,
+               append: bool = False, fields: Optional[List[str]] = None) -> OutputWriter:
+        """Open a streaming writer, see OutputWriter"""
+        return OutputWriter(self, filename, format, compression, append, fields)
+
+    def write_output(self, filename, data):
+        if len(data) <= 0:
+            logging.warning("No data to write")
+            return
+        with self.writer(filename, format='text', compression='none') as writer:
+            writer.write_text(data)
+
+    def manifest(self) -> Dict[str, Any]:
+        try:
+            with open(self.manifest_path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'scraper': self.name, 'files': {}}
+
+    def record_file(self, filename: str, entry: Dict[str, Any]):
+        """Add or update a file in the manifest"""
+        with _MANIFEST_LOCK:
+            manifest = self.manifest()
+            manifest['files'][filename] = entry
+            manifest['updated_at'] = time.time()
+            tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            _replace(tmp_path, self.manifest_path)
+
+    def files(self) -> Dict[str, Dict[str, Any]]:
+        """Files listed in the manifest, with their format, compression and record count"""
+        return self.manifest().get('files', {})
+
+    def save_settings(self, data: dict):
+        logging.debug(f"Saving settings for {self.name}: {data}")
+        tmp_path = f"{self.settings_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        _replace(tmp_path, self.settings_path)
+        logging.info(f"Settings written to {self.settings_path}")
+
+    def load_settings(self) -> dict:
+        try:
+            with open(self.settings_path, "r") as f:
+                data = json.load(f)
+            f.close()
+            logging.debug(f"Loaded settings for {self.name}: {data}")
+            return data
+        except FileNotFoundError:
+            logging.warning(f"No settings found for {self.name}")
+            return {}
+
+
+def read_records(path: str) -> Iterable[Any]:
+    """
+    Stream the records of an output file written by OutputWriter, whatever its format and compression
+    :param path: File path
+    :return: Iterator of lines (text), values (jsonl) or dicts (csv with a header)
+    """
+    if path.endswith(".gz"):
+        f = gzip.open(path, "rt", encoding="utf-8", newline="")
+        name = path[:-3]
+    elif path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError(f"zstandard is needed to read {path}")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True)
+        f = io.TextIOWrapper(reader, encoding="utf-8", newline="")
+        name = path[:-4]
+    else:
+        f = open(path, "r", encoding="utf-8", newline="")
+        name = path
+    format = _FORMAT_EXTENSIONS.get(os.path.splitext(name)[1], 'text')
+    with f:
+        if format == 'csv':
+            yield from csv.DictReader(f)
+        elif format == 'jsonl':
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for line in f:
+                yield line.rstrip("\r\n")
+
+
+# Module level helpers work out the namespace from the calling module, kept for backwards compatibility.
+
 
 def write_output(filename, data):
-    if len(data) <= 0:
-        logging.warning("No data to write")
-        return
     # Preface filename with calling filename
-    calling_filename = get_calling_filename()
-    output_dir = os.path.join(OUTPUT_DIRECTORY, calling_filename)
-    if not os.path.exists(os.path.join(output_dir)):
-        os.makedirs(output_dir)
-    filename = f"{filename}"
-    with open(f"{output_dir}/{filename}", "w") as f:
-        f.write(data)
-    f.close()
-    logging.info(f"Output written to {output_dir}/{filename}")
+    Outputs(get_calling_filename()).write_output(filename, data)
 
 
 def save_settings(data: dict):
-    logging.debug(f"Saving settings for {get_calling_filename()}: {data}")
-    settings_name = get_calling_filename() + "_settings.json"
-    with open(f"{OUTPUT_DIRECTORY}/{settings_name}", "w") as f:
-        json.dump(data, f)
-    f.close()
-    logging.info(f"Settings written to {OUTPUT_DIRECTORY}/{settings_name}")
+    Outputs(get_calling_filename()).save_settings(data)
 
 
 def load_settings():
-    settings_name = get_calling_filename() + "_settings.json"
-    try:
-        with open(f"{OUTPUT_DIRECTORY}/{settings_name}", "r") as f:
-            data = json.load(f)
-        f.close()
-        logging.debug(f"Loaded settings for {get_calling_filename()}: {data}")
-        return data
-    except FileNotFoundError:
-        logging.warning(f"No settings found for {get_calling_filename()}")
-        return {}
+    return Outputs(get_calling_filename()).load_settings()
 
 
 if __name__ == "__main__":
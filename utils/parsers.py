@@ -0,0 +1,385 @@
+"""
+ Pluggable HTML parser engines and declarative extraction specs.
+
+ Scrapers describe what they want with an ExtractSpec (a tag plus attribute filters, an optional simple selector
+ inside each match, and the attribute to return) instead of walking a full BeautifulSoup tree. Each backend only
+ materialises the matching subtrees:
+    - bs4: html.parser with a SoupStrainer, so only matching tags are built into the tree
+    - lxml: a pull parser filtered on the tag, matches are cleared as soon as they have been read
+    - selectolax: lexbor's C parser, fast enough that a full parse is cheaper than filtering in Python
+ lxml and selectolax are optional, HTML_PARSER_BACKEND=auto picks the fastest one that is installed.
+
+ StreamingExtractor applies the same specs incrementally to chunks as they arrive off the network, and reports
+ when the page region the spec cares about has ended so the download can be cut short. It runs on lxml's pull parser
+ when lxml is installed and on the much slower html.parser otherwise.
+"""
+import os
+import re
+import logging
+import html.parser
+
+from typing import Callable, Dict, List, Optional, Pattern, Union
+
+import bs4
+
+from utils.metrics import Metrics
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser as SelectolaxParser
+except ImportError:
+    try:
+        from selectolax.parser import HTMLParser as SelectolaxParser
+    except ImportError:
+        SelectolaxParser = None
+
+HTML_PARSER_BACKEND = os.getenv("HTML_PARSER_BACKEND", "auto")
+
+AttrFilter = Union[str, bool, Pattern]
+_SIMPLE_SELECTOR = re.compile(r"^([a-zA-Z][a-zA-Z0-9]*)?((?:\.[\w-]+)*)$")
+
+
+class ExtractSpec:
+    """
+    Declares what to extract from a page.
+
+    Args:
+        tag (str): Tag to match, e.g. "article"
+        attrs (dict, optional): Attribute filters, a value can be a string (exact), True (present) or a compiled
+            regex (searched), the same rules as BeautifulSoup's find_all
+        select (str, optional): Simple selector ("a", ".cls", "a.cls") for the element inside each match to read
+            from, the first one is used. The match itself is used when omitted.
+        attr (str, optional): Attribute to return, the element's text is returned when omitted
+        stop_after (str, optional): Tag whose closing marks the end of the region holding every match, e.g.
+            "main". Streaming extraction stops reading the page there, full-page backends ignore it.
+    """
+
+    def __init__(self, tag: str, attrs: Dict[str, AttrFilter] = None, select: str = None, attr: str = None,
+                 stop_after: str = None):
+        if select is not None and not _SIMPLE_SELECTOR.match(select):
+            raise ValueError(f"Only simple tag/class selectors are supported, got {select!r}")
+        self.tag = tag
+        self.attrs = attrs or {}
+        self.select = select
+        self.attr = attr
+        self.stop_after = stop_after
+        if select:
+            match = _SIMPLE_SELECTOR.match(select)
+            self.select_tag = match.group(1)
+            self.select_classes = [cls for cls in match.group(2).split(".") if cls]
+
+    def selects(self, tag: str, attrs) -> bool:
+        """Check an element against the select part of the spec"""
+        if self.select_tag and tag != self.select_tag:
+            return False
+        classes = (attrs.get('class') or "").split()
+        return all(cls in classes for cls in self.select_classes)
+
+    def matches_attrs(self, attrs) -> bool:
+        for name, expected in self.attrs.items():
+            value = attrs.get(name)
+            if expected is True:
+                if value is None:
+                    return False
+            elif isinstance(expected, str):
+                if value != expected:
+                    return False
+            elif value is None or not expected.search(value):
+                return False
+        return True
+
+    def __repr__(self):
+        return f"ExtractSpec({self.tag!r}, attrs={self.attrs!r}, select={self.select!r}, attr={self.attr!r})"
+
+
+class ParserBackend:
+    """Interface for parser engines"""
+
+    name = None
+
+    def extract(self, html: str, spec: ExtractSpec) -> List[str]:
+        """
+        Extract values matching a spec
+        :param html: Page source
+        :param spec: What to extract
+        :return: Values in document order, matches without the requested element/attribute are skipped
+        """
+        raise NotImplementedError
+
+
+class BeautifulSoupBackend(ParserBackend):
+    name = "bs4"
+
+    def __init__(self, features: str = 'html.parser'):
+        self.features = features
+
+    def extract(self, html, spec):
+        strainer = bs4.SoupStrainer(spec.tag, attrs=spec.attrs)
+        soup = bs4.BeautifulSoup(html, self.features, parse_only=strainer)
+        values = []
+        for element in soup.find_all(spec.tag, attrs=spec.attrs):
+            target = element.select_one(spec.select) if spec.select else element
+            if target is None:
+                continue
+            value = target.get(spec.attr) if spec.attr else target.get_text()
+            if value is not None:
+                values.append(value)
+        return values
+
+
+class LxmlBackend(ParserBackend):
+    name = "lxml"
+
+    @staticmethod
+    def _select(element, spec):
+        for child in element.iterdescendants():
+            if isinstance(child.tag, str) and spec.selects(child.tag, child.attrib):
+                return child
+        return None
+
+    def extract(self, html, spec):
+        parser = etree.HTMLPullParser(events=('end',), tag=spec.tag)
+        parser.feed(html)
+        values = []
+        for _, element in parser.read_events():
+            if spec.matches_attrs(element.attrib):
+                target = self._select(element, spec) if spec.select else element
+                if target is not None:
+                    value = target.get(spec.attr) if spec.attr else "".join(target.itertext())
+                    if value is not None:
+                        values.append(value)
+            element.clear(keep_tail=True)
+        parser.close()
+        return values
+
+
+class SelectolaxBackend(ParserBackend):
+    name = "selectolax"
+
+    def extract(self, html, spec):
+        tree = SelectolaxParser(html)
+        values = []
+        for node in tree.css(spec.tag):
+            if not spec.matches_attrs(node.attributes):
+                continue
+            target = node.css_first(spec.select) if spec.select else node
+            if target is None:
+                continue
+            value = target.attributes.get(spec.attr) if spec.attr else target.text()
+            if value is not None:
+                values.append(value)
+        return values
+
+
+class HTMLParserStreamingExtractor(html.parser.HTMLParser):
+    """
+    Incremental extractor, feed() it decoded chunks as they arrive and read values once done or the input ends.
+    done becomes True once the spec's stop_after element has closed, nothing after it can match.
+    """
+
+    def __init__(self, spec: ExtractSpec):
+        super().__init__(convert_charrefs=True)
+        self.spec = spec
+        self.values = []
+        self.done = False
+        self._match_depth = 0
+        self._target_found = False
+        self._target_tag = None
+        self._target_depth = 0
+        self._text = None
+        self._stop_depth = 0
+
+    def feed(self, data: str):
+        if not self.done:
+            super().feed(data)
+
+    def _begin_target(self, tag, attrs):
+        self._target_found = True
+        if self.spec.attr:
+            value = attrs.get(self.spec.attr)
+            if value is not None:
+                self.values.append(value)
+        else:
+            self._text = []
+            self._target_tag = tag
+            self._target_depth = 1
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        attrs = {name: value if value is not None else "" for name, value in attrs}
+        if tag == self.spec.stop_after:
+            self._stop_depth += 1
+        if self._match_depth:
+            if tag == self.spec.tag:
+                self._match_depth += 1
+            if self._text is not None and tag == self._target_tag:
+                self._target_depth += 1
+            elif not self._target_found and self.spec.select and self.spec.selects(tag, attrs):
+                self._begin_target(tag, attrs)
+            return
+        if tag == self.spec.tag and self.spec.matches_attrs(attrs):
+            self._match_depth = 1
+            self._target_found = False
+            if not self.spec.select:
+                self._begin_target(tag, attrs)
+
+    def handle_data(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+    def handle_endtag(self, tag):
+        if self.done:
+            return
+        if self._text is not None and tag == self._target_tag:
+            self._target_depth -= 1
+            if self._target_depth == 0:
+                self.values.append("".join(self._text))
+                self._text = None
+        if self._match_depth and tag == self.spec.tag:
+            self._match_depth -= 1
+        if tag == self.spec.stop_after and self._stop_depth:
+            self._stop_depth -= 1
+            if self._stop_depth == 0:
+                self.done = True
+
+
+class LxmlStreamingExtractor:
+    """
+    HTMLParserStreamingExtractor on lxml's pull parser, tokenizing happens in C and only the current match is kept
+    in the tree, everything else is cleared as soon as it has closed
+    """
+
+    def __init__(self, spec: ExtractSpec):
+        self.spec = spec
+        self.values = []
+        self.done = False
+        self._parser = etree.HTMLPullParser(events=('start', 'end'))
+        self._match = None
+        self._target = None
+        self._target_found = False
+        self._stop_depth = 0
+
+    def feed(self, data: str):
+        if not self.done:
+            self._parser.feed(data)
+            self._read_events()
+
+    def close(self):
+        if self.done:
+            return
+        try:
+            self._parser.close()
+        except etree.XMLSyntaxError:
+            # Nothing was fed
+            return
+        self._read_events()
+
+    def _begin_target(self, element):
+        self._target_found = True
+        if self.spec.attr:
+            value = element.get(self.spec.attr)
+            if value is not None:
+                self.values.append(value)
+        else:
+            self._target = element
+
+    def _start(self, element):
+        tag = element.tag
+        if tag == self.spec.stop_after:
+            self._stop_depth += 1
+        if self._match is not None:
+            if not self._target_found and self.spec.select and self.spec.selects(tag, element.attrib):
+                self._begin_target(element)
+        elif tag == self.spec.tag and self.spec.matches_attrs(element.attrib):
+            self._match = element
+            self._target_found = False
+            if not self.spec.select:
+                self._begin_target(element)
+
+    def _end(self, element):
+        if element is self._target:
+            self.values.append("".join(element.itertext()))
+            self._target = None
+        if element is self._match:
+            self._match = None
+        if self._match is None:
+            element.clear(keep_tail=True)
+        if element.tag == self.spec.stop_after and self._stop_depth:
+            self._stop_depth -= 1
+            if self._stop_depth == 0:
+                self.done = True
+
+    def _read_events(self):
+        for event, element in self._parser.read_events():
+            # Comments and processing instructions have no string tag
+            if not isinstance(element.tag, str):
+                continue
+            if event == 'start':
+                self._start(element)
+            else:
+                self._end(element)
+            if self.done:
+                return
+
+
+StreamingExtractor = LxmlStreamingExtractor if etree is not None else HTMLParserStreamingExtractor
+
+
+BACKENDS: Dict[str, Callable[[], ParserBackend]] = {
+    'bs4': BeautifulSoupBackend,
+    'lxml': LxmlBackend,
+    'selectolax': SelectolaxBackend,
+}
+
+
+def available_backends() -> List[str]:
+    available = ['bs4']
+    if etree is not None:
+        available.append('lxml')
+    if SelectolaxParser is not None:
+        available.append('selectolax')
+    return available
+
+
+def get_backend(name: Optional[str] = None) -> ParserBackend:
+    """
+    Get a parser backend
+    :param name: bs4, lxml, selectolax or auto, defaults to HTML_PARSER_BACKEND
+    :return: ParserBackend
+    """
+    name = name or HTML_PARSER_BACKEND
+    available = available_backends()
+    if name == "auto":
+        name = available[-1]
+    if name not in available:
+        logging.warning(f"HTML parser backend {name} is not installed, falling back to bs4")
+        name = 'bs4'
+    return BACKENDS[name]()
+
+
+def extract(html: str, spec: ExtractSpec, backend: Optional[ParserBackend] = None) -> List[str]:
+    """
+    Extract values from a page
+    :param html: Page source
+    :param spec: What to extract
+    :param backend: Parser backend, defaults to get_backend()
+    :return: Extracted values
+    """
+    backend = backend or _default_backend()
+    with Metrics().timer("parse_seconds", backend=backend.name):
+        return backend.extract(html, spec)
+
+
+_DEFAULT_BACKEND = None
+
+
+def _default_backend() -> ParserBackend:
+    global _DEFAULT_BACKEND
+    if _DEFAULT_BACKEND is None:
+        _DEFAULT_BACKEND = get_backend()
+    return _DEFAULT_BACKEND
@@ -0,0 +1,323 @@
+"""
+ Streaming pipelines: a source and a chain of stages connected by bounded queues, every stage running on its own
+ worker threads.
+
+ Items flow through as soon as they are produced, so the second stage starts on the source's first item and a run
+ takes about as long as its slowest stage rather than the sum of all of them. A full queue blocks the stage feeding
+ it (backpressure), which bounds memory whatever the size of the input. Stages can take their input in batches, and
+ a stage with a Checkpoint stores each item's output in the cache keyed by the item's version, so a failed or
+ interrupted run resumes without redoing the items it already got through.
+
+    pipeline = Pipeline("mealie_food_builder")
+    pipeline.source("recipes", list_recipes)
+    pipeline.stage("ingredients", fetch_ingredients, workers=8, checkpoint=INGREDIENTS, key=recipe_version)
+    pipeline.stage("parse", parse_batch, workers=4, batch_size=50, flat=True)
+    for result in pipeline.run():
+        ...
+"""
+import os
+import time
+import queue
+import logging
+import threading
+
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from utils.cache import CacheNamespace
+from utils.metrics import Metrics
+
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 256))
+# Seconds a batching stage waits for a batch to fill before sending what it has
+PIPELINE_BATCH_TIMEOUT = float(os.getenv("PIPELINE_BATCH_TIMEOUT", 0.2))
+
+_END = object()
+_POLL = 0.1
+
+
+class PipelineError(RuntimeError):
+    """Items failed in a stage of a pipeline, raised once the rest went through"""
+
+
+class Checkpoint:
+    """
+    Outputs of a stage kept in the cache per item key and version, an item whose version changed is redone.
+    An item without a version can't be validated, it is redone on every run.
+    """
+
+    def __init__(self, cache: CacheNamespace, prefix: str, ttl: int):
+        self.cache = cache
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key: str, version: str) -> Optional[Any]:
+        if not version:
+            return None
+        entry = self.cache.get(f"{self.prefix}:{key}")
+        if isinstance(entry, dict) and entry.get('version') == version:
+            return entry.get('value')
+        return None
+
+    def put(self, key: str, version: str, value: Any):
+        if not version:
+            return
+        self.cache.set(f"{self.prefix}:{key}", {'version': version, 'value': value}, self.ttl)
+
+
+class StageStats:
+    """Counters of one stage, busy is time spent in the stage function and blocked time waiting on a full queue"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {'items': 0, 'outputs': 0, 'failed': 0, 'checkpointed': 0}
+        self.busy = 0.0
+        self.blocked = 0.0
+
+    def incr(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def add_time(self, busy: float = 0.0, blocked: float = 0.0):
+        with self.lock:
+            self.busy += busy
+            self.blocked += blocked
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            return dict(self.counts, busy=round(self.busy, 3), blocked=round(self.blocked, 3))
+
+
+class _Stage:
+    def __init__(self, name: str, function: Callable, workers: int, batch_size: Optional[int], flat: bool,
+                 checkpoint: Optional[Checkpoint], key: Optional[Callable[[Any], Tuple[str, str]]]):
+        if checkpoint is not None and (key is None or batch_size):
+            raise ValueError(f"Stage {name}: a checkpoint needs a key function and can't be used with batches")
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.batch_size = batch_size
+        self.flat = flat
+        self.checkpoint = checkpoint
+        self.key = key
+        self.stats = StageStats()
+        self.remaining = workers
+        self.lock = threading.Lock()
+        self.error: Optional[BaseException] = None
+
+
+class Pipeline:
+    """
+    A source feeding a chain of stages, consumed by iterating run()
+
+    Args:
+        name (str): Name used in logs and metrics
+        queue_size (int, optional): Items held between two stages at most
+    """
+
+    def __init__(self, name: str, queue_size: int = PIPELINE_QUEUE_SIZE):
+        self.name = name
+        self.queue_size = queue_size
+        self.stages: List[_Stage] = []
+        self.source_name = None
+        self.source_function = None
+        self.source_stats = StageStats()
+        self.errors: List[BaseException] = []
+        self._cancel = threading.Event()
+
+    def source(self, name: str, function: Callable[[], Iterable[Any]]) -> "Pipeline":
+        """
+        Set the source
+        :param name: Stage name
+        :param function: Returns an iterable of items, consumed on its own thread
+        """
+        self.source_name = name
+        self.source_function = function
+        return self
+
+    def stage(self, name: str, function: Callable[[Any], Any], workers: int = 1, batch_size: Optional[int] = None,
+              flat: bool = False, checkpoint: Optional[Checkpoint] = None,
+              key: Optional[Callable[[Any], Tuple[str, str]]] = None) -> "Pipeline":
+        """
+        Add a stage after the last one
+        :param name: Stage name
+        :param function: Called with an item (a list of up to batch_size items when batching), returns the output.
+                         None outputs are dropped. An exception drops the item(s) and is logged, once
+                         everything else went through run() raises a PipelineError.
+        :param workers: Threads running the function
+        :param batch_size: Hand the function lists of items instead of single items
+        :param flat: The function returns an iterable of outputs, each passed on separately
+        :param checkpoint: Store outputs so items already done are skipped on the next run
+        :param key: Returns (key, version) of an item, needed with a checkpoint
+        """
+        self.stages.append(_Stage(name, function, workers, batch_size, flat, checkpoint, key))
+        return self
+
+    def _put(self, outbox: queue.Queue, item: Any, stats: StageStats) -> bool:
+        started = time.perf_counter()
+        while not self._cancel.is_set():
+            try:
+                outbox.put(item, timeout=_POLL)
+                stats.add_time(blocked=time.perf_counter() - started)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _end(self, outbox: queue.Queue):
+        """Mark the end of a stream, given up once the run is cancelled as nobody reads the queue anymore"""
+        while True:
+            try:
+                outbox.put(_END, timeout=_POLL)
+                return
+            except queue.Full:
+                if self._cancel.is_set():
+                    return
+
+    def _get(self, inbox: queue.Queue, timeout: Optional[float] = None) -> Any:
+        """Next item, _END once the stream ended or the run was cancelled, None on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._cancel.is_set():
+            wait = _POLL if deadline is None else min(_POLL, deadline - time.monotonic())
+            if wait <= 0:
+                return None
+            try:
+                return inbox.get(timeout=wait)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _produce(self, outbox: queue.Queue):
+        try:
+            for item in self.source_function():
+                self.source_stats.incr('outputs')
+                if not self._put(outbox, item, self.source_stats):
+                    return
+        except Exception as e:
+            # Everything already emitted still flows through, the run then fails with this error
+            logging.error(f"{self.name}/{self.source_name} failed: {e}")
+            self.errors.append(e)
+        finally:
+            self._end(outbox)
+
+    def _take(self, stage: _Stage, inbox: queue.Queue) -> Tuple[List[Any], bool]:
+        """Items for one call of the stage function, and whether the stream has ended"""
+        item = self._get(inbox)
+        if item is _END:
+            return [], True
+        if not stage.batch_size:
+            return [item], False
+        batch = [item]
+        deadline = time.monotonic() + PIPELINE_BATCH_TIMEOUT
+        while len(batch) < stage.batch_size:
+            item = self._get(inbox, max(0.0, deadline - time.monotonic()))
+            if item is None:
+                break
+            if item is _END:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _call(self, stage: _Stage, items: List[Any]) -> Any:
+        if stage.batch_size:
+            return stage.function(items)
+        item = items[0]
+        if stage.checkpoint is None:
+            return stage.function(item)
+        key, version = stage.key(item)
+        output = stage.checkpoint.get(key, version)
+        if output is not None:
+            stage.stats.incr('checkpointed')
+            return output
+        output = stage.function(item)
+        if output is not None:
+            stage.checkpoint.put(key, version, output)
+        return output
+
+    def _work(self, stage: _Stage, inbox: queue.Queue, outbox: queue.Queue):
+        ended = False
+        while not ended and not self._cancel.is_set():
+            items, ended = self._take(stage, inbox)
+            if not items:
+                continue
+            stage.stats.incr('items', len(items))
+            started = time.perf_counter()
+            try:
+                output = self._call(stage, items)
+                outputs = list(output) if stage.flat and output is not None else [output]
+            except Exception as e:
+                stage.stats.incr('failed', len(items))
+                with stage.lock:
+                    stage.error = stage.error or e
+                logging.error(f"{self.name}/{stage.name} failed on {len(items)} item(s): {e}")
+                continue
+            finally:
+                stage.stats.add_time(busy=time.perf_counter() - started)
+            for output in outputs:
+                if output is None:
+                    continue
+                stage.stats.incr('outputs')
+                if not self._put(outbox, output, stage.stats):
+                    return
+        if ended:
+            # Let the other workers of this stage see the end too
+            self._end(inbox)
+        with stage.lock:
+            stage.remaining -= 1
+            last = stage.remaining == 0
+        if last:
+            self._end(outbox)
+
+    def run(self) -> Iterator[Any]:
+        """
+        Start every stage and yield the outputs of the last one as they arrive. Stopping the iteration early
+        cancels the run. Once everything went through, raises the source's error if it failed, or a PipelineError
+        if items failed in a stage, so a run that dropped items never passes for a complete one.
+        """
+        if self.source_function is None:
+            raise ValueError(f"Pipeline {self.name} has no source")
+        self._cancel.clear()
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._produce, args=(queues[0],), name=f"{self.name}-{self.source_name}",
+                                    daemon=True)]
+        for i, stage in enumerate(self.stages):
+            stage.remaining = stage.workers
+            stage.error = None
+            threads.extend(threading.Thread(target=self._work, args=(stage, queues[i], queues[i + 1]),
+                                            name=f"{self.name}-{stage.name}-{n}", daemon=True)
+                           for n in range(stage.workers))
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        completed = False
+        try:
+            while True:
+                item = self._get(queues[-1])
+                if item is _END:
+                    completed = True
+                    break
+                yield item
+        finally:
+            if not completed:
+                self._cancel.set()
+            for thread in threads:
+                thread.join()
+            self._report(time.perf_counter() - started)
+        if self.errors:
+            raise self.errors[0]
+        failed = [stage for stage in self.stages if stage.error is not None]
+        if failed:
+            counts = ", ".join(f"{stage.name}: {stage.stats.counts['failed']}" for stage in failed)
+            raise PipelineError(f"Pipeline {self.name} dropped failed items ({counts})") from failed[0].error
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        stats = {self.source_name: self.source_stats.as_dict()}
+        stats.update((stage.name, stage.stats.as_dict()) for stage in self.stages)
+        return stats
+
+    def _report(self, seconds: float):
+        logging.info(f"Pipeline {self.name} finished in {seconds:.1f}s")
+        for name, counts in self.stats().items():
+            logging.info(f"\t{name}: {counts}")
+            for counter in ('items', 'outputs', 'failed', 'checkpointed'):
+                Metrics().incr("pipeline_items_total", counts[counter], pipeline=self.name, stage=name, kind=counter)
+            Metrics().incr("pipeline_busy_seconds_total", counts['busy'], pipeline=self.name, stage=name)
+            Metrics().incr("pipeline_blocked_seconds_total", counts['blocked'], pipeline=self.name, stage=name)
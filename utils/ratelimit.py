@@ -0,0 +1,289 @@
+"""
+ Rate limiting primitives shared by writers and the HTTP layer.
+
+ HostScheduler gives every host an AdaptiveLimiter that all requests to it go through, threaded or asyncio:
+    - a token bucket caps the request rate (HTTP_HOST_RATE, unlimited by default)
+    - a concurrency window grows by one request per window while responses are healthy and halves on a 429, a 5xx,
+      a connection error or latency well above the best seen (AIMD), so throughput settles just under what the
+      host can take
+    - Retry-After (or a jittered exponential backoff) blocks the whole host, not just the request that got it
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+import collections
+import urllib.parse as urlparse
+
+from email.utils import parsedate_to_datetime
+from typing import Deque, Dict, Mapping, Optional, Tuple
+
+HTTP_HOST_RATE = float(os.getenv("HTTP_HOST_RATE", 0))
+HTTP_HOST_RATES = os.getenv("HTTP_HOST_RATES", "")  # host=rate,host=rate
+HTTP_HOST_MAX_CONCURRENCY = int(os.getenv("HTTP_HOST_MAX_CONCURRENCY", 32))
+HTTP_HOST_INITIAL_CONCURRENCY = int(os.getenv("HTTP_HOST_INITIAL_CONCURRENCY", 4))
+# Latency above this multiple of the best recently seen counts as congestion
+HTTP_LATENCY_TOLERANCE = float(os.getenv("HTTP_LATENCY_TOLERANCE", 3.0))
+# ...as long as it is also this many seconds above it, a few milliseconds either way is noise on a fast host
+LATENCY_SLACK = 0.05
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", 60))
+AIMD_DECREASE = 0.5
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket, allows bursts of up to `burst` calls then `rate` calls per second
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> float:
+        """Take a token if one is available, returns 0 if it was taken or the seconds until one will be"""
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Block until a token is available and take it"""
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+def retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """Seconds asked for by a Retry-After header (delay or HTTP date), None if there is none"""
+    value = (headers.get("Retry-After") or "").strip()
+    if not value:
+        return None
+    if value.isdigit():
+        return min(float(value), HTTP_BACKOFF_MAX)
+    try:
+        return min(max(0.0, parsedate_to_datetime(value).timestamp() - time.time()), HTTP_BACKOFF_MAX)
+    except (TypeError, ValueError):
+        return None
+
+
+def jittered_backoff(attempt: int, base: float, cap: float = HTTP_BACKOFF_MAX) -> float:
+    """Full jitter exponential backoff, spreads out retries from many workers hitting the same error"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class AdaptiveLimiter:
+    """
+    Rate and concurrency limits for one host, adjusted from the outcome of every request. Call acquire() (or
+    acquire_async()) before sending and release() with the outcome once the response headers arrived.
+
+    A slot is held until the response headers arrive, not while the body is read: the window bounds the requests
+    the host is still working on, and the latency it adapts to is the time to first byte. Callers waiting for a
+    slot sleep until a release (or abandon) frees one, threads on a Condition and coroutines on a future of their
+    own event loop, both may release the same host's slots.
+    """
+
+    def __init__(self, name: str, rate: float = 0, max_concurrency: int = HTTP_HOST_MAX_CONCURRENCY,
+                 initial_concurrency: int = HTTP_HOST_INITIAL_CONCURRENCY):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst=max(1, int(rate))) if rate > 0 else None
+        self.max_concurrency = max_concurrency
+        self.limit = float(min(initial_concurrency, max_concurrency))
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.latency = None
+        self.best_latency = None
+        self.last_decrease = 0.0
+        self.lock = threading.Lock()
+        self.slot_freed = threading.Condition(self.lock)
+        self.async_waiters: Deque[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = collections.deque()
+        self.counts = {'requests': 0, 'throttled': 0, 'errors': 0, 'decreases': 0}
+
+    def _take(self) -> Optional[float]:
+        """Take a slot, called with the lock held. Returns 0 if taken, the seconds to wait, or None until a release"""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.in_flight >= int(self.limit):
+            return None
+        if self.bucket is not None:
+            wait = self.bucket.try_acquire()
+            if wait > 0:
+                return wait
+        self.in_flight += 1
+        return 0.0
+
+    def _notify(self):
+        """Wake as many waiters as there are free slots, called with the lock held"""
+        free = int(self.limit) - self.in_flight
+        if free <= 0:
+            return
+        self.slot_freed.notify(free)
+        while free > 0 and self.async_waiters:
+            loop, future = self.async_waiters.popleft()
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(_wake, future)
+                free -= 1
+
+    def try_acquire(self) -> Optional[float]:
+        """
+        Take a slot if the host allows another request now
+        :return: 0 if taken, the seconds to wait, or None if the window is full until a release frees a slot
+        """
+        with self.lock:
+            return self._take()
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                wait = self._take()
+                if wait == 0:
+                    return
+                self.slot_freed.wait(wait)
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                wait = self._take()
+                if wait == 0:
+                    return
+                if wait is None:
+                    future = loop.create_future()
+                    self.async_waiters.append((loop, future))
+            if wait is not None:
+                await asyncio.sleep(wait)
+                continue
+            try:
+                await future
+            except asyncio.CancelledError:
+                with self.lock:
+                    try:
+                        self.async_waiters.remove((loop, future))
+                    except ValueError:
+                        # Woken already, the slot it was woken for goes to the next waiter
+                        self._notify()
+                raise
+
+    def _decrease(self, now: float):
+        # One decrease per round trip, a burst of failures from the same window is a single congestion signal
+        if now - self.last_decrease < (self.latency or 0.1):
+            return
+        self.limit = max(1.0, self.limit * AIMD_DECREASE)
+        self.last_decrease = now
+        self.counts['decreases'] += 1
+        logging.debug(f"{self.name}: concurrency down to {int(self.limit)}")
+
+    def release(self, latency: Optional[float], ok: bool = True, throttled: bool = False):
+        """
+        Report the outcome of a request
+        :param latency: Seconds until the response headers arrived, None if the request failed
+        :param ok: False for 5xx responses and connection errors
+        :param throttled: True for 429 (and 503 with Retry-After) responses
+        """
+        with self.lock:
+            self.in_flight -= 1
+            self.counts['requests'] += 1
+            now = time.monotonic()
+            # Rejections come back fast, timing them would make every normal response look congested
+            if latency is not None and ok and not throttled:
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+                # Let the best latency drift up slowly so one lucky response doesn't pin it forever
+                self.best_latency = latency if self.best_latency is None else min(latency, self.best_latency * 1.05)
+            if throttled or not ok:
+                self.counts['throttled' if throttled else 'errors'] += 1
+                self._decrease(now)
+            elif self.latency is not None and self.latency > max(self.best_latency * HTTP_LATENCY_TOLERANCE,
+                                                                 self.best_latency + LATENCY_SLACK):
+                self._decrease(now)
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._notify()
+
+    def abandon(self):
+        """Give back the slot of a request that ended without an outcome to learn from, e.g. it was cancelled"""
+        with self.lock:
+            self.in_flight -= 1
+            self._notify()
+
+    def backoff(self, seconds: float):
+        """Hold every request to the host for `seconds`, e.g. for a Retry-After"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        logging.debug(f"{self.name}: backing off for {seconds:.2f}s")
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            return dict(self.counts, concurrency=int(self.limit),
+                        latency=round(self.latency, 4) if self.latency is not None else None)
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _parse_rates(value: str) -> Dict[str, float]:
+    rates = {}
+    for part in value.split(","):
+        if "=" not in part:
+            continue
+        host, rate = part.split("=", 1)
+        rates[host.strip()] = float(rate)
+    return rates
+
+
+class HostScheduler:
+    """Singleton holding the AdaptiveLimiter of every host"""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = super(HostScheduler, cls).__new__(cls)
+                cls._instance._limiters = {}
+                cls._instance._rates = _parse_rates(HTTP_HOST_RATES)
+                cls._instance._lock = threading.Lock()
+        return cls._instance
+
+    def configure_host(self, host: str, rate: float):
+        """
+        Set a host's default request rate, HTTP_HOST_RATES still wins so it can be tuned without code changes
+        :param host: Hostname, e.g. www.recipetineats.com
+        :param rate: Requests per second, 0 for unlimited
+        """
+        with self._lock:
+            rate = _parse_rates(HTTP_HOST_RATES).get(host, rate)
+            self._rates[host] = rate
+            limiter = self._limiters.get(host)
+            if limiter is not None:
+                limiter.bucket = TokenBucket(rate, burst=max(1, int(rate))) if rate > 0 else None
+
+    def for_host(self, host: str) -> AdaptiveLimiter:
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                limiter = self._limiters[host] = AdaptiveLimiter(host, self._rates.get(host, HTTP_HOST_RATE))
+            return limiter
+
+    def for_url(self, url: str) -> AdaptiveLimiter:
+        return self.for_host(urlparse.urlsplit(url).netloc.lower())
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {host: limiter.stats() for host, limiter in limiters.items()}
@@ -0,0 +1,79 @@
+"""
+ Scraper registry, finds the scrapers in ./scrapers by reading their source instead of importing them.
+
+ Importing a scraper pulls in requests, bs4, tqdm and opens its caches, so listing or selecting scrapers would pay
+ for every one of them. Each module is parsed with ast instead: a module with a top level main() is a scraper, its
+ docstring (or first comment) describes it and a literal DEPENDS_ON list names scrapers whose outputs it reads.
+"""
+import os
+import ast
+import logging
+
+from typing import Dict, List, NamedTuple, Optional
+
+SCRAPERS_DIRECTORY = "scrapers"
+
+
+class ScraperInfo(NamedTuple):
+    name: str
+    module: str
+    path: str
+    description: str
+    depends_on: List[str]
+
+
+def _describe(tree: ast.Module, source: str) -> str:
+    docstring = ast.get_docstring(tree)
+    if docstring:
+        return docstring.strip().splitlines()[0]
+    for line in source.splitlines():
+        if line.startswith("#"):
+            return line.lstrip("# ").strip()
+    return ""
+
+
+def _depends_on(tree: ast.Module) -> List[str]:
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(getattr(target, 'id', None) == "DEPENDS_ON"
+                                                for target in node.targets):
+            try:
+                return list(ast.literal_eval(node.value))
+            except ValueError:
+                logging.warning(f"DEPENDS_ON must be a literal list, got {ast.dump(node.value)}")
+    return []
+
+
+def inspect_scraper(path: str) -> Optional[ScraperInfo]:
+    """
+    Read a scraper module without importing it
+    :param path: Path to the module
+    :return: ScraperInfo, None if the module has no top level main()
+    """
+    with open(path, "r") as f:
+        source = f.read()
+    try:
+        tree = ast.parse(source, filename=path)
+    except SyntaxError as e:
+        logging.error(f"Skipping {path}: {e}")
+        return None
+    if not any(isinstance(node, ast.FunctionDef) and node.name == "main" for node in tree.body):
+        return None
+    name = os.path.splitext(os.path.basename(path))[0]
+    module = f"{os.path.basename(os.path.dirname(path))}.{name}"
+    return ScraperInfo(name, module, path, _describe(tree, source), _depends_on(tree))
+
+
+def discover_scrapers(directory: str = SCRAPERS_DIRECTORY) -> Dict[str, ScraperInfo]:
+    """
+    Find every scraper in a directory
+    :param directory: Package directory holding the scrapers
+    :return: ScraperInfo by name, sorted by name
+    """
+    scrapers = {}
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".py") or filename.startswith("_"):
+            continue
+        info = inspect_scraper(os.path.join(directory, filename))
+        if info is not None:
+            scrapers[info.name] = info
+    return scrapers
@@ -0,0 +1,175 @@
+"""
+ Runs scrapers non-interactively, each in its own process.
+
+ Independent scrapers run at the same time (up to max_parallel), a scraper listing another in DEPENDS_ON waits for
+ it to succeed first. A scraper that overruns its timeout is terminated. Every run ends with a summary of each
+ scraper's exit status and timings, optionally written as JSON for cron wrappers and dashboards.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import multiprocessing
+
+from typing import Dict, List, Optional
+
+from utils.registry import ScraperInfo
+
+RUNNER_TIMEOUT = float(os.getenv("RUNNER_TIMEOUT", 3600))
+RUNNER_MAX_PARALLEL = int(os.getenv("RUNNER_MAX_PARALLEL", 4))
+
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+TIMED_OUT = "timed out"
+SKIPPED = "skipped"
+
+
+def run_scraper(module: str, profile: Optional[str] = None):
+    """
+    Run one scraper in the current process, flushing the caches, logging the HTTP stats and writing the metrics
+    report at the end (also when the scraper fails)
+    :param module: Module path, e.g. scrapers.recipetineats
+    :param profile: Run main() under a profiler, cprofile or sampling, defaults to PROFILE
+    """
+    from importlib import import_module
+    from utils.cache import Cache
+    from utils.http_cache import ResponseCache
+    from utils.metrics import METRICS_ENABLED, PROFILE, Metrics, profiled
+    from utils.webpages import HTTPClient, STREAM_STATS
+
+    name = module.rsplit(".", 1)[-1]
+    metrics = Metrics()
+    metrics.begin(name)
+    metrics.register_collector("connections", HTTPClient().stats)
+    metrics.register_collector("http_cache", ResponseCache().stats.as_dict)
+    metrics.register_collector("hosts", HTTPClient().host_stats)
+    metrics.register_collector("streamed_pages", STREAM_STATS.as_dict)
+    cache = Cache()
+    profile = profile or PROFILE
+    try:
+        main = import_module(module).main
+        if profile:
+            profiled(main, profile, name)
+        else:
+            main()
+    finally:
+        logging.info(f"HTTP connections: {HTTPClient().stats()}")
+        logging.info(f"HTTP cache: {ResponseCache().stats.as_dict()}")
+        for host, counts in HTTPClient().host_stats().items():
+            logging.info(f"HTTP host {host}: {counts}")
+        for stream, counts in STREAM_STATS.as_dict().items():
+            logging.info(f"Streamed pages ({stream}): {counts}")
+        cache.write_cache()
+        if METRICS_ENABLED:
+            metrics.export()
+
+
+def _child(module: str, level: int, profile: Optional[str]):
+    # Nothing can be answered from a child process, scrapers fall back to their environment variables
+    sys.stdin = open(os.devnull)
+    logging.basicConfig(level=level, format=f"%(asctime)s - {module} - %(levelname)s - %(message)s", force=True)
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+    try:
+        run_scraper(module, profile)
+    except Exception:
+        logging.exception(f"{module} failed")
+        sys.exit(1)
+
+
+class ScraperRun:
+    """State and timings of one scraper within a run"""
+
+    def __init__(self, info: ScraperInfo):
+        self.info = info
+        self.process: Optional[multiprocessing.Process] = None
+        self.status: Optional[str] = None
+        self.exit_code: Optional[int] = None
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+
+    @property
+    def duration(self) -> Optional[float]:
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def as_dict(self) -> dict:
+        return {'scraper': self.info.name, 'status': self.status, 'exit_code': self.exit_code,
+                'started': self.started, 'finished': self.finished, 'duration': self.duration}
+
+
+def run_scrapers(scrapers: List[ScraperInfo], max_parallel: int = RUNNER_MAX_PARALLEL,
+                 timeout: float = RUNNER_TIMEOUT, poll_interval: float = 0.2,
+                 profile: Optional[str] = None) -> Dict[str, ScraperRun]:
+    """
+    Run scrapers in parallel processes
+    :param scrapers: Scrapers to run, dependencies that aren't in the list are assumed to be up to date
+    :param max_parallel: Scrapers running at the same time
+    :param timeout: Seconds a scraper may run before it is terminated
+    :param poll_interval: Seconds between checks on the running processes
+    :param profile: Profile every scraper, cprofile or sampling
+    :return: ScraperRun by scraper name, in the order given
+    """
+    runs = {info.name: ScraperRun(info) for info in scrapers}
+    level = logging.getLogger().getEffectiveLevel()
+    running: List[ScraperRun] = []
+    while True:
+        for run in runs.values():
+            if run.status is not None or run.process is not None:
+                continue
+            dependencies = [runs[name] for name in run.info.depends_on if name in runs]
+            if any(dependency.status not in (None, SUCCEEDED) for dependency in dependencies):
+                run.status = SKIPPED
+                logging.warning(f"Skipping {run.info.name}: a scraper it depends on did not succeed")
+            elif all(dependency.status == SUCCEEDED for dependency in dependencies) and len(running) < max_parallel:
+                run.process = multiprocessing.Process(target=_child, args=(run.info.module, level, profile),
+                                                      name=run.info.name)
+                run.started = time.time()
+                run.process.start()
+                running.append(run)
+                logging.info(f"Started {run.info.name} (pid {run.process.pid})")
+        if not running:
+            break
+        time.sleep(poll_interval)
+        for run in list(running):
+            if run.process.is_alive():
+                if time.time() - run.started < timeout:
+                    continue
+                logging.error(f"{run.info.name} ran for more than {timeout:.0f}s, terminating it")
+                run.process.terminate()
+                run.process.join(10)
+                if run.process.is_alive():
+                    run.process.kill()
+                run.process.join()
+                run.status = TIMED_OUT
+            else:
+                run.status = SUCCEEDED if run.process.exitcode == 0 else FAILED
+            run.finished = time.time()
+            run.exit_code = run.process.exitcode
+            running.remove(run)
+            logging.info(f"{run.info.name} {run.status} in {run.duration:.1f}s")
+    for run in runs.values():
+        if run.status is None:
+            # Only left over when dependencies form a cycle
+            run.status = SKIPPED
+            logging.warning(f"Skipping {run.info.name}: circular DEPENDS_ON")
+    return runs
+
+
+def summarize(runs: Dict[str, ScraperRun], path: Optional[str] = None) -> bool:
+    """
+    Log the outcome of every scraper and optionally write it as JSON
+    :param runs: Result of run_scrapers
+    :param path: File to write the summary to
+    :return: True if every scraper succeeded
+    """
+    logging.info("Run summary:")
+    for run in runs.values():
+        duration = f"{run.duration:.1f}s" if run.duration is not None else "-"
+        logging.info(f"\t{run.info.name:<24} {run.status:<10} exit={run.exit_code} {duration}")
+    if path:
+        with open(path, "w") as f:
+            json.dump({'finished': time.time(), 'scrapers': [run.as_dict() for run in runs.values()]}, f, indent=2)
+        logging.info(f"Run summary written to {path}")
+    return all(run.status == SUCCEEDED for run in runs.values())
@@ -0,0 +1,229 @@
+"""
+ Sitemap based URL discovery, a cheaper alternative to crawling a site's listing pages.
+
+ Sitemaps are found through robots.txt (falling back to /sitemap.xml), sitemap index files are followed, and gzipped
+ sitemaps are inflated on the fly. Every file is streamed through an incremental XML parser and each <url> is
+ dropped as soon as it has been read, so memory stays flat however many entries a sitemap holds.
+
+ SitemapDiscovery remembers when it last completed and only yields URLs whose <lastmod> is newer, skipping whole
+ child sitemaps the index reports as unchanged.
+"""
+import os
+import time
+import zlib
+import logging
+import datetime
+import urllib.parse as urlparse
+import xml.etree.ElementTree as ElementTree
+
+from typing import Callable, Iterator, List, NamedTuple, Optional, Tuple
+
+import requests
+
+from utils.cache import Cache, TTL
+from utils.webpages import HTTPClient, HTTP_STREAM_CHUNK_SIZE, archive_error, cached_get, record_transfer
+from utils.archive import ARCHIVE_RECORD, PageArchive
+
+# The sitemap protocol caps a file at 50MB uncompressed, anything past this is not a sitemap
+SITEMAP_MAX_BYTES = int(os.getenv("SITEMAP_MAX_BYTES", 64 * 1024 * 1024))
+# <lastmod> is set by the site's clock, re-reading a day's worth of entries covers any skew
+SITEMAP_LASTMOD_SLACK = float(os.getenv("SITEMAP_LASTMOD_SLACK", TTL.DAYS))
+SITEMAP_STATE_TTL = TTL.DAYS * 365
+
+_GZIP_MAGIC = b"\x1f\x8b"
+
+
+class SitemapEntry(NamedTuple):
+    url: str
+    lastmod: Optional[float]
+
+
+def parse_lastmod(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a W3C datetime (2024-01-31, 2024-01-31T10:00:00+00:00, ...Z) into a timestamp, dates without a timezone
+    are taken as UTC
+    :param value: <lastmod> text
+    :return: Timestamp or None if missing or unparsable
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        logging.debug(f"Unparsable lastmod {value!r}")
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+def sitemaps_from_robots(base_url: str) -> List[str]:
+    """
+    Sitemaps a site declares in its robots.txt
+    :param base_url: Any URL on the site
+    :return: Sitemap URLs, /sitemap.xml if robots.txt declares none
+    """
+    sitemaps = []
+    try:
+        robots = cached_get(urlparse.urljoin(base_url, "/robots.txt"), max_age=TTL.DAYS).text
+        for line in robots.splitlines():
+            name, _, value = line.partition(":")
+            if name.strip().lower() == "sitemap" and value.strip():
+                sitemaps.append(value.strip())
+    except requests.RequestException as e:
+        logging.debug(f"No robots.txt for {base_url}: {e}")
+    return sitemaps or [urlparse.urljoin(base_url, "/sitemap.xml")]
+
+
+def _iter_body(url: str) -> Iterator[bytes]:
+    """Stream a sitemap body, inflating it if it is gzipped (sitemap.xml.gz is usually served as is)"""
+    with HTTPClient().request("GET", url, stream=True) as response:
+        archive_error(url, response)
+        response.raise_for_status()
+        decompressor = None
+        size = 0
+        started = time.perf_counter()
+        body = bytearray() if ARCHIVE_RECORD else None
+        for i, chunk in enumerate(response.iter_content(HTTP_STREAM_CHUNK_SIZE)):
+            if body is not None:
+                body += chunk
+            if i == 0 and chunk.startswith(_GZIP_MAGIC):
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if decompressor is not None:
+                chunk = decompressor.decompress(chunk)
+            size += len(chunk)
+            if size > SITEMAP_MAX_BYTES:
+                logging.warning(f"Stopped reading {url} after {SITEMAP_MAX_BYTES} bytes (SITEMAP_MAX_BYTES)")
+                return
+            yield chunk
+        if decompressor is not None:
+            yield decompressor.flush()
+        if body is not None:
+            # Archived as served, still gzipped if it was a .xml.gz
+            PageArchive().record(url, response.status_code, response.headers, bytes(body), response.encoding)
+        # Inflated size, and the time includes parsing as each chunk is parsed before the next is read
+        record_transfer(url, time.perf_counter() - started, size)
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _iter_entries(chunks: Iterator[bytes]) -> Iterator[Tuple[str, str, Optional[str]]]:
+    """Yield (kind, loc, lastmod) for every <url> and <sitemap> element as soon as it has been parsed"""
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+    root = None
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            if event == "start":
+                if root is None:
+                    root = element
+                continue
+            kind = _local_name(element.tag)
+            if kind not in ("url", "sitemap") or element is root:
+                continue
+            loc = lastmod = None
+            for child in element:
+                name = _local_name(child.tag)
+                if name == "loc":
+                    loc = (child.text or "").strip()
+                elif name == "lastmod":
+                    lastmod = child.text
+            # Entries are direct children of the root, dropping them keeps the tree empty
+            root.clear()
+            if loc:
+                yield kind, loc, lastmod
+    parser.close()
+
+
+def iter_sitemap(url: str, since: Optional[float] = None, include_sitemap: Optional[Callable[[str], bool]] = None,
+                 failed: Optional[List[str]] = None) -> Iterator[SitemapEntry]:
+    """
+    Stream the entries of a sitemap, following sitemap index files. A sitemap that can't be read is logged and
+    skipped, the others are still read.
+    :param url: Sitemap or sitemap index URL
+    :param since: Only yield entries modified after this timestamp, entries without a lastmod are always yielded
+    :param include_sitemap: Filter for the child sitemaps of an index
+    :param failed: Filled with the sitemaps that couldn't be read (or only partly)
+    :return: Iterator of SitemapEntry
+    """
+    pending = [url]
+    visited = set()
+    while pending:
+        sitemap = pending.pop(0)
+        if sitemap in visited:
+            continue
+        visited.add(sitemap)
+        children = []
+        skipped = 0
+        try:
+            for kind, loc, lastmod in _iter_entries(_iter_body(sitemap)):
+                modified = parse_lastmod(lastmod)
+                if since is not None and modified is not None and modified <= since:
+                    skipped += 1
+                    continue
+                if kind == "url":
+                    yield SitemapEntry(loc, modified)
+                elif include_sitemap is None or include_sitemap(loc):
+                    # Index files are small, children are read once this one's connection is released
+                    children.append(loc)
+        except (requests.RequestException, ElementTree.ParseError) as e:
+            logging.error(f"Failed to read sitemap {sitemap}: {e}")
+            if failed is not None:
+                failed.append(sitemap)
+        logging.debug(f"Read {sitemap}: {len(children)} child sitemaps, {skipped} unchanged entries skipped")
+        pending.extend(children)
+
+
+class SitemapDiscovery:
+    """
+    URL source reading a site's sitemaps, yielding only the URLs added or changed since the last completed run
+
+    Args:
+        name (str): Name the last run is remembered under, e.g. "recipetineats"
+        base_url (str): Site to discover
+        include (Callable, optional): Filter for the page URLs to yield
+        include_sitemap (Callable, optional): Filter for the child sitemaps of an index
+    """
+
+    def __init__(self, name: str, base_url: str, include: Optional[Callable[[str], bool]] = None,
+                 include_sitemap: Optional[Callable[[str], bool]] = None):
+        self.name = name
+        self.base_url = base_url
+        self.include = include
+        self.include_sitemap = include_sitemap
+        self.state = Cache().namespace("sitemaps")
+        self.started = None
+        self.failed: List[str] = []
+
+    @property
+    def last_run(self) -> Optional[float]:
+        return self.state.get(f"{self.name}:last_run")
+
+    def urls(self) -> Iterator[str]:
+        """URLs that are new or changed since the last committed run, every URL on the first run"""
+        self.started = time.time()
+        self.failed = []
+        last_run = self.last_run
+        since = last_run - SITEMAP_LASTMOD_SLACK if last_run is not None else None
+        for sitemap in sitemaps_from_robots(self.base_url):
+            for entry in iter_sitemap(sitemap, since, self.include_sitemap, self.failed):
+                if self.include is None or self.include(entry.url):
+                    yield entry.url
+
+    def commit(self):
+        """
+        Remember this run once its URLs have been stored, the next run only asks for newer entries. A run in which
+        a sitemap failed isn't remembered, so the next one reads the entries it missed.
+        """
+        if self.started is None:
+            return
+        if self.failed:
+            logging.warning(f"{len(self.failed)} sitemaps of {self.name} failed, they are read again on the next run")
+            return
+        self.state.set(f"{self.name}:last_run", self.started, SITEMAP_STATE_TTL)
+        self.state.write_cache()
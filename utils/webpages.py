@@ -1,19 +1,522 @@
-from typing import List
+"""
+ Shared HTTP client layer used by every scraper.
+
+ All requests go through a single pooled client so that keep-alive connections are reused across threads and
+ across scrapers within one run. Sessions are kept per thread, but they all mount the same connection pools.
+ Every request waits for its host's AdaptiveLimiter (utils.ratelimit), which finds how fast each host can be crawled.
+
+ Spec based extraction streams the body into an incremental parser as it arrives. The download stops as soon as
+ the spec's region has been read or the body passes HTTP_MAX_RESPONSE_BYTES, so a page never has to be held in
+ memory whole.
+
+ With ARCHIVE_MODE=record every page read is also archived (utils.archive), whole, so streaming is off. With
+ ARCHIVE_MODE=replay GET requests are answered from the archive and never reach the network.
+"""
+import os
+import time
+import codecs
+import logging
+import threading
+import urllib.parse as urlparse
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, Iterator, List, Mapping, Optional
 import requests
 import bs4
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from utils.http_cache import HTTP_CACHE_ENABLED, CachedResponse, ResponseCache
+from utils.archive import ARCHIVE_MODE, ARCHIVE_RECORD, ARCHIVE_REPLAY, NotArchived, PageArchive
+from utils.parsers import ExtractSpec, StreamingExtractor, extract
+from utils.ratelimit import HostScheduler, jittered_backoff, retry_after
+from utils.metrics import Metrics, SIZE_BUCKETS
+
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 10))
+HTTP_POOL_SIZES = os.getenv("HTTP_POOL_SIZES", "")  # host=size,host=size
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", 3))
+HTTP_BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", 0.5))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 30))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# The server is shedding load, the request wasn't processed so it is retried whatever the method
+THROTTLE_STATUSES = (429, 503)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+API_PAGE_SIZE = int(os.getenv("API_PAGE_SIZE", 100))
+API_MAX_WORKERS = int(os.getenv("API_MAX_WORKERS", 8))
+HTTP_STREAMING = os.getenv("HTTP_STREAMING", "1") not in ("0", "false", "False")
+HTTP_STREAM_CHUNK_SIZE = int(os.getenv("HTTP_STREAM_CHUNK_SIZE", 16 * 1024))
+HTTP_MAX_RESPONSE_BYTES = int(os.getenv("HTTP_MAX_RESPONSE_BYTES", 5 * 1024 * 1024))
+
+
+class ConnectionStats:
+    """
+    Thread safe counters for connections opened versus requests sent
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.requests = 0
+
+    def connection_opened(self):
+        with self.lock:
+            self.opened += 1
+
+    def request_sent(self):
+        with self.lock:
+            self.requests += 1
+
+    @property
+    def reused(self) -> int:
+        return max(self.requests - self.opened, 0)
+
+    def as_dict(self) -> Dict[str, int]:
+        with self.lock:
+            return {'opened': self.opened, 'requests': self.requests, 'reused': max(self.requests - self.opened, 0)}
+
+
+CONNECTION_STATS = ConnectionStats()
+
+
+class StreamStats:
+    """
+    Thread safe per scraper counters for bytes read from streamed responses versus bytes left unread
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.scrapers = {}
+
+    def record(self, scraper: str, read: int, skipped: int, stopped_early: bool, truncated: bool):
+        with self.lock:
+            counts = self.scrapers.setdefault(scraper, {'pages': 0, 'bytes_read': 0, 'bytes_skipped': 0,
+                                                        'stopped_early': 0, 'truncated': 0})
+            counts['pages'] += 1
+            counts['bytes_read'] += read
+            counts['bytes_skipped'] += skipped
+            counts['stopped_early'] += int(stopped_early)
+            counts['truncated'] += int(truncated)
+
+    def as_dict(self) -> Dict[str, Dict[str, int]]:
+        with self.lock:
+            return {scraper: dict(counts) for scraper, counts in self.scrapers.items()}
+
+
+STREAM_STATS = StreamStats()
+
+
+def content_length(headers: Mapping[str, str]) -> Optional[int]:
+    """Length of the decoded body from the response headers, None when unknown or the body is compressed"""
+    if headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    value = headers.get('Content-Length', '')
+    return int(value) if value.isdigit() else None
+
+
+def stream_cache_vary(spec: ExtractSpec) -> str:
+    """
+    Cache vary for streamed pages, a body cut short at spec.stop_after only holds that spec's region so it must not
+    be served to callers wanting the full page
+    """
+    return f"stream:{spec.stop_after}" if spec.stop_after else ""
+
+
+def url_host(url: str) -> str:
+    return urlparse.urlsplit(url).netloc.lower()
+
+
+def record_response(url: str, status: int, ttfb: float):
+    """Count a response and observe its time to first byte (headers)"""
+    host = url_host(url)
+    Metrics().incr("http_responses_total", host=host, status=status)
+    Metrics().observe("http_ttfb_seconds", ttfb, host=host)
+
+
+def record_transfer(url: str, seconds: float, size: int):
+    """Observe the time spent reading a body after its headers arrived, and its size"""
+    host = url_host(url)
+    Metrics().observe("http_transfer_seconds", seconds, host=host)
+    Metrics().observe("http_response_bytes", size, buckets=SIZE_BUCKETS, host=host)
+
+
+class StreamedPage:
+    """Feeds a response body to a StreamingExtractor chunk by chunk, keeping the raw bytes for the cache"""
+
+    def __init__(self, spec: ExtractSpec, encoding: Optional[str], max_bytes: int = HTTP_MAX_RESPONSE_BYTES,
+                 keep_body: bool = True):
+        self.extractor = StreamingExtractor(spec)
+        self.decoder = codecs.getincrementaldecoder(encoding or 'utf-8')(errors='replace')
+        self.max_bytes = max_bytes
+        self.body = bytearray() if keep_body else None
+        self.read = 0
+        self.complete = False
+        self.truncated = False
+        self.started = time.perf_counter()
+        self.parse_seconds = 0.0
+
+    def feed(self, chunk: bytes) -> bool:
+        """
+        Parse the next chunk of the body
+        :param chunk: Raw bytes
+        :return: False once the rest of the body is not needed
+        """
+        self.read += len(chunk)
+        if self.body is not None:
+            self.body += chunk
+        started = time.perf_counter()
+        self.extractor.feed(self.decoder.decode(chunk))
+        self.parse_seconds += time.perf_counter() - started
+        if self.extractor.done:
+            return False
+        if self.read >= self.max_bytes:
+            self.truncated = True
+            return False
+        return True
+
+    def finish(self, url: str, headers: Mapping[str, str], scraper: str) -> List[str]:
+        """
+        Flush the parser and record how much of the body was read
+        :param url: URL, for logging
+        :param headers: Response headers
+        :param scraper: Name the byte counts are recorded under
+        :return: Extracted values
+        """
+        stopped_early = not self.complete and not self.truncated
+        if self.complete:
+            self.extractor.feed(self.decoder.decode(b"", final=True))
+        self.extractor.close()
+        length = content_length(headers)
+        skipped = max(length - self.read, 0) if length is not None else 0
+        STREAM_STATS.record(scraper, self.read, skipped, stopped_early, self.truncated)
+        record_transfer(url, time.perf_counter() - self.started, self.read)
+        Metrics().observe("parse_seconds", self.parse_seconds, backend="stream")
+        if self.truncated:
+            logging.warning(f"Stopped reading {url} after {self.read} bytes (HTTP_MAX_RESPONSE_BYTES)")
+        return self.extractor.values
+
+    def cacheable(self, headers: Mapping[str, str], max_age: float) -> bool:
+        """A truncated body would be served as if it were whole, and one without validators is never reused"""
+        if self.body is None or self.truncated:
+            return False
+        return max_age > 0 or 'ETag' in headers or 'Last-Modified' in headers
+
+
+class _CountingConnectionMixin:
+    def _new_conn(self):
+        # Called whenever a socket is actually opened, including reconnects of a pooled connection
+        CONNECTION_STATS.connection_opened()
+        return super()._new_conn()
+
+    def connect(self):
+        # DNS lookup, TCP connect and TLS handshake, urllib3 doesn't time them separately
+        started = time.perf_counter()
+        super().connect()
+        host = self.host if self.port in (None, 80, 443) else f"{self.host}:{self.port}"
+        Metrics().observe("http_connect_seconds", time.perf_counter() - started, host=host.lower())
+
+
+class _CountingHTTPConnection(_CountingConnectionMixin, HTTPConnection):
+    pass
+
+
+class _CountingHTTPSConnection(_CountingConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _CountingPoolMixin:
+    def urlopen(self, *args, **kwargs):
+        CONNECTION_STATS.request_sent()
+        return super().urlopen(*args, **kwargs)
+
+
+class _CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    ConnectionCls = _CountingHTTPConnection
 
 
-def get_webpage(url, features='html.parser') -> bs4.BeautifulSoup:
+class _CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+
+class _PooledAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools report connection usage to CONNECTION_STATS"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool
+        }
+
+
+def _parse_pool_sizes(value: str) -> Dict[str, int]:
+    sizes = {}
+    for part in value.split(","):
+        if "=" not in part:
+            continue
+        host, size = part.split("=", 1)
+        sizes[host.strip()] = int(size)
+    return sizes
+
+
+class HTTPClient:
+    """Singleton pooled HTTP client"""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = super(HTTPClient, cls).__new__(cls)
+                cls._instance._local = threading.local()
+                cls._instance._adapters_lock = threading.Lock()
+                cls._instance._default_adapter = cls._instance._new_adapter(HTTP_POOL_SIZE)
+                cls._instance._host_adapters = {}
+                cls._instance._generation = 0
+                for host, size in _parse_pool_sizes(HTTP_POOL_SIZES).items():
+                    cls._instance.configure_host(host, size)
+        return cls._instance
+
+    @staticmethod
+    def _new_adapter(pool_size: int) -> HTTPAdapter:
+        # Retries happen in request() where the host's limiter sees every attempt
+        retry = Retry(total=0, read=False, raise_on_status=False)
+        return _PooledAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    def configure_host(self, host: str, pool_size: int):
+        """
+        Give a host its own connection pool size
+        :param host: Hostname, e.g. www.recipetineats.com
+        :param pool_size: Maximum number of kept-alive connections to that host
+        """
+        adapter = self._new_adapter(pool_size)
+        with self._adapters_lock:
+            for scheme in ("http", "https"):
+                self._host_adapters[f"{scheme}://{host}"] = adapter
+            self._generation += 1
+        logging.debug(f"Configured connection pool for {host}: {pool_size}")
+
+    @property
+    def session(self) -> requests.Session:
+        """Session for the current thread, all sessions share the same connection pools"""
+        session = getattr(self._local, 'session', None)
+        if session is None or self._local.generation != self._generation:
+            session = requests.Session()
+            session.mount("http://", self._default_adapter)
+            session.mount("https://", self._default_adapter)
+            with self._adapters_lock:
+                for prefix, adapter in self._host_adapters.items():
+                    session.mount(prefix, adapter)
+                self._local.generation = self._generation
+            self._local.session = session
+        return session
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Send a request through the pooled session for this thread, paced by the host's AdaptiveLimiter.
+        429/503 responses hold every request to the host for their Retry-After (or a jittered backoff) and are
+        retried, connection errors and other 5xx responses are retried when resending is safe.
+        :param method: HTTP method
+        :param url: URL
+        :param kwargs: Passed through to requests.Session.request
+        :return: Response
+        """
+        if ARCHIVE_REPLAY:
+            return replayed_response(method, url)
+        kwargs.setdefault('timeout', HTTP_TIMEOUT)
+        limiter = HostScheduler().for_url(url)
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            limiter.acquire()
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                limiter.release(None, ok=False)
+                Metrics().incr("http_errors_total", host=url_host(url), error=type(e).__name__)
+                # A connect timeout never reached the server, anything else may have been processed
+                if attempt >= HTTP_MAX_RETRIES or not (idempotent or isinstance(e, requests.ConnectTimeout)):
+                    raise
+                delay = jittered_backoff(attempt, HTTP_BACKOFF_FACTOR)
+            except Exception:
+                # Whatever else went wrong (broken chunking, redirect loops, bad URLs...) the slot has to be given
+                # back, or the host stays at its concurrency limit for the rest of the run
+                limiter.release(None, ok=False)
+                raise
+            except BaseException:
+                limiter.abandon()
+                raise
+            else:
+                status = response.status_code
+                throttled = status in THROTTLE_STATUSES
+                ttfb = response.elapsed.total_seconds()
+                limiter.release(ttfb, ok=status < 500, throttled=throttled)
+                record_response(url, status, ttfb)
+                if not kwargs.get('stream'):
+                    # The body has been read already, streamed bodies are timed by whoever reads them
+                    record_transfer(url, max(time.perf_counter() - started - ttfb, 0.0), len(response.content))
+                if attempt >= HTTP_MAX_RETRIES or not (throttled or (idempotent and status in RETRY_STATUSES)):
+                    return response
+                delay = retry_after(response.headers)
+                if delay is None:
+                    delay = jittered_backoff(attempt, HTTP_BACKOFF_FACTOR)
+                response.close()
+                if throttled:
+                    # The limiter holds this and every other request to the host
+                    limiter.backoff(delay)
+                    delay = 0
+            attempt += 1
+            logging.debug(f"Retrying {method} {url} (attempt {attempt})")
+            time.sleep(delay)
+
+    def stats(self) -> Dict[str, int]:
+        return CONNECTION_STATS.as_dict()
+
+    def host_stats(self) -> Dict[str, Dict[str, float]]:
+        """Request counts, current concurrency and latency of every host's limiter"""
+        return HostScheduler().stats()
+
+
+def replayed_response(method: str, url: str) -> requests.Response:
+    """
+    Answer a request from the page archive as the server did when the page was recorded
+    :param method: HTTP method, only GET requests were archived, anything else raises NotArchived
+    :param url: URL
+    :return: Response holding the archived body, already read
+    """
+    if method.upper() != "GET":
+        raise NotArchived(f"{method} {url} can't be replayed, only pages read with GET are archived")
+    page = PageArchive().get(url)
+    response = requests.Response()
+    response.url = url
+    response.status_code = page.status
+    response.headers = page.headers
+    response.encoding = page.encoding
+    # Marked as read, iter_content() serves the body from memory and closing has no connection to release
+    response._content = page.body
+    response._content_consumed = True
+    return response
+
+
+def archive_error(url: str, response: requests.Response):
+    """Archive an error response, a replay has to fail (or end a paginated listing) where the crawl did"""
+    if ARCHIVE_RECORD and response.status_code >= 400:
+        PageArchive().record(url, response.status_code, response.headers, response.content, response.encoding)
+
+
+def archive_page(url: str, response: CachedResponse) -> CachedResponse:
+    """Archive a page read through the response cache, whether it came from the network or the cache"""
+    if ARCHIVE_RECORD:
+        PageArchive().record(url, 200, response.headers, response.body, response.encoding)
+    return response
+
+
+def cached_get(url, headers=None, max_age=0, vary="") -> CachedResponse:
+    """
+    GET a URL through the on-disk response cache
+    :param url: URL
+    :param headers: Extra request headers
+    :param max_age: Seconds a stored response is served without contacting the server, 0 always revalidates
+    :param vary: Extra value the response depends on, e.g. a bearer token
+    :return: CachedResponse
+    """
+    headers = dict(headers or {})
+    if not HTTP_CACHE_ENABLED or ARCHIVE_REPLAY:
+        response = HTTPClient().request("GET", url, headers=headers)
+        archive_error(url, response)
+        response.raise_for_status()
+        return archive_page(url, CachedResponse(url, response.content, response.headers, response.encoding, 0))
+    cache = ResponseCache()
+    entry = cache.lookup(url, vary)
+    if entry is not None:
+        if entry.age() < max_age:
+            cache.stats.incr('hits')
+            return archive_page(url, entry)
+        headers.update(entry.conditional_headers())
+    response = HTTPClient().request("GET", url, headers=headers)
+    if response.status_code == 304 and entry is not None:
+        cache.stats.incr('revalidated')
+        cache.refresh(url, vary)
+        return archive_page(url, entry)
+    archive_error(url, response)
+    response.raise_for_status()
+    cache.stats.incr('misses')
+    if max_age <= 0 and 'ETag' not in response.headers and 'Last-Modified' not in response.headers:
+        # Nothing to revalidate against and never served fresh, storing it would only cost disk writes
+        return archive_page(url, CachedResponse(url, response.content, response.headers, response.encoding, 0))
+    encoding = response.encoding or response.apparent_encoding
+    return archive_page(url, cache.store(url, response.content, response.headers, encoding, vary))
+
+
+def get_webpage(url, features='html.parser', max_age=0) -> bs4.BeautifulSoup:
     """
     Get the webpage from the given URL and return a BeautifulSoup object.
     :param url:  URL of the webpage
     :param features: The parser to use
+    :param max_age: Seconds a cached copy is used without revalidating it
     :return:
     """
-    response = requests.get(url)
-    response.raise_for_status()
-    return bs4.BeautifulSoup(response.text, features)
+    response = cached_get(url, max_age=max_age)
+    with Metrics().timer("parse_seconds", backend=f"bs4-{features}"):
+        return bs4.BeautifulSoup(response.text, features)
+
+
+def stream_extract(url, spec: ExtractSpec, max_age=0, scraper="default",
+                   max_bytes=HTTP_MAX_RESPONSE_BYTES) -> List[str]:
+    """
+    Stream the webpage from the given URL into an incremental parser, closing the connection once the spec's region
+    has been read or max_bytes have arrived.
+    :param url: URL of the webpage
+    :param spec: What to extract
+    :param max_age: Seconds a cached copy is used without revalidating it
+    :param scraper: Name the bytes read/skipped are recorded under
+    :param max_bytes: Maximum body bytes read
+    :return: Extracted values
+    """
+    vary = stream_cache_vary(spec)
+    cache = ResponseCache() if HTTP_CACHE_ENABLED else None
+    entry = cache.lookup(url, vary) if cache is not None else None
+    headers = {}
+    if entry is not None:
+        if entry.age() < max_age:
+            cache.stats.incr('hits')
+            return extract(entry.text, spec)
+        headers = entry.conditional_headers()
+    with HTTPClient().request("GET", url, headers=headers, stream=True) as response:
+        if response.status_code == 304 and entry is not None:
+            cache.stats.incr('revalidated')
+            cache.refresh(url, vary)
+            return extract(entry.text, spec)
+        response.raise_for_status()
+        encoding = response.encoding or 'utf-8'
+        page = StreamedPage(spec, encoding, max_bytes, keep_body=cache is not None)
+        # Leaving the block with the body unread closes the connection instead of returning it to the pool
+        page.complete = all(page.feed(chunk) for chunk in response.iter_content(HTTP_STREAM_CHUNK_SIZE))
+        values = page.finish(url, response.headers, scraper)
+    if cache is not None:
+        cache.stats.incr('misses')
+        if page.cacheable(response.headers, max_age):
+            cache.store(url, bytes(page.body), response.headers, encoding, vary)
+    return values
+
+
+def extract_webpage(url, spec: ExtractSpec, max_age=0, scraper="default") -> List[str]:
+    """
+    Get the webpage from the given URL and extract the values described by spec, without building a full tree.
+    :param url: URL of the webpage
+    :param spec: What to extract
+    :param max_age: Seconds a cached copy is used without revalidating it
+    :param scraper: Name streamed bytes are recorded under
+    :return: Extracted values
+    """
+    # Archived pages are whole, and replayed ones have been read already
+    if HTTP_STREAMING and ARCHIVE_MODE == "off":
+        return stream_extract(url, spec, max_age=max_age, scraper=scraper)
+    return extract(cached_get(url, max_age=max_age).text, spec)
 
 
 def get_url_path_parts(url) -> List[str]:
@@ -28,11 +531,12 @@ def get_url_path_parts(url) -> List[str]:
     return paths
 
 
-def get_authenticated_api_data(url, bearer_token):
+def get_authenticated_api_data(url, bearer_token, max_age=0):
     """
     Make an authenticated API request
     :param url: URL
     :param bearer_token: Bearer Token
+    :param max_age: Seconds a cached copy is used without revalidating it
     :return: Response
     """
     headers = {
@@ -41,9 +545,7 @@ def get_authenticated_api_data(url, bearer_token):
         'Content-Type': 'application/json',
         'Encoding': 'utf-8'
     }
-    resp = requests.get(url, headers=headers)
-    resp.raise_for_status()
-    return resp.json()
+    return cached_get(url, headers=headers, max_age=max_age, vary=bearer_token).json()
 
 
 def post_authenticated_api_data(url, bearer_token, json_data):
@@ -60,6 +562,62 @@ def post_authenticated_api_data(url, bearer_token, json_data):
         'Content-Type': 'application/json',
         'Encoding': 'utf-8'
     }
-    resp = requests.post(url, headers=headers, json=json_data)
+    resp = HTTPClient().request("POST", url, headers=headers, json=json_data)
     resp.raise_for_status()
     return resp.json()
+
+
+def set_query_params(url, **params) -> str:
+    """
+    Set (or replace) query parameters on a URL
+    :param url: URL
+    :param params: Parameters to set
+    :return: URL
+    """
+    parts = urlparse.urlsplit(url)
+    query = dict(urlparse.parse_qsl(parts.query, keep_blank_values=True))
+    query.update({k: str(v) for k, v in params.items()})
+    return urlparse.urlunsplit(parts._replace(query=urlparse.urlencode(query)))
+
+
+def iter_paginated_api_data(url, bearer_token, per_page=API_PAGE_SIZE, max_workers=API_MAX_WORKERS,
+                            max_age=0) -> Iterator[dict]:
+    """
+    Stream the items of a paginated API collection (Mealie style: items, page, total_pages).
+    The first page is fetched to learn total_pages, the remaining pages are fetched concurrently with at most
+    max_workers in flight. Items are yielded as soon as their page arrives, so pages may come out of order.
+    :param url: URL of the collection, perPage/page are set on it
+    :param bearer_token: Bearer Token
+    :param per_page: Page size
+    :param max_workers: Maximum pages in flight
+    :param max_age: Seconds a cached page is used without revalidating it
+    :return: Iterator of items
+    """
+    def fetch_page(page):
+        return get_authenticated_api_data(set_query_params(url, perPage=per_page, page=page), bearer_token, max_age)
+
+    first = fetch_page(1)
+    yield from first['items']
+    total_pages = first.get('total_pages', 1)
+    if total_pages <= 1:
+        return
+    logging.debug(f"Fetching {total_pages - 1} more pages of {url}")
+    pages = iter(range(2, total_pages + 1))
+    executor = ThreadPoolExecutor(max_workers)
+    try:
+        pending = set()
+        for page in pages:
+            pending.add(executor.submit(fetch_page, page))
+            if len(pending) >= max_workers:
+                break
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                # Only queue another page once one has been consumed, so a slow consumer bounds memory
+                page = next(pages, None)
+                if page is not None:
+                    pending.add(executor.submit(fetch_page, page))
+                yield from future.result()['items']
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+